@@ -4,20 +4,38 @@ from sklearn.ensemble import RandomForestClassifier, IsolationForest
 from sklearn.preprocessing import StandardScaler, OneHotEncoder
 from sklearn.pipeline import Pipeline
 from sklearn.compose import ColumnTransformer
-from datetime import datetime, timedelta
+from datetime import datetime
 import pickle
-import requests
+import hashlib
 import logging
-from database import get_db, User, Transaction,TransactionAnalysis, UserProfile, Alert
+from database import begin_write, get_db, split_analysis_row, User, Transaction,TransactionAnalysis, TransactionAnalysisPayload, UserProfile, Alert
+from feature_store import ensure_user, get_profile_values, get_user_features, record_profile, record_transaction
+from ip_reputation import IPReputationIndex
+from blocklist import BlocklistRefresher
+from geoip import get_resolver
+from analysis_writer import AnalysisWriter
+from alert_queue import AlertDispatcher, AlertQueue, build_alert_data
+from alert_store import build_alert_row
+from rollups import record_analysis_counts, record_counts
+from serialization import Lazy, dumps_str, loads
+from logging_config import configure_logging
+from metrics import TRANSACTIONS, stage_timer
+from sqlalchemy import func
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
+import asyncio
 import json
 import os
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 import uuid
 from typing import Dict, List, Optional, Tuple
 
+ai_logger = logging.getLogger('fraud_detection.ai')
+
 class FraudDetectionSystem:
     # Class constants
+    AI_SYSTEM_MESSAGE = "You are a financial fraud detection system. Your task is to analyze user financial transactions based on transaction history and the latest transaction to determine if the new transaction is likely fraudulent. You must respond with valid JSON only, no additional text."
+
     FRAUD_DETECTION_PROMPT = """
     Analyze this transaction for potential fraud. The process includes:
 
@@ -123,16 +141,11 @@ class FraudDetectionSystem:
     """
 
     def __init__(self):
-        # Thiết lập logging
-        logging.basicConfig(
-            level=logging.INFO,
-            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-            handlers=[
-                logging.FileHandler('fraud_detection.log'),
-                logging.StreamHandler()  # Thêm handler để log ra console
-            ]
-        )
+        # Thiết lập logging (ghi qua hàng đợi nền, xem logging_config)
+        configure_logging('fraud_detection.log')
         self.logger = logging.getLogger('fraud_detection')
+        # Logger riêng cho từng giai đoạn để lấy mẫu độc lập qua LOG_SAMPLE_RATES
+        self.rules_logger = logging.getLogger('fraud_detection.rules')
         
         # Load mô hình hoặc tạo mới nếu chưa có
         try:
@@ -140,8 +153,9 @@ class FraudDetectionSystem:
             if os.path.exists(model_path):
                 with open(model_path, 'rb') as f:
                     self.model = pickle.load(f)
+                self.model_version = self._model_version(model_path)
             else:
-                self.logger.warning(f"Model file not found at {model_path}")
+                self.logger.warning("Model file not found at %s", model_path)
                 raise FileNotFoundError("Model file not found")
             # self.scaler = pickle.load(open('scaler.pkl', 'rb'))
             # self.encoder = pickle.load(open('encoder.pkl', 'rb'))
@@ -149,6 +163,7 @@ class FraudDetectionSystem:
         except:
             self.logger.info("Khởi tạo mô hình mới")
             self.model = None
+            self.model_version = 'none'
             self.scaler = StandardScaler()
             self.encoder = OneHotEncoder(handle_unknown='ignore')
             
@@ -161,72 +176,59 @@ class FraudDetectionSystem:
             'anomaly_score_threshold': 0.65   # Ngưỡng điểm bất thường
         }
         
-        # Danh sách IP được biết là nguy hiểm từ nguồn bên ngoài
-        self.known_bad_ips = self._load_known_bad_ips()
+        # Index IP/dải CIDR được biết là nguy hiểm: tải ngay từ snapshot cục bộ,
+        # làm mới từ nguồn bên ngoài trong thread nền
+        self.blocklist = BlocklistRefresher.from_env()
+        self.blocklist.start()
+        
+        # Cơ sở dữ liệu IP -> quốc gia/vùng cục bộ để điền và xác thực geolocation
+        self.geoip = get_resolver()
+        
+        # Hàng đợi ghi nhóm kết quả phân tích (tùy chọn, bật bằng ANALYSIS_WRITE_BEHIND)
+        self.analysis_writer = AnalysisWriter.from_env()
+        
+        # Hàng đợi cảnh báo bền vững (tùy chọn, bật bằng ALERTS_ENABLED): giao dịch đáng ngờ chỉ
+        # ghi job vào file hàng đợi cục bộ, các worker nền gửi push/email/SMS
+        self.alert_queue = AlertQueue.from_env()
+        self.alert_channels = {channel.strip() for channel in os.getenv('ALERT_CHANNELS', 'push,email,sms').split(',')}
+        self.alert_dispatcher = None
+        if self.alert_queue is not None and int(os.getenv('ALERT_DISPATCH_WORKERS', 4)) > 0:
+            self.alert_dispatcher = AlertDispatcher.from_env(self.alert_queue).start()
+        
+        # Client LLM bất đồng bộ cho API ASGI, tạo khi cần
+        self._async_llm_client = None
     
-    def _load_known_bad_ips(self):
-        """Tải danh sách IP đã biết là độc hại từ API AbuseIPDB"""
-        try:
-            # Sử dụng API AbuseIPDB để lấy danh sách IP độc hại
-            # Bạn cần đăng ký tài khoản tại https://www.abuseipdb.com để lấy API key
-            api_key = os.getenv('ABUSEIPDB_API_KEY')
-            headers = {
-                'Key': api_key,
-                'Accept': 'application/json'
-            }
-            
-            # Lấy danh sách blacklist IP có điểm tin cậy từ 90% trở lên trong 30 ngày qua
-            params = {
-                'confidenceMinimum': 90,
-                'limit': 100  # Giới hạn số lượng IP trả về
-            }
-            
-            response = requests.get(
-                "https://api.abuseipdb.com/api/v2/blacklist",
-                headers=headers,
-                params=params,
-                timeout=10
-            )
-            
-            if response.status_code == 200:
-                data = response.json()
-                # Trích xuất danh sách IP từ phản hồi
-                ip_list = [item['ipAddress'] for item in data.get('data', [])]
-                self.logger.info(f"Đã tải thành công {len(ip_list)} IP độc hại")
-                return set(ip_list)
-            else:
-                self.logger.warning(f"Lỗi khi tải IP độc hại từ API, đọc từ file dự phòng")
-                try:
-                    with open('ip_data.json', 'r') as f:
-                        data = json.loads(f.read())
-                        ip_list = [item['ipAddress'] for item in data.get('data', [])]
-                        self.logger.info(f"Đã tải {len(ip_list)} IP độc hại từ file")
-                        return set(ip_list)
-                except Exception as e:
-                    self.logger.warning(f"Không thể đọc file ip_data.json: {str(e)}")
-                    return set()
-        except Exception as e:
-            self.logger.warning(f"Không thể tải danh sách IP độc hại: {str(e)}")
-            return set()
+    @staticmethod
+    def _model_version(model_path: str) -> str:
+        """MODEL_VERSION if set, otherwise a short hash of the model file"""
+        if os.getenv('MODEL_VERSION'):
+            return os.getenv('MODEL_VERSION')
+        with open(model_path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()[:12]
+    
+    def _timed(self, stage: str):
+        """Record the duration of a processing stage in the latency histograms"""
+        return stage_timer(stage, self.model_version)
+    
+    @property
+    def known_bad_ips(self) -> IPReputationIndex:
+        """Index IP độc hại hiện tại (được thay thế nguyên tử khi blocklist được làm mới)"""
+        return self.blocklist.index
     
     def _get_user_location_history(self, db: Session, user_id: str):
         """Lấy lịch sử vị trí của người dùng từ database"""
-        user_profile = db.query(UserProfile).filter(UserProfile.user_id == user_id).first()
-        if user_profile and user_profile.common_locations:
-            return user_profile.common_locations
-        return []
+        return get_profile_values(db, user_id, 'location')['location']
     
     def _get_user_ip_address_history(self, db: Session, user_id: str):
         """Lấy lịch sử vị trí của người dùng từ database"""
         try:
-            self.logger.info(f"Lấy lịch sử IP của user {user_id}")
+            self.logger.info("Lấy lịch sử IP của user %s", user_id)
             
-            user_profile = db.query(UserProfile).filter(UserProfile.user_id == user_id).first()
+            ip_addresses = get_profile_values(db, user_id, 'ip_address')['ip_address']
             
-            if user_profile and user_profile.common_ip_addresses:
-                ip_addresses = user_profile.common_ip_addresses
-                self.logger.info(f"Tìm thấy {len(ip_addresses)} IP trong lịch sử")
-                self.logger.debug(f"Danh sách IP: {ip_addresses}")
+            if ip_addresses:
+                self.logger.info("Tìm thấy %s IP trong lịch sử", len(ip_addresses))
+                self.logger.debug("Danh sách IP: %s", ip_addresses)
                 return ip_addresses
             
             self.logger.info("Không tìm thấy lịch sử IP")
@@ -239,7 +241,7 @@ class FraudDetectionSystem:
         """Lấy lịch sử giao dịch của người dùng từ database"""
 
         transactions = db.query(Transaction).filter(Transaction.user_id == user_id).order_by(Transaction.timestamp.desc()).limit(100).all()
-        self.logger.info(f"Tìm thấy {len(transactions)} giao dịch")
+        self.logger.info("Tìm thấy %s giao dịch", len(transactions))
 
         return [{
             'amount': t.amount,
@@ -261,17 +263,11 @@ class FraudDetectionSystem:
     
     def _get_common_categories(self, db: Session, user_id: str):
         """Lấy các danh mục sản phẩm thường mua của người dùng từ database"""
-        user_profile = db.query(UserProfile).filter(UserProfile.user_id == user_id).first()
-        if user_profile and user_profile.common_categories:
-            return set(user_profile.common_categories)
-        return set()
+        return set(get_profile_values(db, user_id, 'category')['category'])
     
     def _get_common_transaction_times(self, db: Session, user_id: str):
         """Lấy thời gian giao dịch thường xuyên của người dùng từ database"""
-        user_profile = db.query(UserProfile).filter(UserProfile.user_id == user_id).first()
-        if user_profile and user_profile.typical_transaction_hours:
-            return user_profile.typical_transaction_hours
-        return []
+        return [int(hour) for hour in get_profile_values(db, user_id, 'hour')['hour']]
     
     def _get_recent_transactions(self, db: Session, user_id: str, hours=1):
         """Lấy số lượng giao dịch gần đây trong khoảng thời gian chỉ định từ database"""
@@ -282,6 +278,22 @@ class FraudDetectionSystem:
         ).all()
         return recent
     
+    def _count_recent_transactions(self, db: Session, user_id: str, hours=1) -> int:
+        """Count the user's transactions in the last `hours`, answered from the (user_id, timestamp) index alone"""
+        cutoff_time = datetime.now() - pd.Timedelta(hours=hours)
+        return db.query(func.count()).select_from(Transaction).filter(
+            Transaction.user_id == user_id,
+            Transaction.timestamp >= cutoff_time
+        ).scalar()
+    
+    def _get_user_features(self, db: Session, user_id: str, now: Optional[datetime] = None) -> Optional[Dict]:
+        """Read the materialized feature record of the user in a single primary-key lookup"""
+        try:
+            return get_user_features(db, user_id, now)
+        except Exception as e:
+            self.logger.error("Error getting user features: %s", e)
+            return None
+    
     def _get_user_profile(self, db: Session, user_id: str) -> Optional[Dict]:
         """
         Lấy thông tin profile của user từ database
@@ -289,7 +301,7 @@ class FraudDetectionSystem:
         try:
             # Lấy user profile từ database
             profile = db.query(UserProfile).filter(UserProfile.user_id == user_id).first()
-            self.logger.info(f"Found profile: {profile.__dict__ if profile else None}")
+            self.logger.debug("Found profile for user %s: %s", user_id, profile is not None)
             
             # Return default profile if no profile found
             if not profile:
@@ -304,18 +316,19 @@ class FraudDetectionSystem:
                 }
                 
             # Chuyển đổi profile thành dictionary
+            values = get_profile_values(db, user_id)
             return {
-                'common_ip_addresses': profile.common_ip_addresses if profile.common_ip_addresses else [],
-                'common_locations': profile.common_locations if profile.common_locations else [],
-                'common_devices': profile.common_devices if profile.common_devices else [],
-                'common_categories': profile.common_categories if profile.common_categories else [],
+                'common_ip_addresses': values['ip_address'],
+                'common_locations': values['location'],
+                'common_devices': values['device'],
+                'common_categories': values['category'],
                 'avg_transaction_amount': profile.avg_transaction_amount,
-                'typical_transaction_hours': profile.typical_transaction_hours if profile.typical_transaction_hours else [],
+                'typical_transaction_hours': [int(hour) for hour in values['hour']],
                 'transactions': self._get_user_transaction_history(db, user_id)
             }
             
         except Exception as e:
-            logging.error(f"Error getting user profile: {str(e)}")
+            self.logger.error("Error getting user profile: %s", e)
             return {
                 'common_ip_addresses': [],
                 'common_locations': [],
@@ -329,58 +342,72 @@ class FraudDetectionSystem:
     def _check_ip_address(self, db: Session, user_id: str, ip_address: str) -> Dict:
         """Check if the IP address is suspicious"""
         try:
-            self.logger.info(f"Checking IP {ip_address} for user {user_id}")
+            self.rules_logger.info("Checking IP %s for user %s", ip_address, user_id)
             
-            # Check if IP is in blacklist
-            if ip_address in self.known_bad_ips:
-                self.logger.warning(f"IP {ip_address} is in the malicious IP list")
+            # Check if IP (or its subnet) is in blacklist
+            reputation = self.known_bad_ips.lookup(ip_address)
+            if reputation:
+                self.rules_logger.warning("IP %s is in the malicious IP list: %s", ip_address, reputation)
                 return {
                     'is_suspicious': True,
-                    'reason': 'IP is in the known malicious IP list',
+                    'reason': f'IP is in the known malicious IP list ({reputation.network}, confidence {reputation.score}%)',
                     'risk_score': 0.9
                 }
         
             # Get user profile
             common_ips = self._get_user_ip_address_history(db, user_id)
-            self.logger.info(f"User's common IPs: {common_ips}")
+            self.rules_logger.debug("User's common IPs: %s", common_ips)
             
             if ip_address not in common_ips:
-                self.logger.warning(f"IP {ip_address} has never appeared in history")
+                self.rules_logger.warning("IP %s has never appeared in history", ip_address)
                 return {
                     'is_suspicious': True,
                     'reason': f'New IP: {ip_address} has never appeared in history',
                     'risk_score': 0.7
                 }
             
-            self.logger.info(f"IP {ip_address} is valid")
+            self.rules_logger.info("IP %s is valid", ip_address)
             return {'is_suspicious': False, 'reason': '', 'risk_score': 0.0}
             
         except Exception as e:
-            self.logger.error(f"Error checking IP address: {str(e)}")
+            self.rules_logger.error("Error checking IP address: %s", e)
             return {'is_suspicious': False, 'reason': '', 'risk_score': 0.0}
 
-    def _check_location(self, db: Session, user_id, geolocation):
+    def _check_location(self, db: Session, user_id, geolocation, ip_address=None):
         """Check if the location is suspicious"""
         try:
-            self.logger.info(f"Checking location {geolocation} for user {user_id}")
+            self.rules_logger.info("Checking location %s for user %s", geolocation, user_id)
+            result = {'is_suspicious': False, 'reason': '', 'risk_score': 0.0}
             
             # Check if location is in history
             locations = self._get_user_location_history(db, user_id)
-            self.logger.info(f"User's common locations: {locations}")
+            self.rules_logger.debug("User's common locations: %s", locations)
             
             if locations and geolocation not in locations:
-                self.logger.warning(f"New location: {geolocation} has never appeared in history")
-                return {
+                self.rules_logger.warning("New location: %s has never appeared in history", geolocation)
+                result = {
                     'is_suspicious': True,
                     'reason': f'New location: {geolocation} has never appeared in history',
                     'risk_score': 0.7
                 }
-        
-            self.logger.info(f"Location {geolocation} is valid")
-            return {'is_suspicious': False, 'reason': '', 'risk_score': 0.0}
+            
+            # Check the claimed location against the location of the IP address
+            ip_location = self.geoip.lookup(ip_address) if ip_address else None
+            if ip_location and not ip_location.matches(geolocation):
+                self.rules_logger.warning("Location %s does not match IP location %s", geolocation, ip_location)
+                mismatch = f'Claimed location {geolocation} does not match IP location {ip_location.display_name}'
+                return {
+                    'is_suspicious': True,
+                    'reason': f"{result['reason']}; {mismatch}" if result['reason'] else mismatch,
+                    'risk_score': max(result['risk_score'], 0.6)
+                }
+            
+            if not result['is_suspicious']:
+                self.rules_logger.info("Location %s is valid", geolocation)
+            return result
             
         except Exception as e:
-            self.logger.error(f"Error checking location: {str(e)}")
+            self.rules_logger.error("Error checking location: %s", e)
             return {'is_suspicious': False, 'reason': '', 'risk_score': 0.0}
     
     def _check_amount(self, db: Session, user_id, amount):
@@ -427,24 +454,27 @@ class FraudDetectionSystem:
         
         return {'is_suspicious': False, 'reason': '', 'risk_score': 0.0}
     
-    def _check_frequency(self, db: Session, user_id, timestamp):
+    def _check_frequency(self, db: Session, user_id, timestamp, features: Optional[Dict] = None):
         """Check if the transaction frequency is suspicious"""
-        recent = self._get_recent_transactions(db, user_id, hours=1)
+        # Prefer the materialized hourly counter, fall back to a range scan for users without a feature record
+        if features is not None:
+            recent_count = round(features['transactions_last_hour'])
+        else:
+            recent_count = self._count_recent_transactions(db, user_id, hours=1)
         
-        if len(recent) >= self.thresholds['max_transactions_per_hour']:
+        if recent_count >= self.thresholds['max_transactions_per_hour']:
             return {
                 'is_suspicious': True,
-                'reason': f'Unusual number of transactions in 1 hour: {len(recent)}',
-                'risk_score': min(0.8, len(recent) / self.thresholds['max_transactions_per_hour'] * 0.4)
+                'reason': f'Unusual number of transactions in 1 hour: {recent_count}',
+                'risk_score': min(0.8, recent_count / self.thresholds['max_transactions_per_hour'] * 0.4)
             }
         
         return {'is_suspicious': False, 'reason': '', 'risk_score': 0.0}
     
     def _check_device(self, db: Session, user_id, device_id):
         """Check if the device is suspicious"""
-        user_profile = db.query(UserProfile).filter(UserProfile.user_id == user_id).first()
-        if user_profile and user_profile.common_devices:
-            common_devices = user_profile.common_devices
+        common_devices = get_profile_values(db, user_id, 'device')['device']
+        if common_devices:
             if device_id not in common_devices:
                 return {
                     'is_suspicious': True,
@@ -465,7 +495,7 @@ class FraudDetectionSystem:
             self.logger.info("Bắt đầu huấn luyện mô hình với dữ liệu giao dịch.")
             # Chuẩn bị dữ liệu
             df = pd.DataFrame(transaction_data)
-            self.logger.info(f"Số lượng giao dịch: {len(df)}")
+            self.logger.info("Số lượng giao dịch: %s", len(df))
             
             # Chuyển đổi timestamp thành giờ
             df['hour'] = pd.to_datetime(df['timestamp']).dt.hour
@@ -474,13 +504,13 @@ class FraudDetectionSystem:
             features = ['amount', 'hour', 'currency', 'description', 'category', 'ip_address', 'geolocation', 'device_id']
             X = df[features]
             y = df['is_fraud'] if 'is_fraud' in df.columns else None
-            self.logger.info(f"Features được sử dụng: {features}")
+            self.logger.info("Features được sử dụng: %s", features)
             
             # Xác định các cột theo loại
             categorical_features = ['currency', 'description', 'category', 'ip_address', 'geolocation', 'device_id']
             numeric_features = ['amount', 'hour']
-            self.logger.info(f"Các features số: {numeric_features}")
-            self.logger.info(f"Các features phân loại: {categorical_features}")
+            self.logger.info("Các features số: %s", numeric_features)
+            self.logger.info("Các features phân loại: %s", categorical_features)
             
             # Tạo preprocessor
             preprocessor = ColumnTransformer(
@@ -508,12 +538,14 @@ class FraudDetectionSystem:
                 self.model.fit(X)
             
             # Lưu mô hình và các transformer
-            pickle.dump(self.model, open('fraud_detection_model.pkl', 'wb'))
+            with open('fraud_detection_model.pkl', 'wb') as f:
+                pickle.dump(self.model, f)
+            self.model_version = self._model_version('fraud_detection_model.pkl')
             self.logger.info("Mô hình đã được huấn luyện và lưu thành công")
             return True
             
         except Exception as e:
-            self.logger.error(f"Lỗi khi huấn luyện mô hình: {str(e)}")
+            self.logger.error("Lỗi khi huấn luyện mô hình: %s", e)
             return False
     
     def predict_with_model(self, transaction):
@@ -537,33 +569,37 @@ class FraudDetectionSystem:
                 # Lấy xác suất của lớp dương tính (gian lận)
                 self.logger.info("Using RandomForestClassifier for prediction")
                 proba = self.model.predict_proba(X)[0][1]
-                self.logger.info(f"Predicted fraud probability: {proba}")
+                self.logger.info("Predicted fraud probability: %s", proba)
                 return proba
             else:
                 # Isolation Forest trả về điểm bất thường
                 self.logger.info("Using IsolationForest for prediction") 
                 score = -self.model.decision_function(X)[0]
                 normalized_score = score / 2 + 0.5  # Chuẩn hóa về khoảng 0-1
-                self.logger.info(f"Raw anomaly score: {score}")
-                self.logger.info(f"Normalized anomaly score: {normalized_score}")
+                self.logger.info("Raw anomaly score: %s", score)
+                self.logger.info("Normalized anomaly score: %s", normalized_score)
                 return normalized_score
         except Exception as e:
-            self.logger.error(f"Lỗi khi dự đoán với mô hình: {str(e)}")
+            self.logger.error("Lỗi khi dự đoán với mô hình: %s", e)
             return 0.5
     
     def update_user_profile(self, db: Session, user_id: str, transaction_data: dict):
-        """Cập nhật hồ sơ người dùng với dữ liệu giao dịch mới vào database"""
-        self.logger.info(f"Updating user profile for user {user_id}")
+        """
+        Cập nhật hồ sơ người dùng với dữ liệu giao dịch mới vào database
+
+        Every write is an atomic upsert or increment evaluated by the database, so
+        concurrent verifications for the same user do not overwrite each other.
+        """
+        self.logger.info("Updating user profile for user %s", user_id)
+        
+        # Ghi trong một write transaction (không có tác dụng nếu caller đã mở transaction)
+        begin_write(db)
         
-        # Tạo hoặc cập nhật user
-        user = db.query(User).filter(User.user_id == user_id).first()
-        if not user:
-            self.logger.info(f"Creating new user record for {user_id}")
-            user = User(user_id=user_id)
-            db.add(user)
+        # Tạo user nếu chưa có
+        created = ensure_user(db, user_id)
         
         # Tạo transaction mới
-        self.logger.info(f"Creating new transaction record for transaction {transaction_data.get('transaction_id')}")
+        self.logger.info("Creating new transaction record for transaction %s", transaction_data.get('transaction_id'))
         transaction = Transaction(
             transaction_id=transaction_data.get('transaction_id'),
             user_id=user_id,
@@ -577,57 +613,23 @@ class FraudDetectionSystem:
             device_id=transaction_data.get('device_id'),
         )
         db.add(transaction)
+        db.flush()
         
-        # Cập nhật user profile
-        profile = db.query(UserProfile).filter(UserProfile.user_id == user_id).first()
-        if not profile:
-            self.logger.info(f"Creating new user profile for {user_id}")
-            profile = UserProfile(user_id=user_id)
-            db.add(profile)
-        
-        # Cập nhật các thông tin profile
-        self.logger.info(f"Fetching transaction history for user {user_id}")
-        transactions = self._get_user_transaction_history(db, user_id)
-        if transactions:
-            self.logger.info(f"Found {len(transactions)} transactions for user {user_id}")
-            
-            # Cập nhật locations
-            locations = set(t.get('geolocation') for t in transactions if t.get('geolocation'))
-            profile.common_locations = list(locations)
-            self.logger.debug(f"Updated common locations: {profile.common_locations}")
-            
-            # Cập nhật devices
-            devices = set(t.get('device_id') for t in transactions if t.get('device_id'))
-            profile.common_devices = list(devices)
-            self.logger.debug(f"Updated common devices: {profile.common_devices}")
-            
-            # Cập nhật categories
-            categories = set(t.get('category') for t in transactions if t.get('category'))
-            profile.common_categories = list(categories)
-            self.logger.debug(f"Updated common categories: {profile.common_categories}")
-            
-            # Cập nhật ip_addresses
-            ip_addresses = set(t.get('ip_address') for t in transactions if t.get('ip_address'))
-            profile.common_ip_addresses = list(ip_addresses)
-            self.logger.debug(f"Updated common IP addresses: {profile.common_ip_addresses}")
-                
-            # Cập nhật avg_transaction_amount
-            profile.avg_transaction_amount = sum(t.get('amount', 0) for t in transactions) / len(transactions)
-            self.logger.debug(f"Updated average transaction amount: {profile.avg_transaction_amount}")
-            
-            # Cập nhật typical_transaction_hours
-            hours = [datetime.fromisoformat(t['timestamp']).hour if isinstance(t['timestamp'], str) else t['timestamp'].hour for t in transactions if 'timestamp' in t]
-            profile.typical_transaction_hours = list(set(hours))
-            self.logger.debug(f"Updated typical transaction hours: {profile.typical_transaction_hours}")
+        # Cập nhật feature record và profile trong cùng transaction với bản ghi giao dịch
+        record_transaction(db, user_id, transaction.amount, transaction.timestamp)
+        record_profile(db, user_id, transaction_data)
+        if created:
+            record_counts(db, new_users=1)
         
-        profile.last_updated = datetime.now()
-        self.logger.info(f"Committing updates to database for user {user_id}")
+        self.logger.info("Committing updates to database for user %s", user_id)
         db.commit()
-        self.logger.info(f"Successfully updated user profile for {user_id}")
+        self.logger.info("Successfully updated user profile for %s", user_id)
     
-    def analyze_transaction(self, db: Session, transaction_data: dict):
+    def analyze_transaction(self, db: Session, transaction_data: dict, features: Optional[Dict] = None):
         """
         Analyze transaction using traditional rule-based methods
+        Args:
+            features: the user's feature record, if already loaded by the caller
         Returns:
             Dict containing:
             - fraud_score: float (0-100)
@@ -635,13 +637,13 @@ class FraudDetectionSystem:
             - analysis_details: List[Dict] containing detailed analysis results
             - reasons: List[str] containing reasons for the decision
         """
-        self.logger.info(f"Starting ML transaction analysis")
+        self.rules_logger.info("Starting ML transaction analysis")
         
         try:
-            self.logger.info(f"transaction_data: {transaction_data}")
+            self.rules_logger.debug("transaction_data: %s", transaction_data)
             # Get transaction information
             user_id = transaction_data['user_id']
-            self.logger.info(f"user_id: {user_id}")
+            self.rules_logger.debug("user_id: %s", user_id)
 
             amount = transaction_data['amount']
             currency = transaction_data.get('currency', 'VND')
@@ -651,32 +653,37 @@ class FraudDetectionSystem:
             geolocation = transaction_data.get('geolocation', '')
             device_id = transaction_data.get('device_id', '')
             
-            self.logger.info(f"Analyzing transaction for user {user_id}: amount={amount} {currency}, category={category}, timestamp={timestamp}")
-            self.logger.info(f"Location info: ip={ip_address}, geo={geolocation}, device={device_id}")
+            self.rules_logger.info("Analyzing transaction for user %s: amount=%s %s, category=%s, timestamp=%s", user_id, amount, currency, category, timestamp)
+            self.rules_logger.info("Location info: ip=%s, geo=%s, device=%s", ip_address, geolocation, device_id)
             
             # Perform rule-based checks
-            results = {
-                'geolocation': self._check_location(db, user_id, geolocation),
-                'ip_address': self._check_ip_address(db, user_id, ip_address),
-                'amount': self._check_amount(db, user_id, amount),
-                'category': self._check_category(db, user_id, category),
-                'time': self._check_time(db, user_id, timestamp),
-                'frequency': self._check_frequency(db, user_id, timestamp),
-                'device': self._check_device(db, user_id, device_id)
+            checks = {
+                'geolocation': lambda: self._check_location(db, user_id, geolocation, ip_address),
+                'ip_address': lambda: self._check_ip_address(db, user_id, ip_address),
+                'amount': lambda: self._check_amount(db, user_id, amount),
+                'category': lambda: self._check_category(db, user_id, category),
+                'time': lambda: self._check_time(db, user_id, timestamp),
+                'frequency': lambda: self._check_frequency(db, user_id, timestamp, features),
+                'device': lambda: self._check_device(db, user_id, device_id)
             }
+            results = {}
+            for check_type, check in checks.items():
+                with self._timed(f'rule_{check_type}'):
+                    results[check_type] = check()
             
-            self.logger.info(f"Rule check results: {results}")
+            self.rules_logger.debug("Rule check results: %s", results)
             
             # Calculate risk score from rules
             risk_factors = [r['risk_score'] for r in results.values()]
             rules_risk_score = max(risk_factors) if risk_factors else 0
             
-            self.logger.info(f"Rules-based risk score: {rules_risk_score}")
+            self.rules_logger.info("Rules-based risk score: %s", rules_risk_score)
             
             # Get risk score from machine learning model
-            model_risk_score = self.predict_with_model(transaction_data)
+            with self._timed('ml_model'):
+                model_risk_score = self.predict_with_model(transaction_data)
             
-            self.logger.info(f"Model risk score: {model_risk_score}")
+            self.rules_logger.info("Model risk score: %s", model_risk_score)
             
             # Combine risk scores
             final_risk_score = max(rules_risk_score, model_risk_score)
@@ -704,8 +711,8 @@ class FraudDetectionSystem:
                     'message': 'Machine learning model detected potential fraud'
                 })
             
-            self.logger.info(f"Final analysis: score={final_risk_score}, suspicious={is_suspicious}")
-            self.logger.info(f"Suspicious reasons: {suspicious_reasons}")
+            self.rules_logger.info("Final analysis: score=%s, suspicious=%s", final_risk_score, is_suspicious)
+            self.rules_logger.info("Suspicious reasons: %s", suspicious_reasons)
             
             return {
                 'fraud_score': final_risk_score * 100,  # Convert to 0-100 scale
@@ -722,7 +729,7 @@ class FraudDetectionSystem:
             }
             
         except Exception as e:
-            self.logger.error(f"Error analyzing transaction: {str(e)}")
+            self.rules_logger.error("Error analyzing transaction: %s", e)
             return {
                 'fraud_score': 0,
                 'is_suspicious': False,
@@ -761,7 +768,7 @@ class FraudDetectionSystem:
     #         }
             
     #         # Log thông tin cảnh báo
-    #         self.logger.info(f"Gửi cảnh báo: {alert_info}")
+    #         self.rules_logger.info(f"Gửi cảnh báo: {alert_info}")
             
     #         # Ở đây bạn sẽ kết nối với dịch vụ gửi cảnh báo như SMS, email, push notification
     #         # Ví dụ:
@@ -784,134 +791,387 @@ class FraudDetectionSystem:
     #         return True
             
     #     except Exception as e:
-    #         self.logger.error(f"Lỗi khi gửi cảnh báo: {str(e)}")
+    #         self.rules_logger.error(f"Lỗi khi gửi cảnh báo: {str(e)}")
     #         return False
 
-    def process_transaction(self, db: Session, transaction_data: dict) -> dict:
+    def _prepare_transaction(self, transaction_data: dict):
+        """Điền geolocation từ địa chỉ IP nếu client không gửi"""
+        if not transaction_data.get('geolocation'):
+            ip_location = self.geoip.lookup(transaction_data.get('ip_address'))
+            if ip_location:
+                transaction_data['geolocation'] = ip_location.display_name
+                self.logger.info("Geolocation resolved from IP: %s", transaction_data['geolocation'])
+        self.logger.debug("Dữ liệu giao dịch: %s", Lazy(transaction_data))
+    
+    def _load_analysis_context(self, read_db: Session, transaction_data: dict) -> Tuple[Dict, Optional[Dict]]:
+        """Profile and feature record of the transaction's user, read before the LLM call"""
+        user_id = transaction_data['user_id']
+        with self._timed('profile_load'):
+            user_profile = self._get_user_profile(read_db, user_id)
+            features = self._get_user_features(read_db, user_id, transaction_data.get('timestamp'))
+        user_profile['features'] = features
+        
+        # Kết thúc transaction đọc để trả connection về pool trong lúc chờ LLM
+        read_db.rollback()
+        return user_profile, features
+    
+    def _run_traditional_analysis(self, read_db: Session, transaction_data: dict, features: Optional[Dict]) -> Dict:
+        traditional_analysis = self.analyze_transaction(read_db, transaction_data, features)
+        read_db.rollback()
+        self.logger.info("Traditional analysis completed: score=%s", traditional_analysis.get('fraud_score', 0))
+        self.logger.debug("Traditional analysis: %s", Lazy(traditional_analysis))
+        return traditional_analysis
+    
+    def _combine_analyses(self, transaction_data: dict, ai_analysis: Dict, traditional_analysis: Dict) -> Tuple[Dict, Dict]:
         """
-        Process a new transaction and return analysis results
+        Combine the AI and traditional analyses
         Returns:
-            Dict containing combined analysis results from both AI and traditional methods
+            (analysis_row, result): the TransactionAnalysis row to persist and the response
         """
-        try:
-            # Get user information
-            user_id = transaction_data['user_id']
-            self.logger.info(f"Bắt đầu xử lý giao dịch cho user {user_id}")
-            self.logger.info(f"Dữ liệu giao dịch: {json.dumps(transaction_data, indent=2, default=str)}")
-            
-            user_profile = self._get_user_profile(db, user_id)
-            
-            # Perform AI analysis
-            ai_analysis = self.analyze_with_ai(transaction_data, user_profile)
-            self.logger.info(f"AI analysis completed: {json.dumps(ai_analysis, indent=2)}")
-            
-            # Perform traditional analysis
-            traditional_analysis = self.analyze_transaction(db, transaction_data)
-            self.logger.info(f"Traditional analysis completed: {json.dumps(traditional_analysis, indent=2)}")
-            
-            # Combine results
-            # Use weighted average for fraud score (60% AI, 40% traditional)
-            combined_fraud_score = (ai_analysis.get('fraud_score', 0) * 0.6) + (traditional_analysis.get('fraud_score', 0) * 0.4)
-            self.logger.info(f"Điểm gian lận kết hợp: {combined_fraud_score:.2f}")
-            
-            # Transaction is suspicious if either method flags it
-            is_suspicious = ai_analysis.get('is_suspicious', False) or traditional_analysis.get('is_suspicious', False)
-            self.logger.info(f"Giao dịch đáng ngờ: {is_suspicious}")
-            
-            # Combine analysis details
-            combined_details = []
-            
-            # Add AI analysis details
-            for detail in ai_analysis.get('analysis_details', []):
-                detail['source'] = 'ai'
-                combined_details.append(detail)
-            
-            # Add traditional analysis details
-            for detail in traditional_analysis.get('analysis_details', []):
-                detail['source'] = 'traditional'
-                combined_details.append(detail)
-            
-            # Sort details by fraud score
-            combined_details.sort(key=lambda x: x.get('fraud_score', 0), reverse=True)
-            self.logger.info(f"Số lượng chi tiết phân tích: {len(combined_details)}")
-            
-            # Combine reasons
-            combined_reasons = list(set(ai_analysis.get('reasons', []) + traditional_analysis.get('reasons', [])))
-            self.logger.info(f"Lý do đáng ngờ: {combined_reasons}")
-            
-            # Create new transaction record
-            transactionAnalysis = TransactionAnalysis(
-                transaction_id=transaction_data.get('transaction_id', str(uuid.uuid4())),
-                user_id=user_id,
-                amount=transaction_data['amount'],
-                currency=transaction_data.get('currency', 'VND'),
-                description=transaction_data.get('description', ''),
-                category=transaction_data.get('category', 'unknown'),
-                timestamp=transaction_data.get('timestamp', datetime.now()),
-                ip_address=transaction_data['ip_address'],
-                geolocation=transaction_data.get('geolocation', 'unknown'),
-                device_id=transaction_data.get('device_id', 'unknown'),
-                is_suspicious=is_suspicious,
-                risk_score=combined_fraud_score,
-                ai_analysis=ai_analysis,
-                traditional_analysis=traditional_analysis,
-                fraud_reasons=combined_reasons
-            )
-            
-            db.add(transactionAnalysis)
-            db.commit()
-            self.logger.info(f"Đã lưu giao dịch analysis vào database với ID: {transactionAnalysis.transaction_id}")
-            
-            # Create alert if transaction is suspicious
-            if is_suspicious:
-                self.logger.info("Giao dịch đáng ngờ, tạo cảnh báo")
-                # self.send_alert(db, user_id, {
-                #     'risk_score': combined_fraud_score,
-                #     'reasons': combined_reasons
-                # }, transaction_data)
-            
-            result = {
-                'fraud_score': combined_fraud_score,
-                'is_suspicious': is_suspicious,
-                'analysis_details': combined_details,
-                'reasons': combined_reasons,
-                'suggestions': ai_analysis.get('suggestions', '') or traditional_analysis.get('suggestions', ''),
-                'alert': {
-                    'is_alert': is_suspicious,
-                    'message': 'Suspicious transaction detected by multiple methods' if is_suspicious else '',
-                    'details': {
-                        'ai_analysis': ai_analysis.get('alert', {}),
-                        'traditional_analysis': traditional_analysis.get('alert', {})
-                    },
-                    'suggestions': 'Verify transaction with user and consider additional security measures' if is_suspicious else ''
-                }
+        # Use weighted average for fraud score (60% AI, 40% traditional)
+        combined_fraud_score = (ai_analysis.get('fraud_score', 0) * 0.6) + (traditional_analysis.get('fraud_score', 0) * 0.4)
+        self.logger.info("Điểm gian lận kết hợp: %.2f", combined_fraud_score)
+        
+        # Transaction is suspicious if either method flags it
+        is_suspicious = ai_analysis.get('is_suspicious', False) or traditional_analysis.get('is_suspicious', False)
+        self.logger.info("Giao dịch đáng ngờ: %s", is_suspicious)
+        
+        # Combine analysis details
+        combined_details = []
+        
+        # Add AI analysis details
+        for detail in ai_analysis.get('analysis_details', []):
+            detail['source'] = 'ai'
+            combined_details.append(detail)
+        
+        # Add traditional analysis details
+        for detail in traditional_analysis.get('analysis_details', []):
+            detail['source'] = 'traditional'
+            combined_details.append(detail)
+        
+        # Sort details by fraud score
+        combined_details.sort(key=lambda x: x.get('fraud_score', 0), reverse=True)
+        self.logger.info("Số lượng chi tiết phân tích: %s", len(combined_details))
+        
+        # Combine reasons
+        combined_reasons = list(set(ai_analysis.get('reasons', []) + traditional_analysis.get('reasons', [])))
+        self.logger.info("Lý do đáng ngờ: %s", combined_reasons)
+        
+        # Create new transaction record
+        analysis_row = dict(
+            transaction_id=transaction_data.get('transaction_id', str(uuid.uuid4())),
+            user_id=transaction_data['user_id'],
+            amount=transaction_data['amount'],
+            currency=transaction_data.get('currency', 'VND'),
+            description=transaction_data.get('description', ''),
+            category=transaction_data.get('category', 'unknown'),
+            timestamp=transaction_data.get('timestamp', datetime.now()),
+            ip_address=transaction_data['ip_address'],
+            geolocation=transaction_data.get('geolocation', 'unknown'),
+            device_id=transaction_data.get('device_id', 'unknown'),
+            is_suspicious=is_suspicious,
+            risk_score=combined_fraud_score,
+            ai_analysis=ai_analysis,
+            traditional_analysis=traditional_analysis,
+            fraud_reasons=combined_reasons
+        )
+        
+        # Alerts for suspicious transactions are queued by the caller (see _enqueue_alert)
+        
+        result = {
+            'fraud_score': combined_fraud_score,
+            'is_suspicious': is_suspicious,
+            'analysis_details': combined_details,
+            'reasons': combined_reasons,
+            'suggestions': ai_analysis.get('suggestions', '') or traditional_analysis.get('suggestions', ''),
+            'alert': {
+                'is_alert': is_suspicious,
+                'message': 'Suspicious transaction detected by multiple methods' if is_suspicious else '',
+                'details': {
+                    'ai_analysis': ai_analysis.get('alert', {}),
+                    'traditional_analysis': traditional_analysis.get('alert', {})
+                },
+                'suggestions': 'Verify transaction with user and consider additional security measures' if is_suspicious else ''
             }
-            
-            self.logger.info("Hoàn thành xử lý giao dịch")
-            return result
-            
+        }
+        if is_suspicious:
+            # Bản ghi Alert được ghi cùng transaction với bản ghi phân tích
+            analysis_row['alert'] = build_alert_row(build_alert_data(
+                dict(transaction_data, transaction_id=analysis_row['transaction_id']), result
+            ))
+        return analysis_row, result
+    
+    def _queue_analysis(self, analysis_row: Dict) -> bool:
+        """Ghi qua hàng đợi write-behind nếu được bật; False nếu caller phải ghi đồng bộ"""
+        if self.analysis_writer is not None and self.analysis_writer.submit(analysis_row):
+            self.logger.info("Đã đưa giao dịch analysis vào hàng đợi ghi với ID: %s", analysis_row['transaction_id'])
+            return True
+        return False
+    
+    def _save_analysis(self, db: Session, analysis_row: Dict):
+        hot_row, payload_row = split_analysis_row(analysis_row)
+        with self._timed('db_commit'):
+            begin_write(db)
+            created = ensure_user(db, analysis_row['user_id'])
+            db.add(TransactionAnalysis(**hot_row))
+            if payload_row is not None:
+                db.add(TransactionAnalysisPayload(**payload_row))
+            if analysis_row.get('alert'):
+                # Alert chỉ có khóa ngoại (không có relationship) tới phân tích: ghi phân tích trước
+                db.flush()
+                db.add(Alert(**analysis_row['alert']))
+            db.flush()
+            # Bộ đếm thống kê cập nhật cuối cùng, cùng transaction với các bản ghi nó đếm
+            record_analysis_counts(db, [analysis_row], new_users=int(created))
+            db.commit()
+        self.logger.info("Đã lưu giao dịch analysis vào database với ID: %s", analysis_row['transaction_id'])
+    
+    def _enqueue_alert(self, transaction_data: dict, result: Dict):
+        """Queue the alert deliveries of a suspicious transaction; a queue error never fails the scoring"""
+        try:
+            with self._timed('alert_enqueue'):
+                alert_data = build_alert_data(transaction_data, result)
+                level, queued = self.alert_queue.submit(transaction_data['user_id'], alert_data, self.alert_channels)
+            # queued == 0: cảnh báo được gộp vào bản tổng hợp (digest) của người dùng
+            self.logger.info("Giao dịch đáng ngờ, đã đưa %s cảnh báo mức %s vào hàng đợi", queued, level)
         except Exception as e:
-            self.logger.error(f"Error processing transaction: {str(e)}")
-            db.rollback()
-            return {
-                'fraud_score': 0,
-                'is_suspicious': False,
-                'analysis_details': [],
-                'reasons': [f'Error processing transaction: {str(e)}'],
-                'suggestions': '',
-                'alert': {
-                    'is_alert': False,
-                    'message': '',
-                    'details': '',
-                    'suggestions': ''
-                }
+            self.logger.error("Không thể đưa cảnh báo vào hàng đợi: %s", e)
+    
+    def _count_outcome(self, result: Dict):
+        outcome = 'suspicious' if result['is_suspicious'] else 'normal'
+        TRANSACTIONS.inc(outcome=outcome, model_version=self.model_version)
+    
+    @staticmethod
+    def _process_error_result(e: Exception) -> Dict:
+        return {
+            'fraud_score': 0,
+            'is_suspicious': False,
+            'analysis_details': [],
+            'reasons': [f'Error processing transaction: {str(e)}'],
+            'suggestions': '',
+            'alert': {
+                'is_alert': False,
+                'message': '',
+                'details': '',
+                'suggestions': ''
             }
+        }
+    
+    def process_transaction(self, db: Session, transaction_data: dict, read_db: Optional[Session] = None) -> dict:
+        """
+        Process a new transaction and return analysis results
+        Args:
+            db: primary session, used for writes
+            read_db: session for profile and history reads (e.g. on a read replica), defaults to db
+        Returns:
+            Dict containing combined analysis results from both AI and traditional methods
+        """
+        with self._timed('total'):
+            try:
+                self.logger.info("Bắt đầu xử lý giao dịch cho user %s", transaction_data['user_id'])
+                self._prepare_transaction(transaction_data)
+                
+                read_db = read_db or db
+                user_profile, features = self._load_analysis_context(read_db, transaction_data)
+                
+                # Perform AI analysis
+                ai_analysis = self.analyze_with_ai(transaction_data, user_profile)
+                self.logger.info("AI analysis completed: score=%s", ai_analysis.get('fraud_score', 0))
+                self.logger.debug("AI analysis: %s", Lazy(ai_analysis))
+                
+                # Perform traditional analysis
+                traditional_analysis = self._run_traditional_analysis(read_db, transaction_data, features)
+                
+                analysis_row, result = self._combine_analyses(transaction_data, ai_analysis, traditional_analysis)
+                # Khi hàng đợi tắt hoặc đầy thì ghi đồng bộ
+                if not self._queue_analysis(analysis_row):
+                    self._save_analysis(db, analysis_row)
+                if result['is_suspicious'] and self.alert_queue is not None:
+                    self._enqueue_alert(transaction_data, result)
+                
+                self.logger.info("Hoàn thành xử lý giao dịch")
+                self._count_outcome(result)
+                return result
+                
+            except Exception as e:
+                self.logger.error("Error processing transaction: %s", e)
+                db.rollback()
+                TRANSACTIONS.inc(outcome='error', model_version=self.model_version)
+                return self._process_error_result(e)
+    
+    async def process_transaction_async(self, db: AsyncSession, transaction_data: dict,
+                                        read_db: Optional[AsyncSession] = None) -> dict:
+        """
+        Same pipeline as `process_transaction` for the ASGI API: database work runs on the
+        async driver and the LLM call on the async client, so the event loop is never
+        blocked while the request waits on I/O
+        """
+        with self._timed('total'):
+            try:
+                self.logger.info("Bắt đầu xử lý giao dịch cho user %s", transaction_data['user_id'])
+                self._prepare_transaction(transaction_data)
+                
+                read_db = read_db or db
+                user_profile, features = await read_db.run_sync(self._load_analysis_context, transaction_data)
+                
+                ai_analysis = await self.analyze_with_ai_async(transaction_data, user_profile)
+                self.logger.info("AI analysis completed: score=%s", ai_analysis.get('fraud_score', 0))
+                self.logger.debug("AI analysis: %s", Lazy(ai_analysis))
+                
+                traditional_analysis = await read_db.run_sync(self._run_traditional_analysis, transaction_data, features)
+                
+                analysis_row, result = self._combine_analyses(transaction_data, ai_analysis, traditional_analysis)
+                if not self._queue_analysis(analysis_row):
+                    await db.run_sync(self._save_analysis, analysis_row)
+                if result['is_suspicious'] and self.alert_queue is not None:
+                    await asyncio.to_thread(self._enqueue_alert, transaction_data, result)
+                
+                self.logger.info("Hoàn thành xử lý giao dịch")
+                self._count_outcome(result)
+                return result
+                
+            except Exception as e:
+                self.logger.error("Error processing transaction: %s", e)
+                await db.rollback()
+                TRANSACTIONS.inc(outcome='error', model_version=self.model_version)
+                return self._process_error_result(e)
         
     def datetime_converter(obj):
         if isinstance(obj, datetime):
             return obj.isoformat()
         raise TypeError(f"Object of type {type(obj)} is not JSON serializable")
 
+    def _build_ai_messages(self, transaction_data: Dict, user_profile: Optional[Dict] = None) -> List[Dict]:
+        """Build the chat messages for the LLM fraud analysis of a transaction"""
+        # Prepare transaction data
+        transaction_info = {
+            'amount': transaction_data['amount'],
+            'currency': transaction_data.get('currency', 'VND'),
+            'description': transaction_data.get('description', ''),
+            'category': transaction_data.get('category', 'unknown'),
+            'ip_address': transaction_data['ip_address'],
+            'device_id': transaction_data.get('device_id', 'unknown'),
+            'geolocation': transaction_data.get('geolocation', 'unknown'),
+            'timestamp': transaction_data['timestamp'].isoformat() if isinstance(transaction_data['timestamp'], datetime) else transaction_data['timestamp']
+        }
+        ai_logger.debug("Transaction info prepared: %s", Lazy(transaction_info))
+        
+        # Prepare account info
+        ai_logger.info("Preparing account info...")
+        account_info = {
+            'user_id': transaction_data['user_id'],
+            'profile': {
+                'common_ip_addresses': user_profile['common_ip_addresses'],
+                'common_locations': user_profile['common_locations'],
+                'common_devices': user_profile['common_devices'],
+                'common_categories': user_profile['common_categories'],
+                'avg_transaction_amount': user_profile['avg_transaction_amount'],
+                'typical_transaction_hours': user_profile['typical_transaction_hours'],
+                'features': user_profile.get('features'),
+            }
+        }
+        ai_logger.debug("Account info prepared: %s", Lazy(account_info))
+        
+        # Prepare transaction history
+        ai_logger.info("Preparing transaction history...")
+        history_info = []
+        if user_profile and 'transactions' in user_profile:
+            history_info = user_profile['transactions']
+            ai_logger.info("Found %s historical transactions", len(history_info))
+        else:
+            ai_logger.info("No transaction history found")
+        
+        
+        # Format prompt with actual data
+        prompt = self.FRAUD_DETECTION_PROMPT.format(
+            account_info=dumps_str(account_info),
+            history_info=dumps_str(history_info),
+            transaction_info=dumps_str(transaction_info)
+        )
+        
+        ai_logger.info("Prompt prepared successfully")
+        return [
+            {"role": "system", "content": self.AI_SYSTEM_MESSAGE},
+            {"role": "user", "content": prompt}
+        ]
+    
+    def _parse_ai_response(self, analysis_text: str) -> Dict:
+        """Parse and validate the LLM's JSON answer into the analysis result format"""
+        ai_logger.debug("Raw AI Analysis text: %s", analysis_text)
+        
+        # Clean the response text
+        analysis_text = analysis_text.strip()
+        if not analysis_text.startswith('{'):
+            # Try to find the first occurrence of a JSON object
+            import re
+            json_match = re.search(r'\{.*\}', analysis_text, re.DOTALL)
+            if json_match:
+                analysis_text = json_match.group(0)
+            else:
+                raise ValueError("No valid JSON found in the response")
+        
+        # Parse the JSON
+        try:
+            analysis_result = loads(analysis_text)
+        except json.JSONDecodeError as e:
+            ai_logger.error("JSON parsing error: %s", e)
+            ai_logger.error("Problematic text: %s", analysis_text)
+            raise
+        
+        ai_logger.debug("Parsed analysis result: %s", Lazy(analysis_result))
+        
+        # Validate required fields
+        required_fields = ['fraud_score', 'fraud_decision', 'fraud_reason', 'fraud_details']
+        for field in required_fields:
+            if field not in analysis_result:
+                raise ValueError(f"Missing required field: {field}")
+        
+        # Check data consistency
+        avg_score = sum(item.get('fraud_score', 0) for item in analysis_result.get('fraud_details', [])) / len(analysis_result.get('fraud_details', [])) if analysis_result.get('fraud_details') else 0
+        if abs(avg_score - analysis_result.get('fraud_score', 0)) > 0.01:  # Allow small rounding errors
+            ai_logger.warning("Fraud score mismatch: calculated=%s, provided=%s", avg_score, analysis_result.get('fraud_score', 0))
+            analysis_result['fraud_score'] = avg_score
+        
+        # Check for duplicate types
+        check_types = [item.get('type') for item in analysis_result.get('fraud_details', [])]
+        if len(check_types) != len(set(check_types)):
+            ai_logger.warning("Duplicate check types found in fraud_details")
+        
+        return {
+            'fraud_score': analysis_result.get('fraud_score', 0),
+            'is_suspicious': analysis_result.get('fraud_decision', False),
+            'analysis_details': analysis_result.get('fraud_details', []),
+            'reasons': [analysis_result.get('fraud_reason', '')] + [detail.get('message', '') for detail in analysis_result.get('fraud_details', []) if detail.get('message')],
+            'suggestions': analysis_result.get('fraud_suggestions', ''),
+            'alert': {
+                'is_alert': analysis_result.get('fraud_alert', False),
+                'message': analysis_result.get('fraud_alert_message', ''),
+                'details': analysis_result.get('fraud_alert_details', ''),
+                'suggestions': analysis_result.get('fraud_alert_suggestions', '')
+            }
+        }
+    
+    @staticmethod
+    def _ai_error_result(e: Exception) -> Dict:
+        ai_logger.error("Error in AI analysis: %s", e)
+        ai_logger.error("Error type: %s", type(e).__name__)
+        ai_logger.error("Error details: %s", e)
+        if hasattr(e, 'response'):
+            ai_logger.error("API Response: %s", e.response)
+        return {
+            'fraud_score': 0,
+            'is_suspicious': False,
+            'analysis_details': [],
+            'reasons': [f'Error in AI analysis: {str(e)}'],
+            'suggestions': '',
+            'alert': {
+                'is_alert': False,
+                'message': '',
+                'details': '',
+                'suggestions': ''
+            }
+        }
+    
     def analyze_with_ai(self, transaction_data: Dict, user_profile: Optional[Dict] = None) -> Dict:
         """
         Analyze transaction using OpenAI API
@@ -923,155 +1183,77 @@ class FraudDetectionSystem:
             - reasons: List[str] containing reasons for the decision
         """
         try:
-            logging.info("Starting AI analysis...")
-            logging.info(f"OpenAI Configuration - Base URL: {os.getenv('OPENAI_BASE_URL')}, Model: {os.getenv('OPENAI_MODEL')}")
+            ai_logger.info("Starting AI analysis...")
+            ai_logger.debug("OpenAI Configuration - Base URL: %s, Model: %s", os.getenv('OPENAI_BASE_URL'), os.getenv('OPENAI_MODEL'))
             
             client = OpenAI(
                 api_key=os.getenv('OPENAI_API_KEY'),
                 base_url=os.getenv('OPENAI_BASE_URL')
             )
-            logging.info("OpenAI client initialized successfully")
-            
-            # Prepare transaction data
-            transaction_info = {
-                'amount': transaction_data['amount'],
-                'currency': transaction_data.get('currency', 'VND'),
-                'description': transaction_data.get('description', ''),
-                'category': transaction_data.get('category', 'unknown'),
-                'ip_address': transaction_data['ip_address'],
-                'device_id': transaction_data.get('device_id', 'unknown'),
-                'geolocation': transaction_data.get('geolocation', 'unknown'),
-                'timestamp': transaction_data['timestamp'].isoformat() if isinstance(transaction_data['timestamp'], datetime) else transaction_data['timestamp']
-            }
-            logging.info(f"Transaction info prepared: {json.dumps(transaction_info, indent=2)}")
-            
-            # Prepare account info
-            logging.info("Preparing account info...")
-            account_info = {
-                'user_id': transaction_data['user_id'],
-                'profile': {
-                    'common_ip_addresses': user_profile['common_ip_addresses'],
-                    'common_locations': user_profile['common_locations'],
-                    'common_devices': user_profile['common_devices'],
-                    'common_categories': user_profile['common_categories'],
-                    'avg_transaction_amount': user_profile['avg_transaction_amount'],
-                    'typical_transaction_hours': user_profile['typical_transaction_hours'],
-                }
-            }
-            logging.info(f"Account info prepared: {json.dumps(account_info, indent=2)}")
-            
-            # Prepare transaction history
-            logging.info("Preparing transaction history...")
-            history_info = []
-            if user_profile and 'transactions' in user_profile:
-                history_info = user_profile['transactions']
-                logging.info(f"Found {len(history_info)} historical transactions")
-            else:
-                logging.info("No transaction history found")
-            
-            
-            # Format prompt with actual data
-            prompt = self.FRAUD_DETECTION_PROMPT.format(
-                account_info=json.dumps(account_info, indent=2),
-                history_info=json.dumps(history_info, indent=2),
-                transaction_info=json.dumps(transaction_info, indent=2)
-            )
-            
-            logging.info("Prompt prepared successfully")
+            ai_logger.info("OpenAI client initialized successfully")
+            with self._timed('ai_prompt_build'):
+                messages = self._build_ai_messages(transaction_data, user_profile)
             
             # Call OpenAI API
-            logging.info("Calling OpenAI API...")
+            ai_logger.info("Calling OpenAI API...")
             try:
-                response = client.chat.completions.create(
-                    model=os.getenv('OPENAI_MODEL', 'gpt-4'),
-                    messages=[
-                        {"role": "system", "content": "You are a financial fraud detection system. Your task is to analyze user financial transactions based on transaction history and the latest transaction to determine if the new transaction is likely fraudulent. You must respond with valid JSON only, no additional text."},
-                        {"role": "user", "content": prompt}
-                    ],
-                    temperature=0.1
-                )
-                logging.info("OpenAI API call successful")
-                logging.info(f"Raw API response: {response}")
+                with self._timed('ai_network'):
+                    response = client.chat.completions.create(
+                        model=os.getenv('OPENAI_MODEL', 'gpt-4'),
+                        messages=messages,
+                        temperature=0.1
+                    )
+                ai_logger.info("OpenAI API call successful")
+                ai_logger.debug("Raw API response: %s", response)
             except Exception as api_error:
-                logging.error(f"OpenAI API call failed: {str(api_error)}")
-                logging.error(f"API Error details: {type(api_error).__name__}")
+                ai_logger.error("OpenAI API call failed: %s", api_error)
+                ai_logger.error("API Error details: %s", type(api_error).__name__)
                 raise api_error
             
-            # Parse results
-            analysis_text = response.choices[0].message.content.strip()
-            logging.info(f"Raw AI Analysis text: {analysis_text}")
+            with self._timed('ai_parse'):
+                return self._parse_ai_response(response.choices[0].message.content.strip())
             
-            # Clean the response text
-            analysis_text = analysis_text.strip()
-            if not analysis_text.startswith('{'):
-                # Try to find the first occurrence of a JSON object
-                import re
-                json_match = re.search(r'\{.*\}', analysis_text, re.DOTALL)
-                if json_match:
-                    analysis_text = json_match.group(0)
-                else:
-                    raise ValueError("No valid JSON found in the response")
+        except Exception as e:
+            return self._ai_error_result(e)
+    
+    async def analyze_with_ai_async(self, transaction_data: Dict, user_profile: Optional[Dict] = None) -> Dict:
+        """
+        Same analysis as `analyze_with_ai` through the async OpenAI client, so the event
+        loop keeps serving other requests while the LLM call is in flight
+        """
+        try:
+            ai_logger.info("Starting AI analysis (async)...")
+            with self._timed('ai_prompt_build'):
+                messages = self._build_ai_messages(transaction_data, user_profile)
             
-            # Parse the JSON
+            ai_logger.info("Calling OpenAI API...")
             try:
-                analysis_result = json.loads(analysis_text)
-            except json.JSONDecodeError as e:
-                logging.error(f"JSON parsing error: {str(e)}")
-                logging.error(f"Problematic text: {analysis_text}")
-                raise
-            
-            logging.info(f"Parsed analysis result: {json.dumps(analysis_result, indent=2)}")
-            
-            # Validate required fields
-            required_fields = ['fraud_score', 'fraud_decision', 'fraud_reason', 'fraud_details']
-            for field in required_fields:
-                if field not in analysis_result:
-                    raise ValueError(f"Missing required field: {field}")
-            
-            # Check data consistency
-            avg_score = sum(item.get('fraud_score', 0) for item in analysis_result.get('fraud_details', [])) / len(analysis_result.get('fraud_details', [])) if analysis_result.get('fraud_details') else 0
-            if abs(avg_score - analysis_result.get('fraud_score', 0)) > 0.01:  # Allow small rounding errors
-                logging.warning(f"Fraud score mismatch: calculated={avg_score}, provided={analysis_result.get('fraud_score', 0)}")
-                analysis_result['fraud_score'] = avg_score
+                with self._timed('ai_network'):
+                    response = await self._get_async_llm_client().chat.completions.create(
+                        model=os.getenv('OPENAI_MODEL', 'gpt-4'),
+                        messages=messages,
+                        temperature=0.1
+                    )
+                ai_logger.info("OpenAI API call successful")
+            except Exception as api_error:
+                ai_logger.error("OpenAI API call failed: %s", api_error)
+                ai_logger.error("API Error details: %s", type(api_error).__name__)
+                raise api_error
             
-            # Check for duplicate types
-            check_types = [item.get('type') for item in analysis_result.get('fraud_details', [])]
-            if len(check_types) != len(set(check_types)):
-                logging.warning("Duplicate check types found in fraud_details")
-            
-            return {
-                'fraud_score': analysis_result.get('fraud_score', 0),
-                'is_suspicious': analysis_result.get('fraud_decision', False),
-                'analysis_details': analysis_result.get('fraud_details', []),
-                'reasons': [analysis_result.get('fraud_reason', '')] + [detail.get('message', '') for detail in analysis_result.get('fraud_details', []) if detail.get('message')],
-                'suggestions': analysis_result.get('fraud_suggestions', ''),
-                'alert': {
-                    'is_alert': analysis_result.get('fraud_alert', False),
-                    'message': analysis_result.get('fraud_alert_message', ''),
-                    'details': analysis_result.get('fraud_alert_details', ''),
-                    'suggestions': analysis_result.get('fraud_alert_suggestions', '')
-                }
-            }
+            with self._timed('ai_parse'):
+                return self._parse_ai_response(response.choices[0].message.content.strip())
             
         except Exception as e:
-            logging.error(f"Error in AI analysis: {str(e)}")
-            logging.error(f"Error type: {type(e).__name__}")
-            logging.error(f"Error details: {str(e)}")
-            if hasattr(e, 'response'):
-                logging.error(f"API Response: {e.response}")
-            return {
-                'fraud_score': 0,
-                'is_suspicious': False,
-                'analysis_details': [],
-                'reasons': [f'Error in AI analysis: {str(e)}'],
-                'suggestions': '',
-                'alert': {
-                    'is_alert': False,
-                    'message': '',
-                    'details': '',
-                    'suggestions': ''
-                }
-            }
+            return self._ai_error_result(e)
+    
+    def _get_async_llm_client(self) -> AsyncOpenAI:
+        """Shared async client: its connection pool is reused by every concurrent request"""
+        if self._async_llm_client is None:
+            self._async_llm_client = AsyncOpenAI(
+                api_key=os.getenv('OPENAI_API_KEY'),
+                base_url=os.getenv('OPENAI_BASE_URL')
+            )
+        return self._async_llm_client
 
 # Ví dụ sử dụng hệ thống
 if __name__ == "__main__":
@@ -3,6 +3,7 @@ import logging
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
 from twilio.rest import Client
+from logging_config import configure_logging
 
 class NotificationService:
     """
@@ -10,12 +11,8 @@ class NotificationService:
     """
     
     def __init__(self):
-        # Thiết lập logging
-        logging.basicConfig(
-            level=logging.INFO,
-            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-            filename='notification.log'
-        )
+        # Thiết lập logging (ghi qua hàng đợi nền, xem logging_config)
+        configure_logging('notification.log')
         self.logger = logging.getLogger('notification_service')
         
         # Khởi tạo tham số cho SendGrid (Email)
@@ -66,6 +63,22 @@ class NotificationService:
             
             subject = f"CẢNH BÁO: Phát hiện giao dịch đáng ngờ #{alert_data['transaction_id']}"
             
+            # Bản tổng hợp: nhiều cảnh báo của cùng người dùng được gộp lại (xem alert_queue.py)
+            digest = alert_data.get('digest')
+            digest_html = ""
+            if digest:
+                subject = f"CẢNH BÁO: {digest['alert_count']} giao dịch đáng ngờ trên tài khoản của bạn"
+                digest_rows = "\n".join(
+                    f"<li>#{item['transaction_id']} - {item['time']} - {item['amount']:,.0f} VND</li>"
+                    for item in digest['transactions']
+                )
+                digest_html = f"""
+            <h3>Các giao dịch đáng ngờ từ {digest['window_start']} ({digest['alert_count']} giao dịch):</h3>
+            <ul>
+                {digest_rows}
+            </ul>
+            """
+            
             content = f"""
             <h2>Cảnh báo giao dịch đáng ngờ</h2>
             <p>Hệ thống đã phát hiện một giao dịch có dấu hiệu bất thường:</p>
@@ -80,6 +93,7 @@ class NotificationService:
                 <li><strong>Mức độ rủi ro:</strong> {alert_data['risk_score']:.2f} (thang điểm 0-1)</li>
             </ul>
             
+            {digest_html}
             <h3>Lý do cảnh báo:</h3>
             <p>{reasons_text if reasons else "Giao dịch không phù hợp với mẫu hành vi thông thường của bạn."}</p>
             
@@ -143,6 +157,12 @@ class NotificationService:
                 f"Nếu không phải bạn, gọi ngay 1900xxxx hoặc vào ứng dụng để khóa thẻ. "
                 f"Xác nhận: https://yourdomain.com/v/{alert_data['transaction_id']}"
             )
+            if alert_data.get('digest'):
+                message_body = (
+                    f"CẢNH BÁO: {alert_data['digest']['alert_count']} giao dịch đáng ngờ trên tài khoản của bạn, "
+                    f"gần nhất #{alert_data['transaction_id']} số tiền {transaction_details['amount']:,.0f} VND. "
+                    f"Nếu không phải bạn, gọi ngay 1900xxxx hoặc vào ứng dụng để khóa thẻ."
+                )
             
             # Gửi SMS
             message = self.twilio_client.messages.create(
@@ -0,0 +1,689 @@
+"""
+Durable alert dispatch queue.
+
+Scoring a suspicious transaction only appends one job per channel (push, email, SMS)
+to a local SQLite queue file; a pool of dispatcher threads delivers them through the
+notification providers concurrently, so provider latency and outages never reach the
+transaction-scoring path. Each job is retried with exponential backoff and jitter until
+it is delivered or runs out of attempts, and every provider has its own rate limit.
+
+Alerts of one user are coalesced: the first alert of a window is sent right away and
+the following ones within ALERT_COALESCE_WINDOW seconds are merged into a per-user digest
+sent when the window ends. The digest's level (and so its channels) follows the combined
+risk of the merged alerts, and a digest whose combined risk reaches a higher level than
+was already notified goes out at once. During an attack on one account, provider calls
+are capped at a few per window instead of one per transaction per channel.
+
+Jobs survive restarts: a job claimed by a process that died is handed out again when
+its lease expires. Several processes (API workers, or `python alert_queue.py` on its
+own) can share one queue file on a node.
+
+Environment:
+    ALERTS_ENABLED          queue alerts for suspicious transactions (default false)
+    ALERT_QUEUE_PATH        queue file (default data/alert_queue.db)
+    ALERT_CHANNELS          channels alerts are queued for (default push,email,sms)
+    ALERT_PROVIDERS         notification (SendGrid/Twilio via NotificationService) or fake
+    ALERT_DISPATCH_WORKERS  dispatcher threads per process (default 4; 0: run `python alert_queue.py`)
+    ALERT_RATE_LIMITS       per-channel sends per second and process, e.g. "email=10,sms=1:5"
+                            (an optional ":burst" sets the bucket size)
+    ALERT_MAX_ATTEMPTS      deliveries tried before a job is marked failed (default 6)
+    ALERT_BACKOFF_BASE      seconds before the first retry, doubled for each further one (default 2)
+    ALERT_BACKOFF_MAX       longest wait between retries (default 300)
+    ALERT_RETENTION_HOURS   delivered and failed jobs are deleted after this (default 24)
+    ALERT_COALESCE_WINDOW   seconds a user's alerts are merged into one digest (default 300, 0 disables)
+    ALERT_DIGEST_MAX_ITEMS  most recent alerts a digest lists (default 20)
+"""
+import argparse
+import logging
+import os
+import random
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from metrics import ALERT_DELIVERIES, ALERT_DIGESTS, ALERT_SEND_SECONDS, ALERT_SENDS_SUPPRESSED, ALERTS_ENQUEUED
+from serialization import dumps_str, loads
+
+logger = logging.getLogger('fraud_detection.alerts')
+
+DEFAULT_QUEUE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'alert_queue.db')
+
+# Channels of each alert level, as in NotificationService.send_alert
+LEVEL_CHANNELS = {
+    'low': ('push',),
+    'medium': ('push', 'email'),
+    'high': ('push', 'email', 'sms'),
+}
+
+# Minimum risk score (0-1) of each alert level, highest first
+LEVEL_THRESHOLDS = (('high', 0.8), ('medium', 0.5), ('low', 0.0))
+LEVEL_RANK = {'low': 0, 'medium': 1, 'high': 2}
+
+
+def clamp_risk(risk_score: Optional[float]) -> float:
+    """Risk score forced onto the 0-1 scale (a missing score counts as 0)"""
+    return min(1.0, max(0.0, risk_score or 0.0))
+
+
+def alert_level(risk_score: float) -> str:
+    """Alert level of a risk score on the 0-1 scale"""
+    for level, threshold in LEVEL_THRESHOLDS:
+        if risk_score >= threshold:
+            return level
+    return 'low'
+
+
+class ProviderError(Exception):
+    """A delivery failed; `permanent` failures are not retried"""
+
+    def __init__(self, message: str, permanent: bool = False):
+        super().__init__(message)
+        self.permanent = permanent
+
+
+class RateLimiter:
+    """Token bucket: `rate` sends per second with bursts of up to `burst`"""
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self._tokens = self.burst
+        self._refilled = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+            self._refilled = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    def refund(self):
+        """Give back a token that was not used"""
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + 1)
+
+
+def parse_rate_limits(spec: Optional[str]) -> Dict[str, RateLimiter]:
+    """"channel=rate[:burst],..." -> {channel: RateLimiter}"""
+    limits = {}
+    for item in (spec or '').split(','):
+        if '=' not in item:
+            continue
+        channel, value = item.split('=', 1)
+        rate, _, burst = value.partition(':')
+        limits[channel.strip()] = RateLimiter(float(rate), float(burst) if burst else None)
+    return limits
+
+
+class NotificationProvider:
+    """Adapts a NotificationService send method (which returns False on failure) to a provider"""
+
+    def __init__(self, name: str, send: Callable[[str, Dict], bool]):
+        self.name = name
+        self._send = send
+
+    def send(self, recipient: str, alert_data: Dict):
+        if not self._send(recipient, alert_data):
+            raise ProviderError(f"{self.name} delivery to {recipient} failed")
+
+
+class FakeProvider:
+    """Local stand-in for a notification provider with a simulated latency and failure rate"""
+
+    def __init__(self, name: str, latency_ms: float = 0.0, failure_rate: float = 0.0, seed: Optional[int] = None):
+        self.name = name
+        self.latency_ms = latency_ms
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.sent: List[Dict] = []
+        self.failures = 0
+
+    def send(self, recipient: str, alert_data: Dict):
+        time.sleep(self.latency_ms / 1000)
+        with self._lock:
+            if self._random.random() < self.failure_rate:
+                self.failures += 1
+                raise ProviderError(f"{self.name}: simulated failure")
+            self.sent.append({'recipient': recipient, 'transaction_id': alert_data.get('transaction_id')})
+
+
+def providers_from_env() -> Dict[str, object]:
+    """Providers of the channels that are configured (ALERT_PROVIDERS=fake for local fakes)"""
+    if os.getenv('ALERT_PROVIDERS', 'notification').lower() == 'fake':
+        return {channel: FakeProvider(channel) for channel in ('push', 'email', 'sms')}
+
+    from alert import NotificationService
+    service = NotificationService()
+    providers = {'push': NotificationProvider('push', service.send_push_notification)}
+    if service.sendgrid_client is not None:
+        providers['email'] = NotificationProvider('email', service.send_email_alert)
+    if service.twilio_client is not None and service.twilio_phone_number:
+        providers['sms'] = NotificationProvider('sms', service.send_sms_alert)
+    return providers
+
+
+def user_recipients(user_id: str, channel: str, alert_data: Dict) -> Optional[str]:
+    """Address of the user on a channel: email and phone from the users table, the transaction's device for push"""
+    if channel == 'push':
+        return alert_data.get('transaction_details', {}).get('device_id')
+    from database import SessionLocal, User
+    db = SessionLocal()
+    try:
+        user = db.get(User, user_id)
+        if user is None:
+            return None
+        return user.email if channel == 'email' else user.phone if channel == 'sms' else None
+    finally:
+        db.close()
+
+
+def combined_risk(risk_scores: Sequence[float]) -> float:
+    """
+    Risk that at least one of several alerts is fraud, treating them as independent
+    (1 - product of 1 - risk): many medium-risk alerts add up to a high one.
+    """
+    survival = 1.0
+    for risk in risk_scores:
+        survival *= 1.0 - clamp_risk(risk)
+    return 1.0 - survival
+
+
+def digest_alert(alerts: List[Dict], alert_count: int, risk: float, window_started: float) -> Dict:
+    """Payload of a digest: the latest alert's transaction, the merged reasons and the list of alerts"""
+    reasons = []
+    for alert in alerts:
+        for reason in alert.get('reasons', []):
+            if reason not in reasons:
+                reasons.append(reason)
+    return dict(alerts[-1], risk_score=risk, reasons=reasons[:10], digest={
+        'alert_count': alert_count,
+        'max_risk': max(alert.get('risk_score', 0.0) for alert in alerts),
+        'window_start': datetime.fromtimestamp(window_started).isoformat(timespec='seconds'),
+        'transactions': [{
+            'transaction_id': alert.get('transaction_id'),
+            'risk_score': alert.get('risk_score'),
+            'amount': alert.get('transaction_details', {}).get('amount'),
+            'time': alert.get('transaction_details', {}).get('time'),
+        } for alert in alerts],
+    })
+
+
+class AlertJob(NamedTuple):
+    id: int
+    user_id: str
+    channel: str
+    alert_level: str
+    alert_data: Dict
+    attempts: int
+
+
+class AlertQueue:
+    """
+    Alert jobs in a local SQLite file (WAL, so enqueueing never waits for a dispatcher
+    reading). A job is claimed by setting a lease; it is delivered, rescheduled for a
+    retry, or marked failed or skipped when its claimant is done with it.
+
+    With a `coalesce_window`, `submit` merges a user's alerts into an open digest row
+    (alert_digests) instead of queueing jobs for each; `flush_digests` turns digests
+    whose window has ended into jobs.
+    """
+
+    def __init__(self, path: str = DEFAULT_QUEUE_PATH, busy_timeout_ms: int = 5000,
+                 coalesce_window: float = 0.0, digest_max_items: int = 20):
+        self.path = path
+        self.busy_timeout_ms = busy_timeout_ms
+        self.coalesce_window = coalesce_window
+        self.digest_max_items = digest_max_items
+        self._local = threading.local()
+        # Wakes dispatchers of this process as soon as a job is queued
+        self.wakeup = threading.Event()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = self._connection()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS alert_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                channel TEXT NOT NULL,
+                alert_level TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                lease_until REAL,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_alert_jobs_claim ON alert_jobs (channel, status, next_attempt_at)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_alert_jobs_status_updated ON alert_jobs (status, updated_at)')
+        # One open coalescing window per user; `survival` is the product of (1 - risk) of its alerts
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS alert_digests (
+                user_id TEXT PRIMARY KEY,
+                window_started REAL NOT NULL,
+                flush_at REAL NOT NULL,
+                alert_count INTEGER NOT NULL,
+                pending INTEGER NOT NULL,
+                survival REAL NOT NULL,
+                notified_level TEXT NOT NULL,
+                alerts TEXT NOT NULL
+            )
+        """)
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_alert_digests_flush ON alert_digests (flush_at)')
+
+    @classmethod
+    def from_env(cls, path: Optional[str] = None) -> Optional['AlertQueue']:
+        """Queue configured from the environment, or None unless ALERTS_ENABLED is set (or a path is given)"""
+        if path is None and os.getenv('ALERTS_ENABLED', 'false').lower() not in ('1', 'true', 'yes'):
+            return None
+        return cls(
+            path or os.getenv('ALERT_QUEUE_PATH', DEFAULT_QUEUE_PATH),
+            coalesce_window=float(os.getenv('ALERT_COALESCE_WINDOW', 300)),
+            digest_max_items=int(os.getenv('ALERT_DIGEST_MAX_ITEMS', 20)),
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'PRAGMA busy_timeout={self.busy_timeout_ms}')
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _insert_jobs(conn: sqlite3.Connection, user_id: str, alert_data: Dict, level: str,
+                     channels: Sequence[str], now: float):
+        payload = dumps_str(alert_data)
+        conn.executemany(
+            'INSERT INTO alert_jobs (user_id, channel, alert_level, payload, next_attempt_at, created_at, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [(user_id, channel, level, payload, now, now, now) for channel in channels]
+        )
+
+    def _queued(self, channels: Sequence[str]):
+        for channel in channels:
+            ALERTS_ENQUEUED.inc(channel=channel)
+        if channels:
+            self.wakeup.set()
+
+    def enqueue(self, user_id: str, alert_data: Dict, level: str, channels: Sequence[str]) -> int:
+        """Queue one delivery job per channel in a single transaction, bypassing coalescing; returns the number of jobs"""
+        if not channels:
+            return 0
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            self._insert_jobs(conn, user_id, alert_data, level, channels, time.time())
+        self._queued(channels)
+        return len(channels)
+
+    def submit(self, user_id: str, alert_data: Dict, channels: Sequence[str]) -> Tuple[str, int]:
+        """
+        Queue an alert on the channels of its level (restricted to `channels`), or merge it
+        into the user's open digest. Returns the level and the number of jobs queued now.
+        """
+        # Out-of-range scores would push the digest's survival product below 0 or above 1
+        risk = clamp_risk(alert_data.get('risk_score'))
+        level = alert_level(risk)
+        allowed = [channel for channel in LEVEL_CHANNELS[level] if channel in channels]
+        if self.coalesce_window <= 0:
+            return level, self.enqueue(user_id, alert_data, level, allowed)
+
+        now = time.time()
+        queued: List[str] = []
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                'SELECT window_started, alert_count, pending, survival, notified_level, alerts '
+                'FROM alert_digests WHERE user_id = ?', (user_id,)
+            ).fetchone()
+            if row is None:
+                # First alert of a window: send it now, merge what follows
+                conn.execute(
+                    'INSERT INTO alert_digests (user_id, window_started, flush_at, alert_count, pending, survival, '
+                    'notified_level, alerts) VALUES (?, ?, ?, 1, 0, ?, ?, ?)',
+                    (user_id, now, now + self.coalesce_window, 1.0 - risk, level, dumps_str([alert_data]))
+                )
+                self._insert_jobs(conn, user_id, alert_data, level, allowed, now)
+                queued = allowed
+            else:
+                window_started, alert_count, pending, survival, notified_level, alerts = row
+                alerts = (loads(alerts) + [alert_data])[-self.digest_max_items:]
+                alert_count, survival = alert_count + 1, survival * (1.0 - risk)
+                combined = combined_risk([1.0 - survival])
+                level = alert_level(combined)
+                if LEVEL_RANK[level] > LEVEL_RANK[notified_level]:
+                    # The combined risk reached a higher level than notified: escalate now
+                    queued = [channel for channel in LEVEL_CHANNELS[level] if channel in channels]
+                    self._insert_jobs(conn, user_id, digest_alert(alerts, alert_count, combined, window_started),
+                                      level, queued, now)
+                    notified_level, pending = level, 0
+                    ALERT_DIGESTS.inc(trigger='escalation')
+                else:
+                    pending += 1
+                    for channel in allowed:
+                        ALERT_SENDS_SUPPRESSED.inc(channel=channel)
+                conn.execute(
+                    'UPDATE alert_digests SET alert_count = ?, pending = ?, survival = ?, notified_level = ?, alerts = ? '
+                    'WHERE user_id = ?',
+                    (alert_count, pending, survival, notified_level, dumps_str(alerts), user_id)
+                )
+        self._queued(queued)
+        return level, len(queued)
+
+    def flush_digests(self, channels: Sequence[str] = ('push', 'email', 'sms')) -> int:
+        """
+        Queue the digests whose window has ended and that hold merged alerts, then start a
+        new window for them; windows that ended without merged alerts are closed. Returns
+        the number of digests queued.
+        """
+        conn = self._connection()
+        now = time.time()
+        due = [user_id for (user_id,) in conn.execute('SELECT user_id FROM alert_digests WHERE flush_at <= ?', (now,))]
+        flushed = 0
+        for user_id in due:
+            queued: List[str] = []
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                row = conn.execute(
+                    'SELECT window_started, flush_at, alert_count, pending, survival, notified_level, alerts '
+                    'FROM alert_digests WHERE user_id = ?', (user_id,)
+                ).fetchone()
+                if row is None or row[1] > now:
+                    continue  # flushed by another process meanwhile
+                window_started, _, alert_count, pending, survival, notified_level, alerts = row
+                if not pending:
+                    conn.execute('DELETE FROM alert_digests WHERE user_id = ?', (user_id,))
+                    continue
+                combined = combined_risk([1.0 - survival])
+                level = alert_level(combined)
+                queued = [channel for channel in LEVEL_CHANNELS[level] if channel in channels]
+                self._insert_jobs(conn, user_id, digest_alert(loads(alerts), alert_count, combined, window_started),
+                                  level, queued, now)
+                # The attack may go on: keep coalescing, starting from the level just notified
+                conn.execute(
+                    "UPDATE alert_digests SET window_started = ?, flush_at = ?, alert_count = 0, pending = 0, "
+                    "survival = 1.0, notified_level = ?, alerts = '[]' WHERE user_id = ?",
+                    (now, now + self.coalesce_window, level, user_id)
+                )
+            ALERT_DIGESTS.inc(trigger='window')
+            self._queued(queued)
+            flushed += 1
+        return flushed
+
+    def claim(self, channel: str, lease: float) -> Optional[AlertJob]:
+        """Take the oldest due job of a channel for `lease` seconds, or None if there is none"""
+        conn = self._connection()
+        now = time.time()
+        due = 'SELECT id FROM alert_jobs WHERE channel = ? AND status = ? AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT 1'
+        # Look before taking the write lock: idle dispatchers must not serialize enqueues
+        if conn.execute(due, (channel, 'pending', now)).fetchone() is None:
+            return None
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(due, (channel, 'pending', now)).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE alert_jobs SET status = 'sending', attempts = attempts + 1, lease_until = ?, updated_at = ? WHERE id = ?",
+                (now + lease, now, row[0])
+            )
+            job = conn.execute(
+                'SELECT id, user_id, channel, alert_level, payload, attempts FROM alert_jobs WHERE id = ?', (row[0],)
+            ).fetchone()
+        return AlertJob(job[0], job[1], job[2], job[3], loads(job[4]), job[5])
+
+    def _finish(self, job_id: int, status: str, error: Optional[str] = None, next_attempt_at: Optional[float] = None):
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                'UPDATE alert_jobs SET status = ?, last_error = ?, lease_until = NULL, updated_at = ?, '
+                'next_attempt_at = COALESCE(?, next_attempt_at) WHERE id = ?',
+                (status, error, now, next_attempt_at, job_id)
+            )
+
+    def complete(self, job_id: int):
+        self._finish(job_id, 'sent')
+
+    def retry(self, job_id: int, error: str, delay: float):
+        self._finish(job_id, 'pending', error, time.time() + delay)
+
+    def fail(self, job_id: int, error: str):
+        self._finish(job_id, 'failed', error)
+
+    def skip(self, job_id: int, reason: str):
+        self._finish(job_id, 'skipped', reason)
+
+    def requeue_expired(self) -> int:
+        """Hand out again the jobs whose claimant died before finishing them"""
+        conn = self._connection()
+        with conn:
+            return conn.execute(
+                "UPDATE alert_jobs SET status = 'pending', lease_until = NULL WHERE status = 'sending' AND lease_until < ?",
+                (time.time(),)
+            ).rowcount
+
+    def prune(self, older_than: float) -> int:
+        """Delete finished jobs last updated more than `older_than` seconds ago"""
+        conn = self._connection()
+        with conn:
+            return conn.execute(
+                "DELETE FROM alert_jobs WHERE status IN ('sent', 'failed', 'skipped') AND updated_at < ?",
+                (time.time() - older_than,)
+            ).rowcount
+
+    def open_digests(self) -> Dict[str, int]:
+        """Users with an open coalescing window and the alerts waiting in their digests"""
+        users, pending = self._connection().execute(
+            'SELECT COUNT(*), COALESCE(SUM(pending), 0) FROM alert_digests'
+        ).fetchone()
+        return {'users': users, 'pending_alerts': pending}
+
+    def counts(self) -> Dict[str, Dict[str, int]]:
+        """Number of jobs by channel and status"""
+        counts: Dict[str, Dict[str, int]] = {}
+        for channel, status, count in self._connection().execute(
+            'SELECT channel, status, COUNT(*) FROM alert_jobs GROUP BY channel, status'
+        ):
+            counts.setdefault(channel, {})[status] = count
+        return counts
+
+
+class AlertDispatcher:
+    """
+    Worker threads that deliver queued alert jobs. Each worker cycles through the channels
+    it has a provider for, claiming a job of a channel only when that channel's rate
+    limiter has a token, so a throttled provider never ties up the workers.
+    """
+
+    def __init__(self, alert_queue: AlertQueue, providers: Dict[str, object],
+                 recipients: Callable[[str, str, Dict], Optional[str]] = user_recipients,
+                 workers: int = 4, rate_limits: Optional[Dict[str, RateLimiter]] = None,
+                 max_attempts: int = 6, backoff_base: float = 2.0, backoff_max: float = 300.0,
+                 lease: float = 60.0, poll_interval: float = 0.5, retention: float = 24 * 3600):
+        self.queue = alert_queue
+        self.providers = providers
+        self.recipients = recipients
+        self.workers = workers
+        self.rate_limits = rate_limits or {}
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._random = random.Random()
+
+    @classmethod
+    def from_env(cls, alert_queue: AlertQueue, providers: Optional[Dict[str, object]] = None) -> 'AlertDispatcher':
+        return cls(
+            alert_queue,
+            providers if providers is not None else providers_from_env(),
+            workers=int(os.getenv('ALERT_DISPATCH_WORKERS', 4)),
+            rate_limits=parse_rate_limits(os.getenv('ALERT_RATE_LIMITS')),
+            max_attempts=int(os.getenv('ALERT_MAX_ATTEMPTS', 6)),
+            backoff_base=float(os.getenv('ALERT_BACKOFF_BASE', 2)),
+            backoff_max=float(os.getenv('ALERT_BACKOFF_MAX', 300)),
+            retention=float(os.getenv('ALERT_RETENTION_HOURS', 24)) * 3600,
+        )
+
+    def backoff(self, attempts: int) -> float:
+        """Delay before retry number `attempts`: doubling from backoff_base up to backoff_max, jittered down by up to half"""
+        delay = min(self.backoff_max, self.backoff_base * (2 ** (attempts - 1)))
+        return delay * (0.5 + self._random.random() / 2)
+
+    def start(self) -> 'AlertDispatcher':
+        channels = sorted(self.providers)
+        for i in range(self.workers):
+            # Each worker starts its rotation at a different channel
+            order = channels[i % len(channels):] + channels[:i % len(channels)] if channels else []
+            thread = threading.Thread(target=self._run, args=(order, i == 0), name=f'alert-dispatch-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info("Alert dispatcher started: %s workers, channels %s", self.workers, ', '.join(channels))
+        return self
+
+    def stop(self, timeout: Optional[float] = 10.0):
+        self._stop.set()
+        self.queue.wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _run(self, channels: List[str], maintenance: bool):
+        next_maintenance = next_flush = 0.0
+        while not self._stop.is_set():
+            if maintenance and time.monotonic() >= next_maintenance:
+                self._maintain()
+                next_maintenance = time.monotonic() + 30
+            if maintenance and self.queue.coalesce_window > 0 and time.monotonic() >= next_flush:
+                try:
+                    self.queue.flush_digests()
+                except Exception as e:
+                    logger.error("Alert digest flush failed: %s", e)
+                next_flush = time.monotonic() + min(1.0, self.queue.coalesce_window / 10)
+            worked = False
+            for channel in channels:
+                try:
+                    worked |= self.run_once(channel)
+                except Exception as e:
+                    logger.error("Alert dispatch on %s failed: %s", channel, e)
+            if not worked:
+                self.queue.wakeup.wait(self.poll_interval)
+                self.queue.wakeup.clear()
+
+    def _maintain(self):
+        try:
+            requeued = self.queue.requeue_expired()
+            if requeued:
+                logger.warning("Requeued %s alert jobs whose lease expired", requeued)
+            self.queue.prune(self.retention)
+        except Exception as e:
+            logger.error("Alert queue maintenance failed: %s", e)
+
+    def run_once(self, channel: str) -> bool:
+        """Claim and deliver one job of `channel` if one is due and the rate limit allows; whether one was"""
+        limiter = self.rate_limits.get(channel)
+        if limiter is not None and not limiter.try_acquire():
+            return False
+        job = self.queue.claim(channel, self.lease)
+        if job is None:
+            if limiter is not None:
+                limiter.refund()
+            return False
+        self._deliver(job)
+        return True
+
+    def _deliver(self, job: AlertJob):
+        recipient = self.recipients(job.user_id, job.channel, job.alert_data)
+        if not recipient:
+            self.queue.skip(job.id, 'no recipient')
+            ALERT_DELIVERIES.inc(channel=job.channel, outcome='skipped')
+            return
+        try:
+            with ALERT_SEND_SECONDS.time(channel=job.channel):
+                self.providers[job.channel].send(recipient, job.alert_data)
+        except Exception as e:
+            permanent = isinstance(e, ProviderError) and e.permanent
+            if permanent or job.attempts >= self.max_attempts:
+                self.queue.fail(job.id, str(e))
+                ALERT_DELIVERIES.inc(channel=job.channel, outcome='failed')
+                logger.error("Alert %s for transaction %s via %s failed after %s attempts: %s",
+                             job.id, job.alert_data.get('transaction_id'), job.channel, job.attempts, e)
+            else:
+                delay = self.backoff(job.attempts)
+                self.queue.retry(job.id, str(e), delay)
+                ALERT_DELIVERIES.inc(channel=job.channel, outcome='retried')
+                logger.warning("Alert %s via %s failed (attempt %s), retrying in %.1fs: %s",
+                               job.id, job.channel, job.attempts, delay, e)
+            return
+        self.queue.complete(job.id)
+        ALERT_DELIVERIES.inc(channel=job.channel, outcome='sent')
+
+
+def build_alert_data(transaction_data: Dict, result: Dict) -> Dict:
+    """Alert payload of a scored transaction, in the format NotificationService expects"""
+    timestamp = transaction_data.get('timestamp') or datetime.now()
+    return {
+        'user_id': transaction_data['user_id'],
+        'transaction_id': transaction_data.get('transaction_id', ''),
+        'risk_score': result['fraud_score'] / 100,  # 0-1 scale
+        'reasons': result['reasons'],
+        'transaction_details': {
+            'amount': transaction_data.get('amount', 0),
+            'currency': transaction_data.get('currency', 'VND'),
+            'description': transaction_data.get('description', ''),
+            'category': transaction_data.get('category', ''),
+            'location': transaction_data.get('geolocation', ''),
+            'device_id': transaction_data.get('device_id'),
+            'time': timestamp.isoformat() if isinstance(timestamp, datetime) else str(timestamp),
+        },
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Run alert dispatcher workers against the local alert queue')
+    parser.add_argument('--path', default=os.getenv('ALERT_QUEUE_PATH', DEFAULT_QUEUE_PATH))
+    parser.add_argument('--status', action='store_true', help='Print the number of jobs by channel and status and exit')
+    args = parser.parse_args(argv)
+
+    from logging_config import configure_logging
+    configure_logging('notification.log')
+    alert_queue = AlertQueue.from_env(args.path)
+    if args.status:
+        for channel, statuses in sorted(alert_queue.counts().items()):
+            print(f"{channel:6s} " + ', '.join(f"{status}={count}" for status, count in sorted(statuses.items())))
+        digests = alert_queue.open_digests()
+        print(f"open digests: {digests['users']} users, {digests['pending_alerts']} alerts waiting")
+        return 0
+
+    dispatcher = AlertDispatcher.from_env(alert_queue)
+    dispatcher.workers = max(1, dispatcher.workers)
+    dispatcher.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        dispatcher.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,92 @@
+import base64
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import and_, or_, select
+from sqlalchemy.orm import Session
+
+from database import Alert
+
+ALERT_STATUSES = ('new', 'reviewed', 'resolved', 'false_positive')
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def build_alert_row(alert_data: Dict, timestamp: Optional[datetime] = None) -> Dict:
+    """Alert column values of an alert payload (see alert_queue.build_alert_data)"""
+    return {
+        'user_id': alert_data['user_id'],
+        'transaction_id': alert_data['transaction_id'],
+        'timestamp': timestamp or datetime.now(),
+        'risk_score': alert_data['risk_score'],
+        'reasons': alert_data['reasons'],
+        'transaction_details': alert_data['transaction_details'],
+        'status': 'new',
+    }
+
+
+def encode_cursor(timestamp: datetime, alert_id: int) -> str:
+    """Opaque page cursor: the (timestamp, alert_id) of the last alert returned"""
+    return base64.urlsafe_b64encode(f"{timestamp.isoformat()}|{alert_id}".encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """Inverse of `encode_cursor`; raises ValueError on a malformed cursor"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        timestamp, alert_id = raw.split('|')
+        return datetime.fromisoformat(timestamp), int(alert_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+def alerts_query(user_id: Optional[str] = None, status: Optional[str] = None, limit: int = DEFAULT_PAGE_SIZE,
+                 cursor: Optional[str] = None):
+    """
+    SELECT of one page of alerts, newest first, optionally for one user and/or one status.
+
+    Pages are keyset-paginated on (timestamp, alert_id): the next page starts strictly
+    after the cursor, so each page is a range read on idx_alerts_user_timestamp,
+    idx_alerts_status_timestamp or idx_alerts_timestamp whatever the page depth, and
+    alerts inserted while a client pages through never shift or repeat rows. The
+    statement asks for one row more than `limit` to tell whether there is a next page.
+    Raises ValueError on an unknown status or a malformed cursor.
+    """
+    if status is not None and status not in ALERT_STATUSES:
+        raise ValueError(f"Unknown alert status: {status}")
+
+    query = select(Alert)
+    if user_id is not None:
+        query = query.where(Alert.user_id == user_id)
+    if status is not None:
+        query = query.where(Alert.status == status)
+    if cursor:
+        timestamp, alert_id = decode_cursor(cursor)
+        # Written as a range on timestamp plus a tie-break, which every backend turns into an index range scan
+        query = query.where(Alert.timestamp <= timestamp, or_(
+            Alert.timestamp < timestamp, and_(Alert.timestamp == timestamp, Alert.alert_id < alert_id)
+        ))
+    return query.order_by(Alert.timestamp.desc(), Alert.alert_id.desc()).limit(limit + 1)
+
+
+def query_alerts(db: Session, user_id: Optional[str] = None, status: Optional[str] = None,
+                 limit: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None) -> Dict:
+    """One page of alerts (see `alerts_query`) and the cursor of the next page, None on the last one"""
+    limit = min(max(limit, 1), MAX_PAGE_SIZE)
+    alerts = db.execute(alerts_query(user_id, status, limit, cursor)).scalars().all()
+
+    page = alerts[:limit]
+    return {
+        'alerts': [{
+            'alert_id': a.alert_id,
+            'user_id': a.user_id,
+            'timestamp': a.timestamp.isoformat(),
+            'risk_score': a.risk_score,
+            'reasons': a.reasons,
+            'transaction_id': a.transaction_id,
+            'transaction_details': a.transaction_details,
+            'status': a.status
+        } for a in page],
+        'next_cursor': encode_cursor(page[-1].timestamp, page[-1].alert_id) if len(alerts) > limit else None,
+    }
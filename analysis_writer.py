@@ -0,0 +1,320 @@
+import atexit
+import glob
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import insert
+
+from serialization import dumps_str, loads
+from database import Alert, SessionLocal, begin_write, TransactionAnalysis, TransactionAnalysisPayload, split_analysis_row
+from feature_store import ensure_users
+from metrics import ANALYSIS_WRITER_FLUSH_SECONDS, ANALYSIS_WRITER_QUEUE_DEPTH, ANALYSIS_WRITER_ROWS
+from rollups import record_analysis_counts
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger('fraud_detection.analysis_writer')
+
+DEFAULT_JOURNAL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'analysis_journal')
+
+# Rows that could not be written even one by one, in the journal format. Not matched by
+# the journal glob: rename it to analysis.<n>.jsonl to have the next start replay it.
+DEAD_LETTER_FILE = 'dead_letter.jsonl'
+
+_STOP = object()
+
+
+def _encode_row(row: Dict) -> str:
+    return dumps_str(row)
+
+
+def _decode_row(line: str) -> Dict:
+    row = loads(line)
+    for values in (row, row.get('alert') or {}):
+        if isinstance(values.get('timestamp'), str):
+            values['timestamp'] = datetime.fromisoformat(values['timestamp'])
+    return row
+
+
+class AnalysisWriter:
+    """
+    Write-behind queue that persists TransactionAnalysis rows (and the Alert rows of
+    suspicious ones) in groups.
+
+    Request threads `submit` a row and return immediately; a background thread drains
+    the queue and writes everything that arrived within `max_wait` seconds (or up to
+    `max_batch` rows) as one multi-row INSERT and one commit, so many requests share a
+    single fsync on the database side.
+
+    The queue is bounded: when it is full `submit` returns False and the caller writes
+    synchronously instead, so backpressure never drops rows. When a journal directory
+    is set, every accepted row is appended to a per-process journal first; journals
+    left behind by processes that died before flushing are replayed on startup, and
+    rows the database refuses are appended to a dead-letter file instead of being
+    dropped. Queue depth, row outcomes and batch latency are exported in metrics.py.
+    """
+
+    def __init__(self, session_factory=SessionLocal, max_batch: int = 200, max_wait: float = 0.05,
+                 max_queue: int = 10000, journal_dir: Optional[str] = DEFAULT_JOURNAL_DIR):
+        self.session_factory = session_factory
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._journal = None
+        self._journal_dir = journal_dir
+        self._journal_path = None
+        self._closed = False
+
+        if journal_dir:
+            os.makedirs(journal_dir, exist_ok=True)
+            self._replay_orphaned_journals(journal_dir)
+            self._journal_path = os.path.join(journal_dir, f"analysis.{os.getpid()}.jsonl")
+            self._journal = self._create_journal(self._journal_path)
+
+        ANALYSIS_WRITER_QUEUE_DEPTH.set_function(self._queue.qsize)
+
+        self._thread = threading.Thread(target=self._run, name='analysis-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    @classmethod
+    def from_env(cls) -> Optional['AnalysisWriter']:
+        """Writer configured from the environment, or None unless ANALYSIS_WRITE_BEHIND is enabled"""
+        if os.getenv('ANALYSIS_WRITE_BEHIND', 'false').lower() not in ('1', 'true', 'yes'):
+            return None
+        journal_dir = os.getenv('ANALYSIS_JOURNAL_DIR', DEFAULT_JOURNAL_DIR)
+        return cls(
+            max_batch=int(os.getenv('ANALYSIS_BATCH_SIZE', 200)),
+            max_wait=float(os.getenv('ANALYSIS_BATCH_WAIT_MS', 50)) / 1000,
+            max_queue=int(os.getenv('ANALYSIS_QUEUE_SIZE', 10000)),
+            journal_dir=journal_dir if journal_dir.lower() != 'none' else None
+        )
+
+    def submit(self, row: Dict) -> bool:
+        """
+        Queue a row (a dict of TransactionAnalysis column values) for writing.
+
+        Returns False if the writer is closed or the queue is full; the row has then
+        not been accepted and the caller must persist it itself.
+        """
+        with self._lock:
+            if self._closed:
+                return False
+            try:
+                self._queue.put_nowait(row)
+            except queue.Full:
+                ANALYSIS_WRITER_ROWS.inc(outcome='rejected')
+                return False
+            if self._journal is not None:
+                self._journal.write(_encode_row(row) + '\n')
+                self._journal.flush()
+            ANALYSIS_WRITER_ROWS.inc(outcome='submitted')
+            return True
+
+    def flush(self, timeout: Optional[float] = 5.0) -> bool:
+        """Block until every row submitted before this call has been written"""
+        marker = threading.Event()
+        try:
+            self._queue.put(marker, timeout=timeout)
+        except queue.Full:
+            return False
+        return marker.wait(timeout)
+
+    def close(self, timeout: Optional[float] = 10.0):
+        """Flush the queue and stop the writer thread"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        if self._journal is not None:
+            # Removed while still locked, so no other process replays it in between
+            if self._queue.empty():
+                os.remove(self._journal_path)
+            self._journal.close()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            batch: List[Dict] = []
+            markers = []
+            stop = False
+            deadline = time.monotonic() + self.max_wait
+            while True:
+                if item is _STOP:
+                    stop = True
+                elif isinstance(item, threading.Event):
+                    markers.append(item)
+                else:
+                    batch.append(item)
+                if stop or len(batch) >= self.max_batch:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 and not markers:
+                    break
+                try:
+                    # A pending flush() drains whatever is already queued without waiting any longer
+                    item = self._queue.get(timeout=max(remaining, 0)) if not markers else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            if batch:
+                self._write(batch)
+            for marker in markers:
+                marker.set()
+            if stop:
+                # Drain anything submitted concurrently with close()
+                leftover = []
+                while True:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if isinstance(item, threading.Event):
+                        item.set()
+                    elif item is not _STOP:
+                        leftover.append(item)
+                if leftover:
+                    self._write(leftover)
+                return
+
+    def _write(self, rows: List[Dict]):
+        with ANALYSIS_WRITER_FLUSH_SECONDS.time():
+            written = self._insert(rows)
+        ANALYSIS_WRITER_ROWS.inc(written, outcome='written')
+
+        with self._lock:
+            # Every accepted row has been written or dead-lettered: the journal can start over
+            if self._journal is not None and self._queue.empty():
+                self._journal.truncate(0)
+                self._journal.seek(0)
+
+    @staticmethod
+    def _execute_insert(db, rows: List[Dict]):
+        begin_write(db)
+        hot_rows, payload_rows, alert_rows = [], [], []
+        for row in rows:
+            hot_row, payload_row = split_analysis_row(row)
+            hot_rows.append(hot_row)
+            if payload_row is not None:
+                payload_rows.append(payload_row)
+            if row.get('alert'):
+                alert_rows.append(row['alert'])
+        # Analyses reference users: create the users seen for the first time
+        new_users = ensure_users(db, sorted({row['user_id'] for row in hot_rows if row.get('user_id')}))
+        db.execute(insert(TransactionAnalysis), hot_rows)
+        if payload_rows:
+            db.execute(insert(TransactionAnalysisPayload), payload_rows)
+        if alert_rows:
+            db.execute(insert(Alert), alert_rows)
+        record_analysis_counts(db, rows, new_users=new_users)
+
+    def _insert(self, rows: List[Dict]) -> int:
+        """
+        Insert rows in one statement per table, falling back to row by row to isolate a bad
+        row. Rows that still fail go to the dead-letter file. Returns the rows written.
+        """
+        db = self.session_factory()
+        try:
+            self._execute_insert(db, rows)
+            db.commit()
+            return len(rows)
+        except Exception as e:
+            db.rollback()
+            logger.warning(f"Ghi nhóm {len(rows)} bản ghi phân tích thất bại, thử ghi từng bản ghi: {str(e)}")
+        finally:
+            db.close()
+
+        written = 0
+        failed = []
+        for row in rows:
+            db = self.session_factory()
+            try:
+                self._execute_insert(db, [row])
+                db.commit()
+                written += 1
+            except Exception as e:
+                db.rollback()
+                failed.append(row)
+                logger.error(f"Không thể lưu phân tích giao dịch {row.get('transaction_id')}: {str(e)}")
+            finally:
+                db.close()
+        if failed:
+            ANALYSIS_WRITER_ROWS.inc(len(failed), outcome='failed')
+            self._dead_letter(failed)
+        return written
+
+    def _dead_letter(self, rows: List[Dict]):
+        """Keep rows the database refused, so dropping them from the journal loses nothing"""
+        if not self._journal_dir:
+            return
+        with open(os.path.join(self._journal_dir, DEAD_LETTER_FILE), 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            f.write(''.join(_encode_row(row) + '\n' for row in rows))
+            f.flush()
+            os.fsync(f.fileno())
+        logger.error(f"Đã chuyển {len(rows)} bản ghi phân tích vào {DEAD_LETTER_FILE}")
+
+    @staticmethod
+    def _create_journal(path: str):
+        """
+        Open a journal that is locked before it becomes visible: it is created under a name
+        the replay glob ignores, locked, then renamed into place, so a worker starting at
+        the same time never mistakes it for an orphan and replays it away.
+        """
+        pending = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.pending")
+        journal = open(pending, 'a')
+        if fcntl is not None:
+            fcntl.flock(journal.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.rename(pending, path)
+        return journal
+
+    def _replay_orphaned_journals(self, journal_dir: str):
+        for path in glob.glob(os.path.join(journal_dir, 'analysis.*.jsonl')):
+            try:
+                f = open(path, 'r+')
+            except FileNotFoundError:
+                continue  # Replayed by another worker meanwhile
+            with f:
+                if fcntl is not None:
+                    try:
+                        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue  # Journal of a live worker
+                    try:
+                        if not os.path.samestat(os.fstat(f.fileno()), os.stat(path)):
+                            continue
+                    except FileNotFoundError:
+                        continue  # Replayed and removed by another worker before we got the lock
+                rows = [_decode_row(line) for line in f if line.strip()]
+                if rows:
+                    self._replay(rows)
+                # Removed before the lock is released, so no other worker replays it again
+                os.remove(path)
+
+    def _replay(self, rows: List[Dict]):
+        db = self.session_factory()
+        try:
+            ids = [row['transaction_id'] for row in rows]
+            existing = {
+                transaction_id for (transaction_id,) in
+                db.query(TransactionAnalysis.transaction_id).filter(TransactionAnalysis.transaction_id.in_(ids))
+            }
+        finally:
+            db.close()
+        missing = [row for row in rows if row['transaction_id'] not in existing]
+        if missing:
+            written = self._insert(missing)
+            ANALYSIS_WRITER_ROWS.inc(written, outcome='replayed')
+            logger.info(f"Đã ghi lại {written} bản ghi phân tích từ journal ({len(missing) - written} lỗi)")
@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, g
 from flask_cors import CORS
 import logging
 import json
@@ -7,7 +7,14 @@ import uuid
 import os
 import argparse
 from agent import FraudDetectionSystem
-from database import get_db, init_db, User, TransactionAnalysis, UserProfile, Alert
+from alert_store import DEFAULT_PAGE_SIZE, query_alerts
+from feature_store import get_profile_values
+from database import SessionLocal, begin_write, ReadSessionLocal, engine, read_engine, init_db, pool_metrics, read_pool_metrics, read_router, User, TransactionAnalysis, TransactionAnalysisPayload, UserProfile, Alert
+from logging_config import configure_logging
+import metrics
+import rollups
+from profiling import RequestProfiler, debug_timing_requested, instrument_engine, trace_request
+from serialization import JSON_MIMETYPE, Serialized, dumps, loads
 from dotenv import load_dotenv
 
 # Parse command line arguments
@@ -17,15 +24,8 @@ load_dotenv()
 app = Flask(__name__)
 CORS(app)  # Cho phép cross-origin requests
 
-# Thiết lập logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('api.log'),
-        logging.StreamHandler()  # Thêm handler để log ra console
-    ]
-)
+# Thiết lập logging (ghi qua hàng đợi nền, xem logging_config)
+configure_logging('api.log')
 logger = logging.getLogger('fraud_api')
 
 # Khởi tạo hệ thống phát hiện gian lận
@@ -34,24 +34,63 @@ fraud_system = FraudDetectionSystem()
 # Initialize database
 init_db()
 
+# Chẩn đoán từng request: đếm truy vấn DB cho ?debug_timing=1, profile 1/N request (PROFILE_SAMPLE_EVERY)
+instrument_engine(engine)
+if read_engine is not engine:
+    instrument_engine(read_engine)
+request_profiler = RequestProfiler.from_env()
+
+def get_request_db():
+    """Database session scoped to the current request, closed in teardown"""
+    if 'db' not in g:
+        g.db = SessionLocal()
+    return g.db
+
+def get_request_read_db(key=None):
+    """
+    Session for lag-tolerant reads scoped to the current request: the read replica when
+    it is configured, caught up and `key` (a user id) has no recent write from this
+    process, otherwise the primary session
+    """
+    if not read_router.use_replica(key):
+        return get_request_db()
+    if 'read_db' not in g:
+        g.read_db = ReadSessionLocal()
+    return g.read_db
+
+def json_response(body, status: int = 200) -> Response:
+    """Compact JSON response, encoded once"""
+    return Response(dumps(body), status=status, mimetype=JSON_MIMETYPE)
+
+@app.teardown_appcontext
+def close_request_db(exception=None):
+    """Return the request's connections to the pools, rolling back anything left uncommitted"""
+    for name in ('db', 'read_db'):
+        db = g.pop(name, None)
+        if db is not None:
+            if exception is not None:
+                db.rollback()
+            db.close()
+
 # API endpoint để xử lý giao dịch mới
 @app.route('/api/v1/process-transaction', methods=['POST'])
 def process_transaction():
     """Process a new transaction and return fraud detection results"""
     try:
         # Get database session
-        db = next(get_db())
+        db = get_request_db()
         
         # Get transaction data from request
-        transaction_data = request.json
-        logger.info(f"Received transaction data: {json.dumps(transaction_data, indent=2, default=str)}")
+        raw_body = request.get_data()
+        logger.info("Received transaction data: %s", Serialized(raw_body))
+        transaction_data = loads(raw_body)
         
         # Kiểm tra dữ liệu đầu vào
         required_fields = ['user_id', 'amount', 'ip_address']
         for field in required_fields:
             if field not in transaction_data:
                 logger.error(f"Missing required field: {field}")
-                return jsonify({
+                return json_response({
                     'status': 'error',
                     'message': f'Missing required field: {field}'
                 }), 400
@@ -68,24 +107,33 @@ def process_transaction():
             transaction_data['transaction_id'] = str(uuid.uuid4())
 
         logger.info(f"Processing transaction with ID: {transaction_data['transaction_id']}")
-        analysis_result = fraud_system.process_transaction(db, transaction_data)
-        logger.info(f"Analysis result: {json.dumps(analysis_result, indent=2, default=str)}")
+        debug_timing = debug_timing_requested(request.headers, request.args)
+        with trace_request(debug_timing) as trace, request_profiler.profile('process_transaction'):
+            analysis_result = fraud_system.process_transaction(
+                db, transaction_data, read_db=get_request_read_db(transaction_data['user_id'])
+            )
         
-        # Trả về kết quả
         response = {
             'status': 'success',
             'transaction_id': transaction_data['transaction_id'],
             'data': analysis_result
         }
+        if trace is not None:
+            # Chi tiết thời gian từng giai đoạn và số truy vấn DB của request này
+            response['debug'] = {'timing': trace.to_dict()}
         
-        # Log response
-        logger.info(f"Transaction processed: {json.dumps(response, indent=2)}")
+        # Trả về kết quả: mã hóa một lần, log tham chiếu chính các byte đó
+        body = dumps(response)
+        logger.info("Transaction processed: %s", Serialized(body))
         
-        return jsonify(response), 200
+        http_response = Response(body, status=200, mimetype=JSON_MIMETYPE)
+        if trace is not None:
+            http_response.headers['Server-Timing'] = trace.server_timing()
+        return http_response
         
     except Exception as e:
         logger.error(f"Error processing transaction: {str(e)}", exc_info=True)
-        return jsonify({
+        return json_response({
             'status': 'error',
             'message': 'Server error while processing transaction',
             'error': str(e)
@@ -101,25 +149,25 @@ def train_model():
             training_data = json.load(f).get('training_data', [])
         
         if not training_data or len(training_data) < 10:
-            return jsonify({
+            return json_response({
                 'status': 'error',
                 'message': 'Training data must be a list with at least 10 transactions'
             }), 400
         
         # Get database session
-        db = next(get_db())
+        db = get_request_db()
 
         # Train model
         success = fraud_system.train_model(db, training_data)
         
         if success:
-            return jsonify({'message': 'Model trained successfully'}), 200
+            return json_response({'message': 'Model trained successfully'}), 200
         else:
-            return jsonify({'error': 'Failed to train model'}), 400
+            return json_response({'error': 'Failed to train model'}), 400
             
     except Exception as e:
         logger.error(f"Error training model: {str(e)}")
-        return jsonify({
+        return json_response({
             'status': 'error',
             'message': 'Server error while training model',
             'error': str(e)
@@ -139,13 +187,14 @@ def verify_transaction():
         
         if not transaction_id or not user_id:
             logger.warning("Missing transaction_id or user_id in request")
-            return jsonify({
+            return json_response({
                 'status': 'error',
                 'message': 'Missing transaction_id or user_id'
             }), 400
         
-        # Get database session
-        db = next(get_db())
+        # Get database session; the lookup is followed by writes, so take the write lock first
+        db = get_request_db()
+        begin_write(db)
         
         # Find transaction in database
         transactionAnalysis = db.query(TransactionAnalysis).filter(
@@ -153,9 +202,20 @@ def verify_transaction():
             TransactionAnalysis.user_id == user_id
         ).first()
         
+        if not transactionAnalysis and fraud_system.analysis_writer is not None:
+            # The analysis may still be waiting in the write-behind queue, whose writer
+            # needs the write lock this transaction holds: release it while flushing
+            db.rollback()
+            fraud_system.analysis_writer.flush()
+            begin_write(db)
+            transactionAnalysis = db.query(TransactionAnalysis).filter(
+                TransactionAnalysis.transaction_id == transaction_id,
+                TransactionAnalysis.user_id == user_id
+            ).first()
+        
         if not transactionAnalysis:
             logger.warning(f"Transaction {transaction_id} not found for user {user_id}")
-            return jsonify({
+            return json_response({
                 'status': 'error',
                 'message': 'Transaction not found'
             }), 404
@@ -195,79 +255,53 @@ def verify_transaction():
         
         # Update transaction s
         db.commit()
+        # Read-your-writes: keep this user's reads on the primary until the replica catches up
+        read_router.note_write(user_id)
 
         logger.info(f"Transaction verification completed for {transaction_id}")
-        return jsonify({
+        return json_response({
             'status': 'success',
             'message': 'Transaction verification recorded'
         })
         
     except Exception as e:
         logger.error(f"Error verifying transaction: {str(e)}")
-        return jsonify({
+        return json_response({
             'status': 'error',
             'message': 'Server error while verifying transaction',
             'error': str(e)
         }), 500
 
-# API endpoint để nhận thống kê
-# @app.route('/api/v1/statistics', methods=['GET'])
-# def get_statistics():
-#     try:
-#         # Số lượng người dùng
-#         user_count = len(fraud_system.user_profiles)
-        
-#         # Tổng số giao dịch
-#         transaction_count = sum(len(profile['transactions']) for profile in fraud_system.user_profiles.values())
-        
-#         # Số lượng cảnh báo trong 7 ngày qua
-#         alerts_count = 0
-#         seven_days_ago = datetime.now() - timedelta(days=7)
-        
-#         # Đọc log để đếm cảnh báo
-#         try:
-#             with open('fraud_detection.log', 'r') as log_file:
-#                 for line in log_file:
-#                     if 'Phát hiện giao dịch đáng ngờ' in line:
-#                         try:
-#                             log_date = datetime.strptime(line.split(' - ')[0], '%Y-%m-%d %H:%M:%S,%f')
-#                             if log_date > seven_days_ago:
-#                                 alerts_count += 1
-#                         except:
-#                             pass
-#         except FileNotFoundError:
-#             pass
-        
-#         return jsonify({
-#             'status': 'success',
-#             'statistics': {
-#                 'user_count': user_count,
-#                 'transaction_count': transaction_count,
-#                 'alerts_last_7_days': alerts_count,
-#                 'generated_at': datetime.now().isoformat()
-#             }
-#         })
-        
-#     except Exception as e:
-#         logger.error(f"Error getting statistics: {str(e)}")
-#         return jsonify({
-#             'status': 'error',
-#             'message': 'Server error while getting statistics',
-#             'error': str(e)
-#         }), 500
+# API endpoint thống kê: đọc bộ đếm tổng hợp (rollups.py), không quét log hay bảng giao dịch
+@app.route('/api/v1/statistics', methods=['GET'])
+def get_statistics():
+    """User, transaction, suspicious and alert counts, in total and per time window"""
+    try:
+        return json_response({
+            'status': 'success',
+            'statistics': rollups.get_statistics(get_request_read_db())
+        }), 200
+    except Exception as e:
+        logger.error(f"Error getting statistics: {str(e)}")
+        return json_response({
+            'status': 'error',
+            'message': 'Server error while getting statistics',
+            'error': str(e)
+        }), 500
 
 @app.route('/api/v1/get_user_profile/<user_id>', methods=['GET'])
 def get_user_profile(user_id):
     """Get user profile and transaction history"""
     try:
-        # Get database session
-        db = next(get_db())
+        # Get database session (profile reads tolerate replica lag)
+        db = get_request_read_db(user_id)
         
         # Get user profile
         profile = db.query(UserProfile).filter(UserProfile.user_id == user_id).first()
         
         if not profile:
-            return jsonify({'error': 'User profile not found'}), 404
+            return json_response({'error': 'User profile not found'}), 404
+        values = get_profile_values(db, user_id)
             
         # Get recent transactions
         transactions = db.query(TransactionAnalysis).filter(
@@ -277,11 +311,11 @@ def get_user_profile(user_id):
         # Format response
         response = {
             'user_id': user_id,
-            'common_locations': profile.common_locations if profile.common_locations else [],
-            'common_devices': profile.common_devices if profile.common_devices else [],
-            'common_categories': profile.common_categories if profile.common_categories else [],
+            'common_locations': values['location'],
+            'common_devices': values['device'],
+            'common_categories': values['category'],
             'avg_transaction_amount': profile.avg_transaction_amount,
-            'typical_transaction_hours': profile.typical_transaction_hours if profile.typical_transaction_hours else [],
+            'typical_transaction_hours': [int(hour) for hour in values['hour']],
             'recent_transactions': [{
                 'transaction_id': t.transaction_id,
                 'amount': t.amount,
@@ -297,40 +331,74 @@ def get_user_profile(user_id):
             } for t in transactions]
         }
         
-        return jsonify(response), 200
+        return json_response(response), 200
         
     except Exception as e:
         logging.error(f"Error getting user profile: {str(e)}")
-        return jsonify({'error': str(e)}), 500
+        return json_response({'error': str(e)}), 500
 
-# @app.route('/api/v1/get_alerts/<user_id>', methods=['GET'])
-# def get_alerts(user_id):
-#     """Get recent alerts for a user"""
-#     try:
-#         # Get database session
-#         db = next(get_db())
-        
-#         # Get recent alerts
-#         alerts = db.query(Alert).filter(
-#             Alert.user_id == user_id
-#         ).order_by(Alert.timestamp.desc()).limit(10).all()
-        
-#         # Format response
-#         response = [{
-#             'alert_id': a.alert_id,
-#             'timestamp': a.timestamp.isoformat(),
-#             'risk_score': a.risk_score,
-#             'reasons': json.loads(a.reasons),
-#             'transaction_id': a.transaction_id,
-#             'transaction_details': json.loads(a.transaction_details),
-#             'status': a.status
-#         } for a in alerts]
-        
-#         return jsonify(response), 200
-        
-#     except Exception as e:
-#         logging.error(f"Error getting alerts: {str(e)}")
-#         return jsonify({'error': str(e)}), 500
+# API endpoint để lấy chi tiết phân tích (AI, rule-based, lý do) của một giao dịch
+@app.route('/api/v1/transaction-analysis/<transaction_id>/details', methods=['GET'])
+def get_transaction_analysis_details(transaction_id):
+    """Decompress and return the verbose analysis payload of a transaction"""
+    try:
+        db = get_request_read_db()
+        payload = db.get(TransactionAnalysisPayload, transaction_id)
+        if payload is None:
+            return json_response({'status': 'error', 'message': 'Analysis details not found'}), 404
+        return json_response({
+            'status': 'success',
+            'transaction_id': transaction_id,
+            'data': payload.fields()
+        }), 200
+    except Exception as e:
+        logger.error(f"Error getting analysis details: {str(e)}")
+        return json_response({'status': 'error', 'message': 'Server error while getting analysis details', 'error': str(e)}), 500
+
+# API endpoint để theo dõi connection pool của worker hiện tại
+@app.route('/api/v1/db-pool', methods=['GET'])
+def get_db_pool():
+    """Connection pool metrics of this worker process"""
+    return json_response({
+        'status': 'success',
+        'pid': os.getpid(),
+        'pool': pool_metrics.snapshot(),
+        'read_pool': read_pool_metrics.snapshot() if read_router.has_replica else None,
+        'replica_lag_seconds': read_router.replica_lag() if read_router.has_replica else None
+    }), 200
+
+# Prometheus metrics (độ trễ từng giai đoạn xử lý) của worker hiện tại
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Stage latency histograms and counters in the Prometheus text format"""
+    return Response(metrics.render(), status=200, content_type=metrics.CONTENT_TYPE)
+
+def _alerts_page(user_id=None):
+    """Keyset-paginated alerts (?status=&limit=&cursor=), shared by the alert routes"""
+    try:
+        limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+        page = query_alerts(
+            get_request_read_db(user_id), user_id=user_id, status=request.args.get('status'),
+            limit=limit, cursor=request.args.get('cursor')
+        )
+    except ValueError as e:
+        return json_response({'status': 'error', 'message': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error getting alerts: {str(e)}")
+        return json_response({'status': 'error', 'message': 'Server error while getting alerts', 'error': str(e)}), 500
+    return json_response(dict(page, status='success')), 200
+
+# API endpoint để lấy cảnh báo của một người dùng, mới nhất trước (phân trang bằng cursor)
+@app.route('/api/v1/get_alerts/<user_id>', methods=['GET'])
+def get_alerts(user_id):
+    """Get a user's alerts, newest first; pass `next_cursor` back as ?cursor= for the next page"""
+    return _alerts_page(user_id)
+
+# API endpoint cho đội kiểm duyệt: cảnh báo của mọi người dùng, lọc theo ?status=new
+@app.route('/api/v1/alerts', methods=['GET'])
+def list_alerts():
+    """Get alerts of all users, newest first, optionally filtered by status"""
+    return _alerts_page()
 
 # Khởi động server
 if __name__ == '__main__':
@@ -0,0 +1,307 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import re
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+import pandas as pd
+from sqlalchemy import Boolean, DateTime, Float, Integer, JSON, delete, exists, func, select
+from sqlalchemy.orm import Session
+
+from database import ANALYSIS_PAYLOAD_FIELDS, Alert, SessionLocal, Transaction, TransactionAnalysis, TransactionAnalysisPayload
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Only needed by the archival job and backtests
+    pa = pq = None
+
+logger = logging.getLogger('fraud_detection.archive')
+
+DEFAULT_ARCHIVE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'archive')
+
+ARCHIVED_TABLES = {
+    'transactions': Transaction,
+    'transaction_analyses': TransactionAnalysis,
+}
+
+_PART_PATTERN = re.compile(r'^(\d{4}-\d{2})\.(\d+)\.parquet$')
+
+
+def month_start(ts: datetime) -> datetime:
+    return ts.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(ts: datetime) -> datetime:
+    ts = month_start(ts)
+    return ts.replace(year=ts.year + 1, month=1) if ts.month == 12 else ts.replace(month=ts.month + 1)
+
+
+def subtract_months(ts: datetime, months: int) -> datetime:
+    index = ts.year * 12 + ts.month - 1 - months
+    return month_start(ts).replace(year=index // 12, month=index % 12 + 1)
+
+
+def _arrow_type(column):
+    if isinstance(column.type, DateTime):
+        return pa.timestamp('us')
+    if isinstance(column.type, Boolean):
+        return pa.bool_()
+    if isinstance(column.type, Integer):
+        return pa.int64()
+    if isinstance(column.type, Float):
+        return pa.float64()
+    # Strings, and JSON columns stored as their JSON text
+    return pa.string()
+
+
+# Compressed payload side tables; their fields are archived inline, as JSON text
+_PAYLOAD_TABLES = {TransactionAnalysis: TransactionAnalysisPayload}
+
+
+def _json_columns(model) -> List[str]:
+    names = [column.name for column in model.__table__.columns if isinstance(column.type, JSON)]
+    if model in _PAYLOAD_TABLES:
+        names += list(ANALYSIS_PAYLOAD_FIELDS)
+    return names
+
+
+def _column_names(model) -> List[str]:
+    names = [column.name for column in model.__table__.columns]
+    if model in _PAYLOAD_TABLES:
+        names += list(ANALYSIS_PAYLOAD_FIELDS)
+    return names
+
+
+def _arrow_schema(model):
+    fields = [(column.name, _arrow_type(column)) for column in model.__table__.columns]
+    if model in _PAYLOAD_TABLES:
+        fields += [(name, pa.string()) for name in ANALYSIS_PAYLOAD_FIELDS]
+    return pa.schema(fields)
+
+
+def _select_rows(model):
+    """SELECT of the archived columns of `model`, joined with its payload side table if it has one"""
+    stmt = select(*model.__table__.columns)
+    payload = _PAYLOAD_TABLES.get(model)
+    if payload is not None:
+        stmt = stmt.add_columns(payload.codec, payload.data).outerjoin(
+            payload, payload.transaction_id == model.transaction_id
+        )
+    return stmt
+
+
+def _row_values(model, row) -> Dict:
+    values = {column.name: row[column.name] for column in model.__table__.columns}
+    payload = _PAYLOAD_TABLES.get(model)
+    if payload is not None:
+        fields = payload.decode(row['codec'], row['data']) if row['data'] is not None else {}
+        for name in ANALYSIS_PAYLOAD_FIELDS:
+            values[name] = fields.get(name)
+    return values
+
+
+class TransactionArchive:
+    """
+    Monthly archive of cold transaction rows in compressed Parquet files.
+
+    MySQL cannot partition tables that take part in foreign keys, so partitioning is
+    done by the application: each calendar month older than the retention window is
+    streamed out of the hot table into `<root>/<table>/<YYYY-MM>.<part>.parquet`
+    (zstd-compressed, JSON columns and analysis payloads kept as JSON text) and then
+    deleted from the database. Rows referenced by an alert stay in the hot table.
+
+    A month is moved in two steps, file first and delete second, and the delete is
+    driven by the ids in the written file; re-running after a crash deletes rows that
+    were already archived instead of archiving them twice.
+    """
+
+    def __init__(self, root: str = DEFAULT_ARCHIVE_DIR, chunk_size: int = 5000):
+        if pq is None:
+            raise RuntimeError("pyarrow is required for the transaction archive (pip install pyarrow)")
+        self.root = root
+        self.chunk_size = chunk_size
+
+    def _table_dir(self, table: str) -> str:
+        return os.path.join(self.root, table)
+
+    def parts(self, table: str, month: Optional[str] = None) -> List[str]:
+        """Archive files of `table`, optionally only those of one month ("YYYY-MM"), in order"""
+        pattern = f"{month}.*.parquet" if month else '*.parquet'
+        paths = [p for p in glob.glob(os.path.join(self._table_dir(table), pattern))
+                 if _PART_PATTERN.match(os.path.basename(p))]
+        return sorted(paths, key=lambda p: tuple(
+            int(v) if v.isdigit() else v for v in _PART_PATTERN.match(os.path.basename(p)).groups()
+        ))
+
+    def months(self, table: str) -> List[str]:
+        return sorted({_PART_PATTERN.match(os.path.basename(p)).group(1) for p in self.parts(table)})
+
+    def archive_before(self, db: Session, cutoff: datetime, tables: Iterable[str] = ARCHIVED_TABLES) -> Dict[str, int]:
+        """Archive every whole month before `cutoff` (rounded down to a month); returns rows moved per table"""
+        cutoff = month_start(cutoff)
+        moved = {}
+        for table in tables:
+            model = ARCHIVED_TABLES[table]
+            oldest = db.execute(select(func.min(model.timestamp)).where(model.timestamp < cutoff)).scalar()
+            db.rollback()
+            moved[table] = 0
+            month = month_start(oldest) if oldest else cutoff
+            while month < cutoff:
+                moved[table] += self.archive_month(db, table, month)
+                month = next_month(month)
+        return moved
+
+    def archive_month(self, db: Session, table: str, month: datetime) -> int:
+        """Move the rows of `table` with a timestamp in `month` to a new archive part; returns the row count"""
+        model = ARCHIVED_TABLES[table]
+        month = month_start(month)
+        key = month.strftime('%Y-%m')
+
+        # Finish any earlier run that wrote its file but did not get to delete the rows
+        for path in self.parts(table, key):
+            self._delete_archived(db, model, path)
+
+        names = _column_names(model)
+        json_columns = set(_json_columns(model))
+        schema = _arrow_schema(model)
+        base = (
+            _select_rows(model)
+            .where(model.timestamp >= month, model.timestamp < next_month(month))
+            .where(~exists().where(Alert.transaction_id == model.transaction_id))
+            .order_by(model.transaction_id)
+            .limit(self.chunk_size)
+        )
+
+        directory = self._table_dir(table)
+        os.makedirs(directory, exist_ok=True)
+        existing = self.parts(table, key)
+        part = int(_PART_PATTERN.match(os.path.basename(existing[-1])).group(2)) + 1 if existing else 0
+        path = os.path.join(directory, f"{key}.{part:04d}.parquet")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+
+        count = 0
+        last_id = None
+        writer = None
+        try:
+            while True:
+                stmt = base if last_id is None else base.where(model.transaction_id > last_id)
+                rows = [_row_values(model, row) for row in db.execute(stmt).mappings()]
+                db.rollback()
+                if not rows:
+                    break
+                data = {
+                    name: [
+                        json.dumps(row[name], ensure_ascii=False) if name in json_columns and row[name] is not None
+                        else row[name]
+                        for row in rows
+                    ]
+                    for name in names
+                }
+                if writer is None:
+                    writer = pq.ParquetWriter(tmp_path, schema, compression='zstd')
+                writer.write_table(pa.Table.from_pydict(data, schema=schema))
+                count += len(rows)
+                last_id = rows[-1]['transaction_id']
+        except Exception:
+            if writer is not None:
+                writer.close()
+                os.remove(tmp_path)
+            raise
+
+        if writer is None:
+            return 0
+        writer.close()
+        with open(tmp_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self._delete_archived(db, model, path)
+        logger.info(f"Đã lưu trữ {count} bản ghi {table} tháng {key} vào {path}")
+        return count
+
+    def _delete_archived(self, db: Session, model, path: str):
+        """Delete the rows listed in an archive file from the hot table, in chunks"""
+        for batch in pq.ParquetFile(path).iter_batches(columns=['transaction_id'], batch_size=self.chunk_size):
+            ids = batch.column(0).to_pylist()
+            payload = _PAYLOAD_TABLES.get(model)
+            if payload is not None:
+                db.execute(delete(payload).where(payload.transaction_id.in_(ids)).execution_options(synchronize_session=False))
+            db.execute(delete(model).where(model.transaction_id.in_(ids)).execution_options(synchronize_session=False))
+            db.commit()
+
+    def read(self, table: str, start: Optional[datetime] = None, end: Optional[datetime] = None,
+             user_id: Optional[str] = None) -> pd.DataFrame:
+        """Archived rows of `table` with start <= timestamp < end, optionally for one user"""
+        model = ARCHIVED_TABLES[table]
+        first = start.strftime('%Y-%m') if start else None
+        last = end.strftime('%Y-%m') if end else None
+        paths = [
+            p for p in self.parts(table)
+            if (first is None or os.path.basename(p)[:7] >= first) and (last is None or os.path.basename(p)[:7] <= last)
+        ]
+        if not paths:
+            return pd.DataFrame(columns=_column_names(model))
+
+        filters = []
+        if user_id is not None:
+            filters.append(('user_id', '=', user_id))
+        if start is not None:
+            filters.append(('timestamp', '>=', pd.Timestamp(start)))
+        if end is not None:
+            filters.append(('timestamp', '<', pd.Timestamp(end)))
+        frame = pq.ParquetDataset(paths, filters=filters or None).read().to_pandas()
+        for name in _json_columns(model):
+            frame[name] = frame[name].map(lambda v: json.loads(v) if isinstance(v, str) else v)
+        return frame
+
+
+def read_transactions(db: Session, table: str = 'transactions', start: Optional[datetime] = None,
+                      end: Optional[datetime] = None, user_id: Optional[str] = None,
+                      archive: Optional[TransactionArchive] = None) -> pd.DataFrame:
+    """
+    Rows of `table` with start <= timestamp < end from both the archive and the hot
+    table, ordered by timestamp. Meant for backtests and offline analysis; the serving
+    path only ever reads the hot table.
+    """
+    model = ARCHIVED_TABLES[table]
+    stmt = _select_rows(model)
+    if user_id is not None:
+        stmt = stmt.where(model.user_id == user_id)
+    if start is not None:
+        stmt = stmt.where(model.timestamp >= start)
+    if end is not None:
+        stmt = stmt.where(model.timestamp < end)
+    hot = pd.DataFrame([_row_values(model, row) for row in db.execute(stmt).mappings()], columns=_column_names(model))
+
+    archive = archive or TransactionArchive(os.getenv('ARCHIVE_DIR', DEFAULT_ARCHIVE_DIR))
+    cold = archive.read(table, start, end, user_id)
+    frames = [frame for frame in (cold, hot) if not frame.empty]
+    if not frames:
+        return hot
+    combined = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+    # A row can be in both only while an archival run is between its write and delete steps
+    combined = combined.drop_duplicates(subset='transaction_id', keep='last')
+    return combined.sort_values('timestamp', kind='stable').reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Move cold months of transaction data to the Parquet archive')
+    parser.add_argument('--retention-months', type=int, default=int(os.getenv('ARCHIVE_RETENTION_MONTHS', 6)),
+                        help='Whole months to keep in the hot tables besides the current one')
+    parser.add_argument('--archive-dir', default=os.getenv('ARCHIVE_DIR', DEFAULT_ARCHIVE_DIR))
+    parser.add_argument('--table', choices=list(ARCHIVED_TABLES), action='append',
+                        help='Table to archive (default: all)')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    cutoff = subtract_months(datetime.now(), args.retention_months)
+    db = SessionLocal()
+    try:
+        moved = TransactionArchive(args.archive_dir).archive_before(db, cutoff, args.table or ARCHIVED_TABLES)
+    finally:
+        db.close()
+    for table, count in moved.items():
+        print(f"{table}: archived {count} rows older than {cutoff:%Y-%m}")
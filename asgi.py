@@ -0,0 +1,413 @@
+import asyncio
+import json
+import logging
+import os
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Optional
+
+from dotenv import load_dotenv
+from fastapi import Depends, FastAPI, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from agent import FraudDetectionSystem
+from alert_store import DEFAULT_PAGE_SIZE, query_alerts
+from database import (
+    DATABASE_READ_URL, DATABASE_URL, DB_MAX_OVERFLOW, DB_POOL_RECYCLE, DB_POOL_SIZE, DB_POOL_TIMEOUT,
+    PoolMetrics, SessionLocal, begin_write, TransactionAnalysis, TransactionAnalysisPayload, UserProfile,
+    create_async_db_engine, init_db, read_router
+)
+from feature_store import get_profile_values
+from logging_config import configure_logging
+import metrics
+import rollups
+from profiling import RequestProfiler, debug_timing_requested, instrument_engine, trace_request
+from serialization import JSON_MIMETYPE, Serialized, dumps, loads
+
+# ASGI version of api.py: the same /api/v1 routes with async handlers, served by uvicorn.
+# A request waiting on the database or the LLM only holds a coroutine, not a worker process.
+load_dotenv()
+
+# Thiết lập logging (ghi qua hàng đợi nền, xem logging_config)
+configure_logging('api.log')
+logger = logging.getLogger('fraud_api')
+
+# Khởi tạo hệ thống phát hiện gian lận
+fraud_system = FraudDetectionSystem()
+
+# Initialize database
+init_db()
+
+_pool_options = dict(
+    pool_pre_ping=True,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_timeout=DB_POOL_TIMEOUT,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_size=DB_POOL_SIZE
+)
+async_pool_metrics = PoolMetrics()
+async_engine = create_async_db_engine(DATABASE_URL, async_pool_metrics, **_pool_options)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+# Read replica, if configured (see database.ReadRouter)
+async_read_pool_metrics = PoolMetrics() if DATABASE_READ_URL else async_pool_metrics
+async_read_engine = create_async_db_engine(
+    DATABASE_READ_URL, async_read_pool_metrics, **_pool_options
+) if DATABASE_READ_URL else async_engine
+AsyncReadSessionLocal = async_sessionmaker(async_read_engine, autoflush=False, expire_on_commit=False)
+
+# Chẩn đoán từng request: đếm truy vấn DB cho ?debug_timing=1, profile 1/N request (PROFILE_SAMPLE_EVERY)
+instrument_engine(async_engine.sync_engine)
+if async_read_engine is not async_engine:
+    instrument_engine(async_read_engine.sync_engine)
+request_profiler = RequestProfiler.from_env()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await async_engine.dispose()
+    if async_read_engine is not async_engine:
+        await async_read_engine.dispose()
+
+
+app = FastAPI(title='Fraud Detection API', lifespan=lifespan)
+app.add_middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])
+
+
+async def get_async_db():
+    """Async database session scoped to the request, rolled back if left uncommitted"""
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+@asynccontextmanager
+async def read_session(db: AsyncSession, key=None):
+    """
+    Session for lag-tolerant reads: a replica session when the read router allows it for
+    `key` (a user id), otherwise the request's primary session
+    """
+    # The lag check may query the replica: keep it off the event loop
+    if not read_router.has_replica or not await asyncio.to_thread(read_router.use_replica, key):
+        yield db
+        return
+    async with AsyncReadSessionLocal() as read_db:
+        yield read_db
+
+
+def respond(body, status_code: int = 200) -> Response:
+    """Compact JSON response, encoded once"""
+    return Response(dumps(body), status_code=status_code, media_type=JSON_MIMETYPE)
+
+
+# API endpoint để xử lý giao dịch mới
+@app.post('/api/v1/process-transaction')
+async def process_transaction(request: Request, db: AsyncSession = Depends(get_async_db)):
+    """Process a new transaction and return fraud detection results"""
+    try:
+        raw_body = await request.body()
+        logger.info("Received transaction data: %s", Serialized(raw_body))
+        transaction_data = loads(raw_body)
+
+        # Kiểm tra dữ liệu đầu vào
+        for field in ('user_id', 'amount', 'ip_address'):
+            if field not in transaction_data:
+                logger.error(f"Missing required field: {field}")
+                return respond({
+                    'status': 'error',
+                    'message': f'Missing required field: {field}'
+                }, 400)
+
+        # Thêm trường timestamp nếu chưa có
+        if 'timestamp' not in transaction_data:
+            transaction_data['timestamp'] = datetime.now()
+        else:
+            transaction_data['timestamp'] = datetime.fromisoformat(transaction_data['timestamp'])
+
+        # Thêm transaction_id nếu chưa có
+        if 'transaction_id' not in transaction_data:
+            transaction_data['transaction_id'] = str(uuid.uuid4())
+
+        logger.info(f"Processing transaction with ID: {transaction_data['transaction_id']}")
+        debug_timing = debug_timing_requested(request.headers, request.query_params)
+        with trace_request(debug_timing) as trace, request_profiler.profile('process_transaction'):
+            async with read_session(db, transaction_data['user_id']) as read_db:
+                analysis_result = await fraud_system.process_transaction_async(db, transaction_data, read_db=read_db)
+
+        response = {
+            'status': 'success',
+            'transaction_id': transaction_data['transaction_id'],
+            'data': analysis_result
+        }
+        if trace is not None:
+            # Chi tiết thời gian từng giai đoạn và số truy vấn DB của request này
+            response['debug'] = {'timing': trace.to_dict()}
+
+        # Mã hóa một lần, log tham chiếu chính các byte đó
+        body = dumps(response)
+        logger.info("Transaction processed: %s", Serialized(body))
+        headers = {'Server-Timing': trace.server_timing()} if trace is not None else None
+        return Response(body, media_type=JSON_MIMETYPE, headers=headers)
+
+    except Exception as e:
+        logger.error(f"Error processing transaction: {str(e)}", exc_info=True)
+        return respond({
+            'status': 'error',
+            'message': 'Server error while processing transaction',
+            'error': str(e)
+        }, 500)
+
+
+def _train_model() -> bool:
+    with open('training_data.json', 'r') as f:
+        training_data = json.load(f).get('training_data', [])
+    if not training_data or len(training_data) < 10:
+        raise ValueError('Training data must be a list with at least 10 transactions')
+    db = SessionLocal()
+    try:
+        return fraud_system.train_model(db, training_data)
+    finally:
+        db.close()
+
+
+# API endpoint để huấn luyện mô hình
+@app.post('/api/v1/train-model')
+async def train_model():
+    """Train the fraud detection model with new transaction data"""
+    try:
+        # Huấn luyện tốn CPU: chạy trong thread để không chặn event loop
+        success = await asyncio.to_thread(_train_model)
+        if success:
+            return respond({'message': 'Model trained successfully'})
+        return respond({'error': 'Failed to train model'}, 400)
+
+    except ValueError as e:
+        return respond({'status': 'error', 'message': str(e)}, 400)
+    except Exception as e:
+        logger.error(f"Error training model: {str(e)}")
+        return respond({
+            'status': 'error',
+            'message': 'Server error while training model',
+            'error': str(e)
+        }, 500)
+
+
+# API endpoint để xác nhận giao dịch (sau khi người dùng xác minh)
+@app.post('/api/v1/verify-transaction')
+async def verify_transaction(request: Request, db: AsyncSession = Depends(get_async_db)):
+    """Verify a transaction after user confirmation"""
+    try:
+        data = await request.json()
+        transaction_id = data.get('transaction_id')
+        user_id = data.get('user_id')
+        is_legitimate = data.get('is_legitimate', False)
+
+        logger.info(f"Verifying transaction {transaction_id} for user {user_id}. Is legitimate: {is_legitimate}")
+
+        if not transaction_id or not user_id:
+            logger.warning("Missing transaction_id or user_id in request")
+            return respond({
+                'status': 'error',
+                'message': 'Missing transaction_id or user_id'
+            }, 400)
+
+        query = select(TransactionAnalysis).where(
+            TransactionAnalysis.transaction_id == transaction_id,
+            TransactionAnalysis.user_id == user_id
+        )
+        # The lookup is followed by writes: take the write lock first
+        await db.run_sync(begin_write)
+        transactionAnalysis = (await db.execute(query)).scalars().first()
+
+        if not transactionAnalysis and fraud_system.analysis_writer is not None:
+            # The analysis may still be waiting in the write-behind queue, whose writer
+            # needs the write lock this transaction holds: release it while flushing
+            await db.rollback()
+            await asyncio.to_thread(fraud_system.analysis_writer.flush)
+            await db.run_sync(begin_write)
+            transactionAnalysis = (await db.execute(query)).scalars().first()
+
+        if not transactionAnalysis:
+            logger.warning(f"Transaction {transaction_id} not found for user {user_id}")
+            return respond({
+                'status': 'error',
+                'message': 'Transaction not found'
+            }, 404)
+
+        logger.info(f"Found transaction {transaction_id}. Updating verification status")
+        transactionAnalysis.verified = True
+        transactionAnalysis.is_fraud = not is_legitimate
+
+        if is_legitimate:
+            logger.info(f"Updating user profile for legitimate transaction {transaction_id}")
+            transaction_data = {
+                'transaction_id': transactionAnalysis.transaction_id,
+                'user_id': transactionAnalysis.user_id,
+                'amount': transactionAnalysis.amount,
+                'currency': transactionAnalysis.currency,
+                'description': transactionAnalysis.description,
+                'category': transactionAnalysis.category,
+                'timestamp': transactionAnalysis.timestamp,
+                'ip_address': transactionAnalysis.ip_address,
+                'geolocation': transactionAnalysis.geolocation,
+                'device_id': transactionAnalysis.device_id,
+            }
+            await db.run_sync(fraud_system.update_user_profile, user_id, transaction_data)
+            logger.info(f"User profile updated successfully for user {user_id}")
+
+        await db.commit()
+        # Read-your-writes: keep this user's reads on the primary until the replica catches up
+        read_router.note_write(user_id)
+
+        logger.info(f"Transaction verification completed for {transaction_id}")
+        return respond({
+            'status': 'success',
+            'message': 'Transaction verification recorded'
+        })
+
+    except Exception as e:
+        logger.error(f"Error verifying transaction: {str(e)}")
+        return respond({
+            'status': 'error',
+            'message': 'Server error while verifying transaction',
+            'error': str(e)
+        }, 500)
+
+
+# API endpoint thống kê: đọc bộ đếm tổng hợp (rollups.py), không quét log hay bảng giao dịch
+@app.get('/api/v1/statistics')
+async def get_statistics(db: AsyncSession = Depends(get_async_db)):
+    """User, transaction, suspicious and alert counts, in total and per time window"""
+    try:
+        async with read_session(db) as read_db:
+            result = await read_db.run_sync(rollups.get_statistics)
+        return respond({'status': 'success', 'statistics': result})
+    except Exception as e:
+        logger.error(f"Error getting statistics: {str(e)}")
+        return respond({
+            'status': 'error',
+            'message': 'Server error while getting statistics',
+            'error': str(e)
+        }, 500)
+
+
+@app.get('/api/v1/get_user_profile/{user_id}')
+async def get_user_profile(user_id: str, db: AsyncSession = Depends(get_async_db)):
+    """Get user profile and transaction history"""
+    try:
+        async with read_session(db, user_id) as read_db:
+            profile = await read_db.get(UserProfile, user_id)
+            if not profile:
+                return respond({'error': 'User profile not found'}, 404)
+            values = await read_db.run_sync(get_profile_values, user_id)
+
+            transactions = (await read_db.execute(
+                select(TransactionAnalysis).where(TransactionAnalysis.user_id == user_id)
+                .order_by(TransactionAnalysis.timestamp.desc()).limit(10)
+            )).scalars().all()
+
+        return respond({
+            'user_id': user_id,
+            'common_locations': values['location'],
+            'common_devices': values['device'],
+            'common_categories': values['category'],
+            'avg_transaction_amount': profile.avg_transaction_amount,
+            'typical_transaction_hours': [int(hour) for hour in values['hour']],
+            'recent_transactions': [{
+                'transaction_id': t.transaction_id,
+                'amount': t.amount,
+                'category': t.category,
+                'currency': t.currency,
+                'description': t.description,
+                'ip_address': t.ip_address,
+                'geolocation': t.geolocation,
+                'device_id': t.device_id,
+                'timestamp': t.timestamp.isoformat(),
+                'is_suspicious': t.is_suspicious,
+                'risk_score': t.risk_score
+            } for t in transactions]
+        })
+
+    except Exception as e:
+        logger.error(f"Error getting user profile: {str(e)}")
+        return respond({'error': str(e)}, 500)
+
+
+async def _alerts_page(db: AsyncSession, user_id: Optional[str], status: Optional[str], limit: int,
+                       cursor: Optional[str]) -> Response:
+    try:
+        async with read_session(db, user_id) as read_db:
+            page = await read_db.run_sync(query_alerts, user_id=user_id, status=status, limit=limit, cursor=cursor)
+    except ValueError as e:
+        return respond({'status': 'error', 'message': str(e)}, 400)
+    except Exception as e:
+        logger.error(f"Error getting alerts: {str(e)}")
+        return respond({'status': 'error', 'message': 'Server error while getting alerts', 'error': str(e)}, 500)
+    return respond(dict(page, status='success'))
+
+
+# API endpoint để lấy cảnh báo của một người dùng, mới nhất trước (phân trang bằng cursor)
+@app.get('/api/v1/get_alerts/{user_id}')
+async def get_alerts(user_id: str, status: Optional[str] = None, limit: int = DEFAULT_PAGE_SIZE,
+                     cursor: Optional[str] = None, db: AsyncSession = Depends(get_async_db)):
+    """Get a user's alerts, newest first; pass `next_cursor` back as ?cursor= for the next page"""
+    return await _alerts_page(db, user_id, status, limit, cursor)
+
+
+# API endpoint cho đội kiểm duyệt: cảnh báo của mọi người dùng, lọc theo ?status=new
+@app.get('/api/v1/alerts')
+async def list_alerts(status: Optional[str] = None, limit: int = DEFAULT_PAGE_SIZE,
+                      cursor: Optional[str] = None, db: AsyncSession = Depends(get_async_db)):
+    """Get alerts of all users, newest first, optionally filtered by status"""
+    return await _alerts_page(db, None, status, limit, cursor)
+
+
+# API endpoint để lấy chi tiết phân tích (AI, rule-based, lý do) của một giao dịch
+@app.get('/api/v1/transaction-analysis/{transaction_id}/details')
+async def get_transaction_analysis_details(transaction_id: str, db: AsyncSession = Depends(get_async_db)):
+    """Decompress and return the verbose analysis payload of a transaction"""
+    try:
+        async with read_session(db) as read_db:
+            payload = await read_db.get(TransactionAnalysisPayload, transaction_id)
+        if payload is None:
+            return respond({'status': 'error', 'message': 'Analysis details not found'}, 404)
+        return respond({
+            'status': 'success',
+            'transaction_id': transaction_id,
+            'data': payload.fields()
+        })
+    except Exception as e:
+        logger.error(f"Error getting analysis details: {str(e)}")
+        return respond({'status': 'error', 'message': 'Server error while getting analysis details', 'error': str(e)}, 500)
+
+
+# API endpoint để theo dõi connection pool của worker hiện tại
+@app.get('/api/v1/db-pool')
+async def get_db_pool():
+    """Connection pool metrics of this worker process"""
+    has_replica = read_router.has_replica
+    return respond({
+        'status': 'success',
+        'pid': os.getpid(),
+        'pool': async_pool_metrics.snapshot(),
+        'read_pool': async_read_pool_metrics.snapshot() if has_replica else None,
+        'replica_lag_seconds': await asyncio.to_thread(read_router.replica_lag) if has_replica else None
+    })
+
+
+# Prometheus metrics (độ trễ từng giai đoạn xử lý) của worker hiện tại
+@app.get('/metrics')
+async def get_metrics():
+    """Stage latency histograms and counters in the Prometheus text format"""
+    return Response(metrics.render(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+# Khởi động server
+if __name__ == '__main__':
+    import uvicorn
+
+    uvicorn.run('asgi:app', host='0.0.0.0', port=int(os.getenv('PORT', 5001)))
@@ -0,0 +1,198 @@
+"""
+Alert dispatch check with local fake providers.
+
+Queues alerts from several threads the way the scoring path does, and measures what that
+costs the caller. Dispatcher workers deliver them through fake push/email/SMS providers
+that have latency and a failure rate, under per-channel rate limits. The check then
+verifies three things:
+- every job ends up delivered exactly once or failed after its last retry
+- no channel went over its rate limit
+- a job abandoned by a dead worker is delivered once its lease expires
+- with coalescing, a burst of alerts on a few accounts collapses into a few digests per
+  account that still account for every alert, escalating when the combined risk grows
+
+Exits non-zero on a violation.
+
+    python benchmarks/alert_dispatch.py
+    python benchmarks/alert_dispatch.py --alerts 2000 --failure-rate 0.3 --latency-ms 200 --workers 16
+"""
+import argparse
+import logging
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from alert_queue import LEVEL_CHANNELS, AlertDispatcher, AlertQueue, FakeProvider, RateLimiter  # noqa: E402
+
+# Per-delivery retries and failures are summarized at the end instead
+logging.getLogger('fraud_detection.alerts').setLevel(logging.CRITICAL)
+
+
+def check_coalescing(tmp_dir: str, window: float, users: int = 5, alerts_per_user: int = 40) -> bool:
+    """Medium-risk alert bursts on a few accounts: one immediate send, one escalation, then window digests"""
+    alert_queue = AlertQueue(os.path.join(tmp_dir, 'coalesce.db'), coalesce_window=window)
+    channels = ('push', 'email', 'sms')
+    for i in range(alerts_per_user):
+        for user in range(users):
+            alert_queue.submit(f'user_{user}', {'transaction_id': f'{user}-{i}', 'risk_score': 0.6, 'reasons': ['r'],
+                                                'transaction_details': {'amount': 1000, 'time': ''}}, channels)
+        time.sleep(window * 1.5 / alerts_per_user)
+    time.sleep(window)
+    alert_queue.flush_digests()
+
+    provider = FakeProvider('all', 0.0, 0.0)
+    jobs_per_user = Counter()
+    accounted = Counter()
+    levels = Counter()
+    for channel in channels:
+        while True:
+            job = alert_queue.claim(channel, lease=30)
+            if job is None:
+                break
+            alert_queue.complete(job.id)
+            if channel == 'push':
+                jobs_per_user[job.user_id] += 1
+                levels[job.alert_level] += 1
+                accounted[job.user_id] += job.alert_data.get('digest', {}).get('alert_count', 1)
+            provider.sent.append(job.alert_data)
+    # The escalation digest repeats the first alert; the window digests list the alerts since
+    merged_ok = all(accounted[f'user_{user}'] >= alerts_per_user for user in range(users))
+    print(f"Coalescing: {users * alerts_per_user} alerts -> {len(provider.sent)} deliveries "
+          f"(instead of {users * alerts_per_user * 2}), per user {sorted(set(jobs_per_user.values()))} push sends, "
+          f"levels {dict(levels)}, every alert in a digest: {merged_ok}")
+    # First alert, escalation, and one digest per window: the burst spans two windows
+    return merged_ok and levels['high'] > 0 and max(jobs_per_user.values()) <= 4
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--alerts', type=int, default=500)
+    parser.add_argument('--producers', type=int, default=8, help='Threads queueing alerts')
+    parser.add_argument('--workers', type=int, default=8, help='Dispatcher threads')
+    parser.add_argument('--latency-ms', type=float, default=50.0, help='Fake provider latency')
+    parser.add_argument('--failure-rate', type=float, default=0.2, help='Share of fake deliveries that fail')
+    parser.add_argument('--sms-rate', type=float, default=50.0, help='SMS rate limit (sends per second)')
+    parser.add_argument('--max-attempts', type=int, default=4)
+    parser.add_argument('--coalesce-window', type=float, default=1.0, help='Window of the coalescing scenario (seconds)')
+    parser.add_argument('--timeout', type=float, default=300.0)
+    args = parser.parse_args(argv)
+
+    tmp_dir = tempfile.mkdtemp(prefix='alert_dispatch_')
+    alert_queue = AlertQueue(os.path.join(tmp_dir, 'alert_queue.db'))
+    providers = {channel: FakeProvider(channel, args.latency_ms, args.failure_rate, seed=i)
+                 for i, channel in enumerate(('push', 'email', 'sms'))}
+    sms_times = []
+    sms_send = providers['sms'].send
+
+    def timed_sms(recipient, alert_data):
+        sms_times.append(time.monotonic())
+        sms_send(recipient, alert_data)
+    providers['sms'].send = timed_sms
+
+    dispatcher = AlertDispatcher(
+        alert_queue, providers, recipients=lambda user_id, channel, alert_data: f"{channel}:{user_id}",
+        workers=args.workers, rate_limits={'sms': RateLimiter(args.sms_rate, burst=1)},
+        max_attempts=args.max_attempts, backoff_base=0.05, backoff_max=0.5, poll_interval=0.05
+    )
+
+    levels = list(LEVEL_CHANNELS)
+    expected = Counter()
+    enqueue_latencies = []
+    lock = threading.Lock()
+
+    def produce(worker: int):
+        for i in range(worker, args.alerts, args.producers):
+            level = levels[i % len(levels)]
+            alert_data = {'transaction_id': str(uuid.uuid4()), 'risk_score': 0.9,
+                          'transaction_details': {'device_id': f'device_{i}'}}
+            started = time.perf_counter()
+            alert_queue.enqueue(f'user_{i % 50}', alert_data, level, LEVEL_CHANNELS[level])
+            elapsed = time.perf_counter() - started
+            with lock:
+                enqueue_latencies.append(elapsed)
+                expected.update(LEVEL_CHANNELS[level])
+
+    dispatcher.start()
+    started = time.perf_counter()
+    producers = [threading.Thread(target=produce, args=(i,)) for i in range(args.producers)]
+    for thread in producers:
+        thread.start()
+    for thread in producers:
+        thread.join()
+    enqueued = time.perf_counter() - started
+
+    total = sum(expected.values())
+    deadline = time.monotonic() + args.timeout
+    while time.monotonic() < deadline:
+        counts = alert_queue.counts()
+        done = sum(statuses.get('sent', 0) + statuses.get('failed', 0) for statuses in counts.values())
+        if done >= total:
+            break
+        time.sleep(0.1)
+    elapsed = time.perf_counter() - started
+    dispatcher.stop()
+
+    failed = 0
+    counts = alert_queue.counts()
+    enqueue_latencies.sort()
+    print(f"Queued {args.alerts} alerts ({total} deliveries) in {enqueued:.2f}s; enqueue latency "
+          f"p50 {statistics.median(enqueue_latencies) * 1000:.2f} ms, "
+          f"p99 {enqueue_latencies[int(len(enqueue_latencies) * 0.99) - 1] * 1000:.2f} ms")
+    print(f"Dispatched in {elapsed:.2f}s ({total / elapsed:.0f} deliveries/s)")
+    for channel, statuses in sorted(counts.items()):
+        provider = providers[channel]
+        delivered = Counter(item['transaction_id'] for item in provider.sent)
+        duplicates = sum(1 for count in delivered.values() if count > 1)
+        print(f"  {channel:6s} queued {expected[channel]:5d}  sent {statuses.get('sent', 0):5d}  "
+              f"failed {statuses.get('failed', 0):4d}  pending {statuses.get('pending', 0) + statuses.get('sending', 0):4d}  "
+              f"provider errors {provider.failures:5d}  duplicates {duplicates}")
+        if sum(statuses.values()) != expected[channel] or statuses.get('sent', 0) != len(provider.sent) \
+                or statuses.get('failed', 0) + statuses.get('sent', 0) != expected[channel] or duplicates:
+            print(f"MISMATCH on {channel}")
+            failed = 1
+
+    # Rate limit: no window of one second holds more SMS sends than the rate allows (+1 for the burst)
+    sms_times.sort()
+    window_max, j = 0, 0
+    for i, sent_at in enumerate(sms_times):
+        while sent_at - sms_times[j] >= 1.0:
+            j += 1
+        window_max = max(window_max, i - j + 1)
+    print(f"SMS sends in any 1s window: {window_max} (limit {args.sms_rate:g}/s)")
+    if window_max > args.sms_rate + 1:
+        print("RATE LIMIT EXCEEDED")
+        failed = 1
+
+    # A job claimed by a worker that died is delivered after its lease expires
+    alert_queue.enqueue('user_crash', {'transaction_id': 'crash-test', 'transaction_details': {}}, 'low', ['push'])
+    abandoned = alert_queue.claim('push', lease=0.0)
+    providers['push'].failure_rate = 0.0
+    recovery = AlertDispatcher(alert_queue, providers, recipients=lambda *a: 'push:user_crash', workers=1)
+    time.sleep(0.01)
+    requeued = alert_queue.requeue_expired()
+    recovery.run_once('push')
+    recovered = any(item['transaction_id'] == 'crash-test' for item in providers['push'].sent)
+    print(f"Abandoned job {abandoned.id if abandoned else None}: requeued {requeued}, delivered {recovered}")
+    if not recovered:
+        failed = 1
+
+    if not check_coalescing(tmp_dir, args.coalesce_window):
+        failed = 1
+
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    if not failed:
+        print("OK: every alert was delivered once or failed after its retries")
+    return failed
+
+
+if __name__ == "__main__":
+    sys.exit(main())
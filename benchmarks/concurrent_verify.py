@@ -0,0 +1,144 @@
+"""
+Concurrent profile-update check.
+
+Runs many threads that verify transactions for a handful of users at the same time,
+through the same statements as FraudDetectionSystem.update_user_profile, then checks
+that no update was lost: every user's transaction count, profile counters and average
+amount must match what was written. Reports throughput. Exits non-zero on a mismatch.
+
+    python benchmarks/concurrent_verify.py                        # temporary SQLite file
+    python benchmarks/concurrent_verify.py --url mysql+pymysql://user:pw@host/fraud_bench --threads 32
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, func, select  # noqa: E402
+from sqlalchemy.exc import OperationalError  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+from database import Base, Transaction, UserFeatures, UserProfile, UserProfileValue, configure_sqlite  # noqa: E402
+from feature_store import ensure_user, record_profile, record_transaction  # noqa: E402
+
+LOCATIONS = ['Vietnam', 'Singapore', 'Japan']
+DEVICES = ['device_a', 'device_b']
+
+
+def verify(session_factory, user_id: str, amount: float, rng: random.Random, retries: int = 5):
+    """Write one verified transaction the way update_user_profile does, retrying on deadlock/lock timeout"""
+    transaction_data = {
+        'transaction_id': str(uuid.uuid4()),
+        'user_id': user_id,
+        'amount': amount,
+        'category': rng.choice(['food', 'travel']),
+        'timestamp': datetime.now() - timedelta(minutes=rng.randint(0, 600)),
+        'ip_address': f"203.0.113.{rng.randint(1, 4)}",
+        'geolocation': rng.choice(LOCATIONS),
+        'device_id': rng.choice(DEVICES),
+    }
+    for attempt in range(retries):
+        db = session_factory()
+        try:
+            ensure_user(db, user_id)
+            db.add(Transaction(**transaction_data))
+            db.flush()
+            record_transaction(db, user_id, amount, transaction_data['timestamp'])
+            record_profile(db, user_id, transaction_data)
+            db.commit()
+            return
+        except OperationalError:
+            db.rollback()
+            if attempt == retries - 1:
+                raise
+            time.sleep(0.01 * (attempt + 1))
+        finally:
+            db.close()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--url', help='Database URL (default: a temporary SQLite file). Use a scratch database.')
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--per-thread', type=int, default=50, help='Verifications per thread')
+    parser.add_argument('--users', type=int, default=3, help='Users the threads contend on')
+    args = parser.parse_args(argv)
+
+    tmp_dir = None
+    url = args.url
+    if url is None:
+        tmp_dir = tempfile.mkdtemp(prefix='concurrent_verify_')
+        url = f"sqlite:///{os.path.join(tmp_dir, 'bench.db')}"
+    engine = create_engine(url, pool_size=args.threads, connect_args={'check_same_thread': False} if url.startswith('sqlite') else {})
+    if engine.dialect.name == 'sqlite':
+        configure_sqlite(engine)
+    Base.metadata.create_all(bind=engine)
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    run_id = uuid.uuid4().hex[:8]
+    user_ids = [f"concurrent_{run_id}_{i}" for i in range(args.users)]
+    written = {user_id: [] for user_id in user_ids}
+    lock = threading.Lock()
+    errors = []
+
+    def worker(seed: int):
+        rng = random.Random(seed)
+        try:
+            for _ in range(args.per_thread):
+                user_id = rng.choice(user_ids)
+                amount = float(rng.randint(1, 1000) * 1000)
+                verify(session_factory, user_id, amount, rng)
+                with lock:
+                    written[user_id].append(amount)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.threads)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    total = sum(len(amounts) for amounts in written.values())
+    print(f"{total} verifications from {args.threads} threads in {elapsed:.2f}s ({total / elapsed:.0f}/s)")
+
+    failures = [f"worker error: {e!r}" for e in errors]
+    with session_factory() as db:
+        for user_id, amounts in written.items():
+            if not amounts:
+                continue
+            features = db.get(UserFeatures, user_id)
+            profile = db.get(UserProfile, user_id)
+            location_total = db.execute(select(func.sum(UserProfileValue.count)).where(
+                UserProfileValue.user_id == user_id, UserProfileValue.attribute == 'location'
+            )).scalar()
+            expected_avg = sum(amounts) / len(amounts)
+            if features is None or features.transaction_count != len(amounts):
+                failures.append(f"{user_id}: transaction_count {features and features.transaction_count} != {len(amounts)}")
+            if location_total != len(amounts):
+                failures.append(f"{user_id}: location counters sum to {location_total}, expected {len(amounts)}")
+            if profile is None or abs(profile.avg_transaction_amount - expected_avg) > 1e-6 * expected_avg:
+                failures.append(f"{user_id}: avg_transaction_amount {profile and profile.avg_transaction_amount} != {expected_avg}")
+
+    engine.dispose()
+    if tmp_dir:
+        os.remove(os.path.join(tmp_dir, 'bench.db'))
+        os.rmdir(tmp_dir)
+    for failure in failures:
+        print(f"LOST UPDATE {failure}")
+    if not failures:
+        print("ok: no lost updates")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
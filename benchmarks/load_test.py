@@ -0,0 +1,391 @@
+"""
+End-to-end load benchmark for the HTTP API.
+
+Replays transactions from training_data.json (or generated ones) against the API at a
+fixed concurrency (closed loop) or a fixed arrival rate (open loop, latency measured
+from each request's scheduled start), and reports throughput, p50/p95/p99 latency and
+error rate per endpoint. By default it runs fully offline: it starts the stub LLM
+(benchmarks/stub_llm.py) and the API on the embedded SQLite backend in a scratch
+directory. The run exits non-zero when an endpoint's error rate exceeds
+--max-error-rate; the default concurrency is high enough to surface write-lock
+contention on SQLite. Results are written as JSON and can be compared with a previous run:
+
+    python benchmarks/load_test.py --requests 500 --concurrency 32 --output results.json
+    python benchmarks/load_test.py --app flask --workers 4 --rate 50 --duration 60
+    python benchmarks/load_test.py --compare baseline.json --fail-on-regression 10
+    python benchmarks/load_test.py --url http://127.0.0.1:8000      # an already running API
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Optional
+
+import requests
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from benchmarks import stub_llm  # noqa: E402
+
+ENDPOINTS = ('process-transaction', 'verify-transaction', 'get_user_profile')
+
+
+class Sample(NamedTuple):
+    endpoint: str
+    seconds: float
+    ok: bool
+
+
+def load_transactions(path: Optional[str], generate: int, seed: int) -> List[Dict]:
+    if generate:
+        from generate_training_data import generate_training_data
+        transactions = generate_training_data(generate)
+    else:
+        with open(path or os.path.join(REPO_DIR, 'training_data.json')) as f:
+            transactions = json.load(f)['training_data']
+    transactions = [dict(t) for t in transactions]
+    random.Random(seed).shuffle(transactions)
+    return transactions
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """Nearest-rank percentile of an ascending list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(q / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(samples: List[Sample], elapsed: float) -> Dict:
+    latencies = sorted(sample.seconds for sample in samples)
+    errors = sum(not sample.ok for sample in samples)
+    return {
+        'requests': len(samples),
+        'errors': errors,
+        'error_rate': errors / len(samples) if samples else 0.0,
+        'throughput_rps': len(samples) / elapsed if elapsed else 0.0,
+        'mean_ms': sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': latencies[-1] * 1000 if latencies else 0.0,
+    }
+
+
+class LoadRunner:
+    """Sends one transaction per iteration, optionally followed by a verification and a profile read"""
+
+    def __init__(self, base_url: str, transactions: List[Dict], verify_ratio: float, profile_ratio: float,
+                 timeout: float, seed: int):
+        self.base_url = base_url.rstrip('/')
+        self._transactions = itertools.cycle(transactions)
+        self.verify_ratio = verify_ratio
+        self.profile_ratio = profile_ratio
+        self.timeout = timeout
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.samples: List[Sample] = []
+
+    def _session(self) -> requests.Session:
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def _next(self):
+        with self._lock:
+            transaction = dict(next(self._transactions))
+            return transaction, self._random.random(), self._random.random()
+
+    def _call(self, endpoint: str, method: str, path: str, started: Optional[float] = None, **kwargs) -> Optional[Dict]:
+        started = time.perf_counter() if started is None else started
+        body = None
+        try:
+            response = self._session().request(method, self.base_url + path, timeout=self.timeout, **kwargs)
+            # A profile only exists once one of the user's transactions was verified
+            ok = response.status_code < 400 or (endpoint == 'get_user_profile' and response.status_code == 404)
+            if response.status_code < 400 and endpoint == 'process-transaction':
+                body = response.json()
+                # The service answers 200 with an error result when processing itself failed
+                ok = not any(str(reason).startswith('Error processing transaction')
+                             for reason in body.get('data', {}).get('reasons', []))
+        except requests.RequestException:
+            ok = False
+        sample = Sample(endpoint, time.perf_counter() - started, ok)
+        with self._lock:
+            self.samples.append(sample)
+        return body if ok else None
+
+    def iteration(self, scheduled: Optional[float] = None):
+        transaction, verify_draw, profile_draw = self._next()
+        is_fraud = transaction.pop('is_fraud', False)
+        transaction['transaction_id'] = str(uuid.uuid4())
+        result = self._call('process-transaction', 'POST', '/api/v1/process-transaction',
+                            started=scheduled, json=transaction)
+        if result is not None and verify_draw < self.verify_ratio:
+            self._call('verify-transaction', 'POST', '/api/v1/verify-transaction', json={
+                'transaction_id': transaction['transaction_id'],
+                'user_id': transaction['user_id'],
+                'is_legitimate': not is_fraud,
+            })
+        if profile_draw < self.profile_ratio:
+            self._call('get_user_profile', 'GET', f"/api/v1/get_user_profile/{transaction['user_id']}")
+
+    def run_closed_loop(self, concurrency: int, requests_total: Optional[int], duration: Optional[float]):
+        counter = itertools.count()
+        deadline = time.perf_counter() + duration if duration else None
+
+        def worker():
+            while True:
+                if deadline is not None and time.perf_counter() >= deadline:
+                    return
+                if requests_total is not None and next(counter) >= requests_total:
+                    return
+                self.iteration()
+
+        threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def run_open_loop(self, rate: float, requests_total: Optional[int], duration: Optional[float], max_in_flight: int):
+        total = requests_total if requests_total is not None else int(rate * duration)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            for i in range(total):
+                scheduled = started + i / rate
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(self.iteration, scheduled)
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class LocalService:
+    """The API on an embedded SQLite database in a scratch directory, talking to the stub LLM"""
+
+    def __init__(self, app: str, workers: int, llm_url: str, extra_env: Dict[str, str]):
+        self.app = app
+        self.workers = workers
+        self.port = _free_port()
+        self.work_dir = tempfile.mkdtemp(prefix='load_test_')
+        self.env = {key: value for key, value in os.environ.items()
+                    if key not in ('DATABASE_URL', 'DATABASE_READ_URL', 'DB_READ_HOST')}
+        self.env.update({
+            'PYTHONPATH': REPO_DIR,
+            'DB_BACKEND': 'sqlite',
+            'SQLITE_PATH': os.path.join(self.work_dir, 'bench.db'),
+            'OPENAI_BASE_URL': llm_url,
+            'OPENAI_API_KEY': 'stub',
+            'OPENAI_MODEL': 'stub',
+            'BLOCKLIST_SOURCE': 'none',
+            'BLOCKLIST_SNAPSHOT_PATH': os.path.join(self.work_dir, 'blocklist_snapshot.json'),
+            'BLOCKLIST_INDEX_PATH': os.path.join(self.work_dir, 'blocklist.idx'),
+            'ANALYSIS_JOURNAL_DIR': os.path.join(self.work_dir, 'analysis_journal'),
+            'LOG_LEVEL': 'WARNING',
+            'LOG_FILE': 'none',
+        })
+        self.env.update(extra_env)
+        self.process = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def start(self, timeout: float = 180.0):
+        # Create the schema once, before several workers race to do it
+        subprocess.run([sys.executable, os.path.join(REPO_DIR, 'database.py')], cwd=self.work_dir,
+                       env=self.env, check=True, stdout=subprocess.DEVNULL)
+        if self.app == 'asgi':
+            command = [sys.executable, '-m', 'uvicorn', 'asgi:app', '--app-dir', REPO_DIR,
+                       '--host', '127.0.0.1', '--port', str(self.port), '--workers', str(self.workers),
+                       '--log-level', 'warning']
+        else:
+            command = [sys.executable, '-m', 'gunicorn', '--pythonpath', REPO_DIR, '-w', str(self.workers),
+                       '-b', f"127.0.0.1:{self.port}", '--log-level', 'warning', 'api:app']
+        self.process = subprocess.Popen(command, cwd=self.work_dir, env=self.env)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"API server exited with code {self.process.returncode}")
+            try:
+                if requests.get(self.base_url + '/metrics', timeout=1).status_code == 200:
+                    return
+            except requests.RequestException:
+                pass
+            time.sleep(0.5)
+        raise RuntimeError(f"API server did not become ready within {timeout:.0f}s")
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(30)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+def compare(results: Dict, baseline: Dict, max_regression: Optional[float]) -> int:
+    """Print the change of each endpoint's metrics against a baseline run; 1 if p95 regressed too much"""
+    print(f"\nCompared with {baseline.get('git_commit') or 'baseline'} ({baseline.get('timestamp')}):")
+    failed = 0
+    for endpoint, stats in results['endpoints'].items():
+        before = baseline.get('endpoints', {}).get(endpoint)
+        if not before:
+            continue
+        changes = []
+        for key in ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms', 'error_rate'):
+            old, new = before.get(key, 0.0), stats[key]
+            delta = (new - old) / old * 100 if old else 0.0
+            changes.append(f"{key} {old:.3g} -> {new:.3g} ({delta:+.1f}%)")
+        print(f"  {endpoint:22s} " + ', '.join(changes))
+        p95_change = (stats['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100 if before.get('p95_ms') else 0.0
+        if max_regression is not None and p95_change > max_regression:
+            print(f"  REGRESSION {endpoint}: p95 +{p95_change:.1f}% exceeds {max_regression:.1f}%")
+            failed = 1
+    return failed
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    target = parser.add_argument_group('target')
+    target.add_argument('--url', help='Benchmark an already running API instead of starting one')
+    target.add_argument('--app', choices=['asgi', 'flask'], default='asgi', help='API to start (uvicorn asgi:app or gunicorn api:app)')
+    target.add_argument('--workers', type=int, default=1)
+    stub_llm.add_arguments(target, 'llm-', latency_ms=500.0, jitter_ms=100.0)
+    target.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help='Extra environment for the started API (e.g. ANALYSIS_WRITE_BEHIND=true)')
+    load = parser.add_argument_group('load')
+    load.add_argument('--data', help='Transactions file (default: training_data.json)')
+    load.add_argument('--generate', type=int, default=0, help='Generate this many transactions instead of reading --data')
+    load.add_argument('--concurrency', type=int, default=16,
+                      help='Closed loop: requests in flight (lower values can hide lock contention)')
+    load.add_argument('--rate', type=float, help='Open loop: transactions per second (overrides --concurrency)')
+    load.add_argument('--max-in-flight', type=int, default=512, help='Open loop: client threads')
+    load.add_argument('--requests', type=int, help='Transactions to send (default 500 unless --duration)')
+    load.add_argument('--duration', type=float, help='Seconds to run')
+    load.add_argument('--warmup', type=int, default=20, help='Transactions sent first and left out of the results')
+    load.add_argument('--verify-ratio', type=float, default=0.2, help='Share of transactions followed by a verification')
+    load.add_argument('--profile-ratio', type=float, default=0.1, help='Share of transactions followed by a profile read')
+    load.add_argument('--timeout', type=float, default=60.0)
+    load.add_argument('--seed', type=int, default=42)
+    output = parser.add_argument_group('output')
+    output.add_argument('--output', help='Write the results as JSON to this file')
+    output.add_argument('--compare', help='Results JSON of a previous run to compare with')
+    output.add_argument('--fail-on-regression', type=float, metavar='PCT',
+                        help='With --compare, exit non-zero if any endpoint p95 grew by more than PCT percent')
+    output.add_argument('--max-error-rate', type=float, default=0.01,
+                        help='Exit non-zero if any endpoint fails more than this share of requests')
+    args = parser.parse_args(argv)
+    if args.requests is None and args.duration is None:
+        args.requests = 500
+
+    transactions = load_transactions(args.data, args.generate, args.seed)
+    stub = service = None
+    try:
+        if args.url:
+            base_url = args.url
+        else:
+            stub = stub_llm.StubLLMServer.from_args(args, 'llm-', seed=args.seed).start()
+            extra_env = dict(item.split('=', 1) for item in args.env)
+            service = LocalService(args.app, args.workers, stub.base_url, extra_env)
+            print(f"Starting {args.app} API ({args.workers} worker(s)) on SQLite in {service.work_dir} ...")
+            service.start()
+            base_url = service.base_url
+
+        if args.warmup:
+            warmup = LoadRunner(base_url, transactions, 0.0, 0.0, args.timeout, args.seed + 1)
+            warmup.run_closed_loop(min(args.concurrency, args.warmup), args.warmup, None)
+
+        runner = LoadRunner(base_url, transactions, args.verify_ratio, args.profile_ratio, args.timeout, args.seed)
+        started = time.perf_counter()
+        if args.rate:
+            runner.run_open_loop(args.rate, args.requests, args.duration, args.max_in_flight)
+        else:
+            runner.run_closed_loop(args.concurrency, args.requests, args.duration)
+        elapsed = time.perf_counter() - started
+    finally:
+        if service is not None:
+            service.stop()
+        if stub is not None:
+            stub.stop()
+
+    results = {
+        'benchmark': 'load_test',
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'git_commit': _git_commit(),
+        'config': {
+            'target': args.url or f"local {args.app}",
+            'workers': None if args.url else args.workers,
+            'mode': 'open' if args.rate else 'closed',
+            'rate': args.rate,
+            'concurrency': None if args.rate else args.concurrency,
+            'requests': args.requests,
+            'duration': args.duration,
+            'llm': None if args.url else {
+                key[len('llm_'):]: value for key, value in vars(args).items() if key.startswith('llm_')
+            },
+            'verify_ratio': args.verify_ratio,
+            'profile_ratio': args.profile_ratio,
+            'env': args.env,
+        },
+        'elapsed_seconds': elapsed,
+        'endpoints': {
+            endpoint: summarize([s for s in runner.samples if s.endpoint == endpoint], elapsed)
+            for endpoint in ENDPOINTS if any(s.endpoint == endpoint for s in runner.samples)
+        },
+        'total': summarize(runner.samples, elapsed),
+        'llm': stub.stats() if stub is not None else None,
+    }
+
+    print(f"\n{'endpoint':22s} {'requests':>8s} {'rps':>8s} {'p50 ms':>9s} {'p95 ms':>9s} {'p99 ms':>9s} {'errors':>7s}")
+    for endpoint, stats in list(results['endpoints'].items()) + [('total', results['total'])]:
+        print(f"{endpoint:22s} {stats['requests']:8d} {stats['throughput_rps']:8.1f} {stats['p50_ms']:9.1f} "
+              f"{stats['p95_ms']:9.1f} {stats['p99_ms']:9.1f} {stats['error_rate']:7.1%}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.output}")
+    failed = 0
+    for endpoint, stats in results['endpoints'].items():
+        if stats['error_rate'] > args.max_error_rate:
+            print(f"  ERRORS {endpoint}: {stats['error_rate']:.1%} exceeds {args.max_error_rate:.1%}")
+            failed = 1
+    if args.compare:
+        with open(args.compare) as f:
+            failed |= compare(results, json.load(f), args.fail_on_regression)
+    return failed
+
+
+if __name__ == "__main__":
+    sys.exit(main())
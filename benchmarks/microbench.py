@@ -0,0 +1,320 @@
+"""
+Component microbenchmarks for FraudDetectionSystem internals.
+
+Times each building block of transaction processing in isolation: the `_check_*` rules,
+`_get_user_profile` and `update_user_profile` on small, medium and very large user
+profiles, `predict_with_model` on one row and the model on a batch, IP blocklist lookups
+on large compiled blocklists, LLM prompt construction and LLM response parsing.
+
+Every benchmark is calibrated to run for at least --min-time per repeat (garbage
+collection off, as with timeit) and reports the median, minimum and interquartile range
+of the per-call time over --repeats repeats. Results are written as JSON and can be
+compared with a previous run, failing when a component's median regressed by more than
+the threshold:
+
+    python benchmarks/microbench.py --output baseline.json
+    python benchmarks/microbench.py --filter rules. --compare baseline.json --threshold 10
+    python benchmarks/microbench.py --quick                      # smaller fixtures
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import timeit
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+# Keep the system under test quiet and offline; must be set before it is imported
+os.environ.setdefault('LOG_LEVEL', 'ERROR')
+os.environ.setdefault('LOG_FILE', 'none')
+os.environ['BLOCKLIST_SOURCE'] = 'none'
+os.environ.setdefault('OPENAI_API_KEY', 'microbench')
+
+import pandas as pd  # noqa: E402
+from sqlalchemy import create_engine, insert  # noqa: E402
+from sqlalchemy.orm import Session, sessionmaker  # noqa: E402
+
+from benchmarks.load_test import _git_commit  # noqa: E402
+from benchmarks.stub_llm import fake_analysis  # noqa: E402
+from database import Base, Transaction, User, UserProfile, UserProfileValue, configure_sqlite  # noqa: E402
+from feature_store import get_user_features, rebuild_user_features  # noqa: E402
+from ip_reputation import IPReputationIndex  # noqa: E402
+
+PROFILE_SIZES = {'small': 20, 'medium': 1000, 'large': 50000}
+QUICK_PROFILE_SIZES = {'small': 20, 'medium': 500, 'large': 5000}
+BLOCKLIST_SIZES = [10000, 1000000]
+QUICK_BLOCKLIST_SIZES = [10000, 100000]
+MODEL_FEATURES = ['amount', 'hour', 'currency', 'description', 'category', 'ip_address', 'geolocation', 'device_id']
+
+LOCATIONS = ['Vietnam', 'Singapore', 'Japan', 'Thailand', 'Korea', 'United States', 'Germany', 'France']
+CATEGORIES = ['food', 'travel', 'electronics', 'fashion', 'entertainment', 'health', 'education', 'utilities']
+
+
+class Result(NamedTuple):
+    name: str
+    loops: int
+    median_s: float
+    min_s: float
+    iqr_s: float
+
+    def to_dict(self) -> Dict:
+        return {
+            'loops': self.loops,
+            'median_us': self.median_s * 1e6,
+            'min_us': self.min_s * 1e6,
+            'iqr_us': self.iqr_s * 1e6,
+            'rel_iqr': self.iqr_s / self.median_s if self.median_s else 0.0,
+        }
+
+
+def measure(name: str, func: Callable[[], object], min_time: float, repeats: int) -> Result:
+    """Per-call time of `func`: loops calibrated to last `min_time`, then `repeats` timed repeats"""
+    timer = timeit.Timer(func)
+    func()  # warm caches and lazily built state
+    loops = 1
+    while True:
+        elapsed = timer.timeit(loops)
+        if elapsed >= min_time or loops >= 1 << 20:
+            break
+        loops = max(loops * 2, int(loops * min_time / elapsed * 1.1)) if elapsed > 0 else loops * 10
+    per_call = sorted(timer.timeit(loops) / loops for _ in range(repeats))
+    quartiles = statistics.quantiles(per_call, n=4) if len(per_call) > 1 else [per_call[0]] * 3
+    return Result(name, loops, statistics.median(per_call), per_call[0], quartiles[2] - quartiles[0])
+
+
+def make_transaction(rng: random.Random, user_id: str, distinct: int, timestamp: Optional[datetime] = None) -> Dict:
+    """A transaction drawing its location, device, category and IP from `distinct` values per attribute"""
+    return {
+        'transaction_id': str(uuid.uuid4()),
+        'user_id': user_id,
+        'amount': round(rng.lognormvariate(12, 1), 2),
+        'currency': 'VND',
+        'description': f"Purchase {rng.randint(1, 50)}",
+        'category': CATEGORIES[rng.randrange(min(distinct, len(CATEGORIES)))],
+        'timestamp': timestamp or datetime.now() - timedelta(minutes=rng.randint(0, 60 * 24 * 365)),
+        'ip_address': f"198.51.{rng.randrange(distinct) // 256}.{rng.randrange(distinct) % 256}",
+        'geolocation': LOCATIONS[rng.randrange(min(distinct, len(LOCATIONS)))],
+        'device_id': f"device_{rng.randrange(distinct)}",
+    }
+
+
+def seed_profile(db: Session, rng: random.Random, user_id: str, transactions: int):
+    """Bulk-write a user with `transactions` verified transactions and the matching profile and features"""
+    distinct = max(3, int(transactions ** 0.5))
+    rows = [make_transaction(rng, user_id, distinct) for _ in range(transactions)]
+    db.execute(insert(User), [{'user_id': user_id, 'created_at': datetime.now()}])
+    for start in range(0, len(rows), 5000):
+        db.execute(insert(Transaction), rows[start:start + 5000])
+
+    counts, last_seen = Counter(), {}
+    for row in rows:
+        for attribute, value in (('location', row['geolocation']), ('device', row['device_id']),
+                                 ('category', row['category']), ('ip_address', row['ip_address']),
+                                 ('hour', str(row['timestamp'].hour))):
+            counts[attribute, value] += 1
+            last_seen[attribute, value] = max(last_seen.get((attribute, value), row['timestamp']), row['timestamp'])
+    db.execute(insert(UserProfileValue), [
+        {'user_id': user_id, 'attribute': attribute, 'value': value, 'count': count,
+         'last_seen_at': last_seen[attribute, value]}
+        for (attribute, value), count in counts.items()
+    ])
+    db.execute(insert(UserProfile), [{
+        'user_id': user_id,
+        'avg_transaction_amount': sum(row['amount'] for row in rows) / len(rows),
+        'last_updated': datetime.now(),
+    }])
+    rebuild_user_features(db, user_id)
+    db.commit()
+
+
+def build_blocklist(rng: random.Random, size: int, path: str) -> IPReputationIndex:
+    """A compiled, memory-mapped index of `size` entries (mostly single addresses, some /24 and /16 blocks)"""
+    entries = []
+    for _ in range(size):
+        address = rng.getrandbits(32)
+        kind = rng.random()
+        if kind < 0.9:
+            value = f"{address >> 24}.{address >> 16 & 255}.{address >> 8 & 255}.{address & 255}"
+        elif kind < 0.99:
+            value = f"{address >> 24}.{address >> 16 & 255}.{address >> 8 & 255}.0/24"
+        else:
+            value = f"{address >> 24}.{address >> 16 & 255}.0.0/16"
+        entries.append((value, rng.randint(50, 100), 'VN'))
+    IPReputationIndex(entries).save(path)
+    return IPReputationIndex.load(path)
+
+
+def model_frame(transactions: List[Dict]) -> pd.DataFrame:
+    """Feature frame prepared the way predict_with_model prepares a single row"""
+    df = pd.DataFrame(transactions)
+    df['hour'] = pd.to_datetime(df['timestamp']).dt.hour
+    return df[MODEL_FEATURES]
+
+
+def run_suite(args) -> List[Result]:
+    from agent import FraudDetectionSystem
+    from generate_training_data import generate_training_data
+
+    profile_sizes = QUICK_PROFILE_SIZES if args.quick else PROFILE_SIZES
+    blocklist_sizes = QUICK_BLOCKLIST_SIZES if args.quick else BLOCKLIST_SIZES
+    rng = random.Random(args.seed)
+    results = []
+
+    def bench(name: str, func: Callable[[], object]):
+        if args.filter and not any(pattern in name for pattern in args.filter):
+            return
+        result = measure(name, func, args.min_time, args.repeats)
+        results.append(result)
+        print(f"{name:48s} {result.median_s * 1e6:12.1f} us  (min {result.min_s * 1e6:.1f}, "
+              f"iqr {result.iqr_s / result.median_s:.1%}, {result.loops} loops)")
+
+    def wanted(prefix: str) -> bool:
+        return not args.filter or any(pattern in prefix or prefix in pattern for pattern in args.filter)
+
+    work_dir = tempfile.mkdtemp(prefix='microbench_')
+    cwd = os.getcwd()
+    try:
+        # train_model saves the model to the working directory
+        os.chdir(work_dir)
+        os.environ['BLOCKLIST_SNAPSHOT_PATH'] = os.path.join(work_dir, 'blocklist_snapshot.json')
+        os.environ['BLOCKLIST_INDEX_PATH'] = os.path.join(work_dir, 'blocklist.idx')
+        system = FraudDetectionSystem()
+        system.blocklist.stop()
+
+        engine = create_engine(f"sqlite:///{os.path.join(work_dir, 'bench.db')}")
+        configure_sqlite(engine)
+        Base.metadata.create_all(engine)
+        SessionLocal = sessionmaker(bind=engine)
+
+        users = {}
+        with SessionLocal() as db:
+            for label, size in profile_sizes.items():
+                if not (wanted('rules.') or wanted('profile.') or wanted('ai.build')):
+                    break
+                users[label] = f"bench_{label}"
+                print(f"Seeding {label} profile ({size} transactions) ...")
+                seed_profile(db, rng, users[label], size)
+
+        db = SessionLocal()
+        now = datetime.now().replace(hour=3)  # inside the suspicious-hours window, so _check_time reads the profile
+        for label, user_id in users.items():
+            distinct = max(3, int(profile_sizes[label] ** 0.5))
+            transaction = make_transaction(rng, user_id, distinct, now)
+            features = get_user_features(db, user_id, now)
+            checks = {
+                'ip_address': lambda: system._check_ip_address(db, user_id, transaction['ip_address']),
+                'location': lambda: system._check_location(db, user_id, transaction['geolocation'], transaction['ip_address']),
+                'amount': lambda: system._check_amount(db, user_id, transaction['amount']),
+                'category': lambda: system._check_category(db, user_id, transaction['category']),
+                'time': lambda: system._check_time(db, user_id, transaction['timestamp']),
+                'frequency': lambda: system._check_frequency(db, user_id, transaction['timestamp'], features),
+                'frequency_scan': lambda: system._check_frequency(db, user_id, transaction['timestamp']),
+                'device': lambda: system._check_device(db, user_id, transaction['device_id']),
+            }
+            for check, func in checks.items():
+                bench(f"rules.{check}[{label}]", func)
+            bench(f"profile.get_user_profile[{label}]", lambda: system._get_user_profile(db, user_id))
+
+            if wanted('ai.'):
+                profile = system._get_user_profile(db, user_id)
+                profile['features'] = features
+                bench(f"ai.build_prompt[{label}]", lambda: system._build_ai_messages(transaction, profile))
+
+            # Last: every call adds a transaction to the profile
+            def verify():
+                update = make_transaction(rng, user_id, distinct)
+                system.update_user_profile(db, user_id, update)
+            bench(f"profile.update_user_profile[{label}]", verify)
+        db.close()
+
+        if wanted('model.'):
+            training = generate_training_data(args.training_rows)
+            system.train_model(None, training)
+            transaction = make_transaction(rng, 'bench_model', 20)
+            bench('model.predict_single', lambda: system.predict_with_model(transaction))
+            batch = [make_transaction(rng, 'bench_model', 20) for _ in range(args.batch_size)]
+            bench(f"model.predict_batch[{args.batch_size}]",
+                  lambda: system.model.predict_proba(model_frame(batch))[:, 1])
+
+        if wanted('ai.parse'):
+            content = json.dumps(fake_analysis('microbench'))
+            bench('ai.parse_response', lambda: system._parse_ai_response(content))
+            wrapped = f"Here is the analysis:\n```json\n{content}\n```"
+            bench('ai.parse_response_wrapped', lambda: system._parse_ai_response(wrapped))
+
+        if wanted('blocklist.'):
+            for size in blocklist_sizes:
+                index = build_blocklist(rng, size, os.path.join(work_dir, f"blocklist_{size}.idx"))
+                probes = [f"{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(256)}"
+                          for _ in range(1000)]
+                probe = iter(probes * (1 << 12))
+                bench(f"blocklist.lookup[{size}]", lambda: index.lookup(next(probe)))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def compare(results: Dict, baseline: Dict, threshold: float) -> int:
+    """Print each benchmark's median change against a baseline; 1 if any regressed past the threshold"""
+    print(f"\nCompared with {baseline.get('git_commit') or 'baseline'} ({baseline.get('timestamp')}):")
+    failed = 0
+    for name, stats in results['benchmarks'].items():
+        before = baseline.get('benchmarks', {}).get(name)
+        if not before or not before.get('median_us'):
+            continue
+        change = (stats['median_us'] - before['median_us']) / before['median_us'] * 100
+        # A change inside the combined run-to-run spread is not reported as a regression
+        noise = (stats['rel_iqr'] + before.get('rel_iqr', 0.0)) * 100
+        regressed = change > threshold and change > noise
+        marker = 'REGRESSION' if regressed else ''
+        print(f"  {name:48s} {before['median_us']:12.1f} -> {stats['median_us']:12.1f} us ({change:+.1f}%) {marker}")
+        failed |= regressed
+    return int(failed)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--filter', action='append', default=[], help='Only run benchmarks whose name contains this (repeatable)')
+    parser.add_argument('--quick', action='store_true', help='Smaller profiles and blocklists')
+    parser.add_argument('--min-time', type=float, default=0.1, help='Seconds each timed repeat runs at least')
+    parser.add_argument('--repeats', type=int, default=7)
+    parser.add_argument('--batch-size', type=int, default=1000, help='Rows per model.predict_batch call')
+    parser.add_argument('--training-rows', type=int, default=2000, help='Generated transactions the model is trained on')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    parser.add_argument('--compare', help='Results JSON of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='With --compare, exit non-zero if a median grew by more than this percent (and beyond the noise)')
+    args = parser.parse_args(argv)
+
+    results = {
+        'benchmark': 'microbench',
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'git_commit': _git_commit(),
+        'config': {'quick': args.quick, 'min_time': args.min_time, 'repeats': args.repeats,
+                   'batch_size': args.batch_size, 'training_rows': args.training_rows, 'seed': args.seed},
+        'benchmarks': {result.name: result.to_dict() for result in run_suite(args)},
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            return compare(results, json.load(f), args.threshold)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,228 @@
+"""
+Query-plan regression benchmark for the hot per-user lookups.
+
+Seeds a synthetic dataset, applies the schema migrations, then checks with EXPLAIN
+that every hot query is answered through its intended index and reports its median
+latency. Exits non-zero if any plan uses a different index (or none), so it can run
+in CI against SQLite or against a MySQL database:
+
+    python benchmarks/query_plans.py                                  # temporary SQLite file
+    python benchmarks/query_plans.py --url mysql+pymysql://user:pw@host/fraud_bench --rows 1000000
+"""
+import argparse
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, func, insert, select, text  # noqa: E402
+from sqlalchemy.engine import Connection, Engine  # noqa: E402
+
+from alert_store import ALERT_STATUSES, alerts_query, encode_cursor  # noqa: E402
+from database import Alert, Base, Transaction, TransactionAnalysis, User, configure_sqlite  # noqa: E402
+from migrations import upgrade  # noqa: E402
+
+CATEGORIES = ['electronics', 'food', 'travel', 'fashion', 'entertainment', 'utilities']
+LOCATIONS = ['Vietnam', 'Singapore', 'Japan', 'United States', 'Thailand']
+
+
+class HotQuery(NamedTuple):
+    name: str
+    expected_index: str
+    build: Callable[[str, datetime], object]  # (user_id, now) -> statement
+
+
+# Mirrors the statements issued by the serving path (agent.py and api.py)
+HOT_QUERIES: List[HotQuery] = [
+    HotQuery(
+        'transaction_history', 'idx_transactions_user_timestamp',
+        lambda user_id, now: select(Transaction).where(Transaction.user_id == user_id)
+        .order_by(Transaction.timestamp.desc()).limit(100)
+    ),
+    HotQuery(
+        'recent_transaction_count', 'idx_transactions_user_timestamp',
+        lambda user_id, now: select(func.count()).select_from(Transaction)
+        .where(Transaction.user_id == user_id, Transaction.timestamp >= now - timedelta(hours=1))
+    ),
+    HotQuery(
+        'analysis_history', 'idx_transaction_analyses_user_timestamp',
+        lambda user_id, now: select(TransactionAnalysis).where(TransactionAnalysis.user_id == user_id)
+        .order_by(TransactionAnalysis.timestamp.desc()).limit(10)
+    ),
+    HotQuery(
+        'user_alerts', 'idx_alerts_user_timestamp',
+        lambda user_id, now: select(Alert).where(Alert.user_id == user_id)
+        .order_by(Alert.timestamp.desc()).limit(20)
+    ),
+    HotQuery(
+        'open_alerts', 'idx_alerts_status_timestamp',
+        lambda user_id, now: select(Alert).where(Alert.status == 'new')
+        .order_by(Alert.timestamp.desc()).limit(50)
+    ),
+    # Deep keyset pages of the alerts API (alert_store.alerts_query)
+    HotQuery(
+        'user_alerts_page', 'idx_alerts_user_timestamp',
+        lambda user_id, now: alerts_query(user_id, cursor=encode_cursor(now - timedelta(days=30), 2 ** 31))
+    ),
+    HotQuery(
+        'open_alerts_page', 'idx_alerts_status_timestamp',
+        lambda user_id, now: alerts_query(status='new', cursor=encode_cursor(now - timedelta(days=30), 2 ** 31))
+    ),
+    HotQuery(
+        'alerts_feed_page', 'idx_alerts_timestamp',
+        lambda user_id, now: alerts_query(cursor=encode_cursor(now - timedelta(days=30), 2 ** 31))
+    ),
+]
+
+
+def seed(engine: Engine, users: int, rows: int, batch_size: int = 5000, seed_value: int = 42):
+    """Insert `users` users and `rows` transactions (plus analyses and alerts) with a skewed per-user volume"""
+    rng = random.Random(seed_value)
+    now = datetime.now()
+    user_ids = [f"bench_user_{i:06d}" for i in range(users)]
+    # A few heavy users make the per-user history lookups non-trivial
+    weights = [rng.paretovariate(1.2) for _ in user_ids]
+
+    with engine.begin() as connection:
+        connection.execute(insert(User), [{'user_id': user_id, 'created_at': now} for user_id in user_ids])
+
+    analysis_rows = max(1, rows // 2)
+    alert_rows = max(1, rows // 20)
+    for model, total in ((Transaction, rows), (TransactionAnalysis, analysis_rows), (Alert, alert_rows)):
+        for start in range(0, total, batch_size):
+            batch = []
+            for user_id in rng.choices(user_ids, weights=weights, k=min(batch_size, total - start)):
+                timestamp = now - timedelta(seconds=rng.randint(0, 180 * 86400))
+                if model is Alert:
+                    batch.append({
+                        'user_id': user_id,
+                        'timestamp': timestamp,
+                        'risk_score': rng.random(),
+                        'status': rng.choice(ALERT_STATUSES),
+                    })
+                    continue
+                row = {
+                    'transaction_id': str(uuid.uuid4()),
+                    'user_id': user_id,
+                    'amount': round(rng.lognormvariate(13, 1.2), 2),
+                    'currency': 'VND',
+                    'category': rng.choice(CATEGORIES),
+                    'timestamp': timestamp,
+                    'ip_address': f"203.0.{rng.randint(0, 255)}.{rng.randint(1, 254)}",
+                    'geolocation': rng.choice(LOCATIONS),
+                    'device_id': f"device_{rng.randint(0, 3)}_{user_id}",
+                }
+                if model is TransactionAnalysis:
+                    row['risk_score'] = rng.random()
+                    row['is_suspicious'] = row['risk_score'] > 0.7
+                batch.append(row)
+            with engine.begin() as connection:
+                connection.execute(insert(model), batch)
+
+    with engine.begin() as connection:
+        if engine.dialect.name == 'mysql':
+            for table in ('transactions', 'transaction_analyses', 'alerts'):
+                connection.execute(text(f"ANALYZE TABLE {table}"))
+        elif engine.dialect.name == 'sqlite':
+            connection.execute(text("ANALYZE"))
+    return user_ids, weights
+
+
+def _compile(connection: Connection, statement) -> str:
+    return str(statement.compile(dialect=connection.dialect, compile_kwargs={'literal_binds': True}))
+
+
+def used_indexes(connection: Connection, statement) -> List[str]:
+    """Names of the indexes the planner chose for `statement`"""
+    sql = _compile(connection, statement)
+    dialect = connection.dialect.name
+    if dialect == 'sqlite':
+        plan = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+        return [m.group(1) for row in plan for m in re.finditer(r'USING (?:COVERING )?INDEX (\w+)', row[-1])]
+    if dialect == 'mysql':
+        plan = connection.exec_driver_sql(f"EXPLAIN {sql}").mappings().fetchall()
+        return [row['key'] for row in plan if row.get('key')]
+    raise NotImplementedError(f"EXPLAIN parsing is not implemented for {dialect}")
+
+
+def median_latency_ms(connection: Connection, statement, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        connection.execute(statement).fetchall()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+def check_plans(engine: Engine, user_id: str, repeat: int = 20) -> Dict[str, Dict]:
+    now = datetime.now()
+    results = {}
+    with engine.connect() as connection:
+        for query in HOT_QUERIES:
+            statement = query.build(user_id, now)
+            indexes = used_indexes(connection, statement)
+            results[query.name] = {
+                'expected_index': query.expected_index,
+                'used_indexes': indexes,
+                'ok': query.expected_index in indexes,
+                'median_ms': median_latency_ms(connection, statement, repeat),
+            }
+    return results
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--url', help='Database URL to seed (default: a temporary SQLite file). Use a scratch database.')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--rows', type=int, default=200000, help='Number of transactions to seed')
+    parser.add_argument('--repeat', type=int, default=20, help='Executions per query for the latency median')
+    parser.add_argument('--skip-seed', action='store_true', help='Reuse data already seeded at --url')
+    args = parser.parse_args(argv)
+
+    tmp_dir = None
+    url = args.url
+    if url is None:
+        tmp_dir = tempfile.mkdtemp(prefix='query_plans_')
+        url = f"sqlite:///{os.path.join(tmp_dir, 'bench.db')}"
+    engine = create_engine(url)
+    if engine.dialect.name == 'sqlite':
+        configure_sqlite(engine)
+
+    Base.metadata.create_all(bind=engine)
+    upgrade(engine)
+    if args.skip_seed:
+        with engine.connect() as connection:
+            heavy_user = connection.execute(
+                select(Transaction.user_id).group_by(Transaction.user_id).order_by(func.count().desc()).limit(1)
+            ).scalar()
+    else:
+        started = time.perf_counter()
+        user_ids, weights = seed(engine, args.users, args.rows)
+        print(f"Seeded {args.rows} transactions for {args.users} users in {time.perf_counter() - started:.1f}s")
+        heavy_user = user_ids[max(range(len(user_ids)), key=weights.__getitem__)]
+
+    results = check_plans(engine, heavy_user, args.repeat)
+    failed = 0
+    for name, result in results.items():
+        status = 'ok' if result['ok'] else 'REGRESSION'
+        failed += not result['ok']
+        print(f"{status:10s} {name:26s} {result['median_ms']:8.2f} ms  "
+              f"expected {result['expected_index']}, used {', '.join(result['used_indexes']) or 'no index'}")
+
+    engine.dispose()
+    if tmp_dir:
+        os.remove(os.path.join(tmp_dir, 'bench.db'))
+        os.rmdir(tmp_dir)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
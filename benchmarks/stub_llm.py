@@ -0,0 +1,338 @@
+"""
+Offline stand-in for the OpenAI chat completions endpoint.
+
+Answers POST /v1/chat/completions with a verdict in the JSON format FRAUD_DETECTION_PROMPT
+asks for, derived from the prompt itself: each check compares the new transaction with
+the account profile in the prompt (known location, device, IP address, usual hours,
+average amount), so the same prompt always gets the same answer. The service can be
+load tested, and its timeout, retry and fallback paths exercised, without network
+access or API cost. Point the service at it with OPENAI_BASE_URL=http://127.0.0.1:<port>/v1.
+
+Latency follows a fixed, uniform, normal or lognormal distribution, and a share of the
+requests can be made to fail: 500 server errors, 429 rate limits (with Retry-After, also
+returned above --max-rps), malformed completions (truncated JSON, prose, missing fields)
+and hangs that outlast the client timeout. GET /stats returns what was served.
+
+    python benchmarks/stub_llm.py --port 8089 --latency-ms 800 --jitter-ms 200
+    python benchmarks/stub_llm.py --latency-dist lognormal --latency-ms 600 --sigma 0.8 \\
+        --error-rate 0.02 --rate-limit-rate 0.05 --malformed-rate 0.01 --max-rps 50
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+LATENCY_DISTRIBUTIONS = ('fixed', 'uniform', 'normal', 'lognormal')
+
+# JSON blocks of FRAUD_DETECTION_PROMPT, in order: account info, history, new transaction
+_JSON_BLOCK = re.compile(r'```\s*(.*?)\s*```', re.DOTALL)
+
+
+def _prompt_data(prompt: str):
+    blocks = []
+    for block in _JSON_BLOCK.findall(prompt):
+        try:
+            blocks.append(json.loads(block))
+        except ValueError:
+            blocks.append(None)
+    if len(blocks) < 3 or not isinstance(blocks[0], dict) or not isinstance(blocks[2], dict):
+        return None, None
+    return blocks[0].get('profile') or {}, blocks[2]
+
+
+def fake_analysis(prompt: str) -> Dict:
+    """Schema-valid verdict for a FRAUD_DETECTION_PROMPT (a hash-derived one for any other prompt)"""
+    profile, transaction = _prompt_data(prompt)
+    digest = hashlib.sha256(prompt.encode('utf-8')).digest()
+    details = []
+    if transaction is not None:
+        def known(value, values) -> bool:
+            return not values or value in values
+
+        hour = None
+        try:
+            hour = int(str(transaction.get('timestamp', ''))[11:13])
+        except ValueError:
+            pass
+        average = profile.get('avg_transaction_amount') or 0
+        amount = transaction.get('amount') or 0
+        checks = [
+            ('location_check', known(transaction.get('geolocation'), profile.get('common_locations')),
+             'In usual area', 'Location never seen for this account'),
+            ('device_check', known(transaction.get('device_id'), profile.get('common_devices')),
+             'Known device', 'New device detected'),
+            ('ip_check', known(transaction.get('ip_address'), profile.get('common_ip_addresses')),
+             'Known IP address', 'IP address does not match the usual patterns'),
+            ('time_check', hour is None or known(hour, profile.get('typical_transaction_hours')),
+             'Usual transaction hour', 'Transaction outside the usual hours'),
+            ('amount_check', not average or amount <= average * 2,
+             'Amount within normal range', 'Amount well above the account average'),
+        ]
+        for i, (check_type, usual, usual_message, unusual_message) in enumerate(checks):
+            details.append({
+                'fraud_score': (digest[i] % 20) + (10 if usual else 65),
+                'type': check_type,
+                'message': usual_message if usual else unusual_message,
+            })
+    else:
+        for i, check_type in enumerate(['amount_check', 'location_check', 'time_check'][:1 + digest[0] % 3]):
+            details.append({'fraud_score': digest[i + 1] % 100, 'type': check_type, 'message': f'Stub {check_type}'})
+
+    score = sum(detail['fraud_score'] for detail in details) / len(details)
+    suspicious = score >= 50
+    unusual = [detail['message'] for detail in details if detail['fraud_score'] >= 65]
+    return {
+        'fraud_score': score,
+        'fraud_decision': suspicious,
+        'fraud_reason': '; '.join(unusual) if unusual else 'Transaction consistent with the account history',
+        'fraud_details': details,
+        'fraud_suggestions': 'Contact user for confirmation' if suspicious else 'No action needed',
+        'fraud_alert': suspicious,
+        'fraud_alert_message': 'Potential fraud activity detected.' if suspicious else '',
+        'fraud_alert_details': '; '.join(unusual) if suspicious else '',
+        'fraud_alert_suggestions': 'Hold the transaction until verified' if suspicious else '',
+    }
+
+
+def malformed_content(analysis: Dict, rng: random.Random) -> str:
+    """A completion the service's parser must reject"""
+    text = json.dumps(analysis)
+    kind = rng.randrange(3)
+    if kind == 0:
+        return text[:len(text) // 2]  # truncated
+    if kind == 1:
+        return 'I am unable to determine whether this transaction is fraudulent.'  # no JSON at all
+    return json.dumps({key: value for key, value in analysis.items() if key != 'fraud_details'})  # missing field
+
+
+class StubLLMServer:
+    """Threaded HTTP server answering chat completions; usable in-process or standalone"""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency_ms: float = 500.0,
+                 jitter_ms: float = 0.0, seed: Optional[int] = None, latency_dist: str = 'uniform',
+                 sigma: float = 0.5, error_rate: float = 0.0, rate_limit_rate: float = 0.0,
+                 malformed_rate: float = 0.0, hang_rate: float = 0.0, hang_ms: float = 120000.0,
+                 max_rps: float = 0.0, retry_after: float = 1.0):
+        if latency_dist not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution: {latency_dist}")
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.latency_dist = latency_dist
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.malformed_rate = malformed_rate
+        self.hang_rate = hang_rate
+        self.hang_ms = hang_ms
+        self.max_rps = max_rps
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        # Token bucket for --max-rps
+        self._tokens = max_rps
+        self._refilled = time.monotonic()
+        self.requests = 0
+        self.outcomes = Counter()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.rstrip('/') == '/stats':
+                    self._send(200, server.stats())
+                else:
+                    self._send(404, {'error': {'message': 'not found'}})
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if not self.path.rstrip('/').endswith('/chat/completions'):
+                    self._send(404, {'error': {'message': 'not found'}})
+                    return
+                try:
+                    request = json.loads(body or b'{}')
+                except ValueError:
+                    self._send(400, {'error': {'message': 'invalid JSON', 'type': 'invalid_request_error'}})
+                    return
+                outcome, delay = server.plan()
+                if outcome == 'rate_limited':
+                    self._send(429, {'error': {'message': 'Rate limit reached for requests', 'type': 'requests',
+                                               'code': 'rate_limit_exceeded'}},
+                               {'Retry-After': f"{server.retry_after:g}"})
+                    return
+                time.sleep(delay)
+                if outcome == 'error':
+                    self._send(500, {'error': {'message': 'The server had an error while processing your request.',
+                                               'type': 'server_error'}})
+                    return
+                self._send(200, server.completion(request, malformed=outcome == 'malformed'))
+
+            def _send(self, status: int, payload: Dict, headers: Optional[Dict] = None):
+                data = json.dumps(payload).encode('utf-8')
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(data)))
+                    for name, value in (headers or {}).items():
+                        self.send_header(name, value)
+                    self.end_headers()
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # the client gave up (e.g. timed out on a hang)
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @classmethod
+    def from_args(cls, args, prefix: str = '', host: str = '127.0.0.1', port: int = 0,
+                  seed: Optional[int] = None) -> 'StubLLMServer':
+        """Server configured from the options added by `add_arguments` (with the same prefix)"""
+        option = lambda name: getattr(args, prefix.replace('-', '_') + name)  # noqa: E731
+        return cls(host, port, option('latency_ms'), option('jitter_ms'), seed,
+                   latency_dist=option('latency_dist'), sigma=option('sigma'),
+                   error_rate=option('error_rate'), rate_limit_rate=option('rate_limit_rate'),
+                   malformed_rate=option('malformed_rate'), hang_rate=option('hang_rate'),
+                   hang_ms=option('hang_ms'), max_rps=option('max_rps'), retry_after=option('retry_after'))
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def next_latency(self) -> float:
+        """Seconds the next completion takes, drawn from the configured distribution"""
+        with self._lock:
+            draw = self._random
+            if self.latency_dist == 'uniform':
+                latency = self.latency_ms + (draw.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0.0)
+            elif self.latency_dist == 'normal':
+                latency = draw.gauss(self.latency_ms, self.jitter_ms)
+            elif self.latency_dist == 'lognormal':
+                # latency_ms is the median; sigma sets the tail
+                latency = draw.lognormvariate(0.0, self.sigma) * self.latency_ms
+            else:
+                latency = self.latency_ms
+        return max(0.0, latency) / 1000
+
+    def _take_token(self) -> bool:
+        if not self.max_rps:
+            return True
+        now = time.monotonic()
+        self._tokens = min(self.max_rps, self._tokens + (now - self._refilled) * self.max_rps)
+        self._refilled = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def plan(self):
+        """(outcome, delay in seconds) of the next request; outcome is ok, error, rate_limited, malformed or hang"""
+        with self._lock:
+            self.requests += 1
+            if not self._take_token():
+                outcome = 'rate_limited'
+            else:
+                draw = self._random.random()
+                outcome = 'ok'
+                for name, rate in (('rate_limited', self.rate_limit_rate), ('error', self.error_rate),
+                                   ('malformed', self.malformed_rate), ('hang', self.hang_rate)):
+                    if draw < rate:
+                        outcome = name
+                        break
+                    draw -= rate
+            self.outcomes[outcome] += 1
+        if outcome == 'rate_limited':
+            return outcome, 0.0
+        if outcome == 'hang':
+            return outcome, self.hang_ms / 1000
+        return outcome, self.next_latency()
+
+    def completion(self, request: Dict, malformed: bool = False) -> Dict:
+        messages: List[Dict] = request.get('messages') or []
+        prompt = messages[-1].get('content', '') if messages else ''
+        analysis = fake_analysis(prompt)
+        if malformed:
+            with self._lock:
+                content = malformed_content(analysis, self._random)
+        else:
+            content = json.dumps(analysis)
+        return {
+            'id': f"chatcmpl-{uuid.uuid4().hex[:24]}",
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': request.get('model', 'stub'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': content},
+                'finish_reason': 'stop',
+            }],
+            'usage': {'prompt_tokens': len(prompt) // 4, 'completion_tokens': len(content) // 4,
+                      'total_tokens': (len(prompt) + len(content)) // 4},
+        }
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {'requests': self.requests, 'outcomes': dict(self.outcomes)}
+
+    def start(self) -> 'StubLLMServer':
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='stub-llm', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def add_arguments(parser: argparse.ArgumentParser, prefix: str = '', latency_ms: float = 500.0, jitter_ms: float = 0.0):
+    """Latency and failure-injection options; `prefix` (e.g. 'llm-') namespaces them inside another tool"""
+    parser.add_argument(f'--{prefix}latency-ms', type=float, default=latency_ms,
+                        help='Simulated LLM response time (the median for lognormal)')
+    parser.add_argument(f'--{prefix}jitter-ms', type=float, default=jitter_ms,
+                        help='Uniform +/- spread, or the standard deviation for normal')
+    parser.add_argument(f'--{prefix}latency-dist', choices=LATENCY_DISTRIBUTIONS, default='uniform')
+    parser.add_argument(f'--{prefix}sigma', type=float, default=0.5, help='Shape of the lognormal latency tail')
+    parser.add_argument(f'--{prefix}error-rate', type=float, default=0.0, help='Share of requests answered 500')
+    parser.add_argument(f'--{prefix}rate-limit-rate', type=float, default=0.0, help='Share of requests answered 429')
+    parser.add_argument(f'--{prefix}malformed-rate', type=float, default=0.0,
+                        help='Share of completions that are truncated JSON, prose or missing fields')
+    parser.add_argument(f'--{prefix}hang-rate', type=float, default=0.0,
+                        help='Share of requests that take --hang-ms before answering')
+    parser.add_argument(f'--{prefix}hang-ms', type=float, default=120000.0)
+    parser.add_argument(f'--{prefix}max-rps', type=float, default=0.0, help='Answer 429 above this request rate (0: no limit)')
+    parser.add_argument(f'--{prefix}retry-after', type=float, default=1.0, help='Retry-After seconds of 429 answers')
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--seed', type=int)
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    server = StubLLMServer.from_args(args, host=args.host, port=args.port, seed=args.seed)
+    print(f"Stub LLM listening on {server.base_url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,321 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Dict, NamedTuple, Optional
+
+import requests
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from ip_reputation import IPReputationIndex
+
+logger = logging.getLogger('fraud_detection.blocklist')
+
+ABUSEIPDB_BLACKLIST_URL = "https://api.abuseipdb.com/api/v2/blacklist"
+DEFAULT_SNAPSHOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'blocklist_snapshot.json')
+DEFAULT_INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'blocklist.idx')
+DEFAULT_FALLBACK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ip_data.json')
+
+
+class FetchResult(NamedTuple):
+    """A blocklist payload in AbuseIPDB format plus the validators for the next conditional request"""
+    payload: Dict
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+
+class HTTPFetcher:
+    """Fetch a blocklist over HTTP using conditional requests (If-None-Match / If-Modified-Since)"""
+
+    def __init__(self, url: str, headers: Optional[Dict] = None, params: Optional[Dict] = None, timeout: float = 10):
+        self.url = url
+        self.headers = headers or {}
+        self.params = params or {}
+        self.timeout = timeout
+
+    def fetch(self, etag: Optional[str] = None, last_modified: Optional[str] = None) -> Optional[FetchResult]:
+        """Return the new blocklist, or None if the source reports it unchanged"""
+        headers = dict(self.headers)
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+        response = requests.get(self.url, headers=headers, params=self.params, timeout=self.timeout)
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+        return FetchResult(
+            payload=response.json(),
+            etag=response.headers.get('ETag'),
+            last_modified=response.headers.get('Last-Modified')
+        )
+
+
+class FileFetcher:
+    """Read a blocklist from a local file, treating an unchanged mtime as not modified"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def fetch(self, etag: Optional[str] = None, last_modified: Optional[str] = None) -> Optional[FetchResult]:
+        mtime = str(os.stat(self.path).st_mtime_ns)
+        if etag == mtime:
+            return None
+        with open(self.path, 'r') as f:
+            return FetchResult(payload=json.load(f), etag=mtime)
+
+
+def abuseipdb_fetcher(api_key: Optional[str], confidence_minimum: int = 90, limit: int = 10000) -> HTTPFetcher:
+    """Fetcher for the AbuseIPDB blacklist endpoint"""
+    return HTTPFetcher(
+        ABUSEIPDB_BLACKLIST_URL,
+        headers={'Key': api_key, 'Accept': 'application/json'},
+        params={'confidenceMinimum': confidence_minimum, 'limit': limit}
+    )
+
+
+def fetcher_from_env():
+    """
+    Build the fetcher configured by BLOCKLIST_SOURCE:
+        - "abuseipdb" (default when ABUSEIPDB_API_KEY is set)
+        - "file:<path>" to read a local file in AbuseIPDB format
+        - "http://..." / "https://..." for any endpoint serving that format (e.g. a stub server)
+        - "none" to only use the on-disk snapshot
+    """
+    source = os.getenv('BLOCKLIST_SOURCE') or ('abuseipdb' if os.getenv('ABUSEIPDB_API_KEY') else 'none')
+    if source == 'none':
+        return None
+    if source == 'abuseipdb':
+        return abuseipdb_fetcher(
+            os.getenv('ABUSEIPDB_API_KEY'),
+            confidence_minimum=int(os.getenv('ABUSEIPDB_CONFIDENCE_MINIMUM', 90)),
+            limit=int(os.getenv('ABUSEIPDB_LIMIT', 10000))
+        )
+    if source.startswith('file:'):
+        return FileFetcher(source[len('file:'):])
+    if source.startswith(('http://', 'https://')):
+        return HTTPFetcher(source)
+    raise ValueError(f"Unsupported BLOCKLIST_SOURCE: {source}")
+
+
+@contextmanager
+def _file_lock(path: str, blocking: bool):
+    """Inter-process lock on `path`; yields whether it was acquired"""
+    if fcntl is None:
+        # No flock on this platform: every process acts on its own
+        yield True
+        return
+    with open(path, 'a') as f:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class BlocklistRefresher:
+    """
+    Keep an IPReputationIndex mapped from a compiled index file shared by all worker processes.
+
+    Construction only touches local files, so worker boot never waits on the network:
+    the compiled index is memory-mapped read-only if it exists, otherwise it is compiled
+    once (under a file lock) from the JSON snapshot or the bundled fallback file.
+
+    A daemon thread in every process polls the index file and re-maps it when it has
+    been replaced. Refreshes are coordinated through the same lock: whichever process
+    takes it when the data is older than the refresh interval fetches with conditional
+    requests, writes the JSON snapshot and compiles a new index next to the old one
+    before renaming it into place. One fetch and one compile per node, however many
+    workers; the others only swap their mapping. Readers always see either the old
+    or the new index, never a partially built one.
+    """
+
+    def __init__(self, fetcher=None, snapshot_path: str = DEFAULT_SNAPSHOT_PATH,
+                 fallback_path: Optional[str] = DEFAULT_FALLBACK_PATH, index_path: str = DEFAULT_INDEX_PATH,
+                 interval: float = 3600, poll_interval: float = 5):
+        self.fetcher = fetcher
+        self.snapshot_path = snapshot_path
+        self.fallback_path = fallback_path
+        self.index_path = index_path
+        self.meta_path = f"{index_path}.meta.json"
+        self.lock_path = f"{index_path}.lock"
+        self.interval = interval
+        self.poll_interval = poll_interval
+        self.fetched_at = None
+        self.last_error = None
+        self._index_stat = None
+        self._stop = threading.Event()
+        self._thread = None
+        self.index = self._load_local()
+
+    @classmethod
+    def from_env(cls) -> 'BlocklistRefresher':
+        return cls(
+            fetcher=fetcher_from_env(),
+            snapshot_path=os.getenv('BLOCKLIST_SNAPSHOT_PATH', DEFAULT_SNAPSHOT_PATH),
+            fallback_path=os.getenv('BLOCKLIST_FALLBACK_PATH', DEFAULT_FALLBACK_PATH),
+            index_path=os.getenv('BLOCKLIST_INDEX_PATH', DEFAULT_INDEX_PATH),
+            interval=float(os.getenv('BLOCKLIST_REFRESH_INTERVAL', 3600)),
+            poll_interval=float(os.getenv('BLOCKLIST_POLL_INTERVAL', 5))
+        )
+
+    def _map_index(self) -> IPReputationIndex:
+        # Stat before opening: if the file is swapped in between, the next poll maps it again
+        st = os.stat(self.index_path)
+        index = IPReputationIndex.load(self.index_path)
+        self._index_stat = (st.st_ino, st.st_mtime_ns)
+        self.fetched_at = self._read_meta().get('fetchedAt')
+        return index
+
+    def _load_json(self) -> IPReputationIndex:
+        for path in (self.snapshot_path, self.fallback_path):
+            if not path or not os.path.exists(path):
+                continue
+            try:
+                index = IPReputationIndex.from_file(path)
+            except Exception as e:
+                logger.warning(f"Không thể đọc blocklist từ {path}: {str(e)}")
+                continue
+            logger.info(f"Đã tải {len(index)} dải IP độc hại từ {path}")
+            return index
+        logger.warning("Không có blocklist cục bộ, bắt đầu với danh sách rỗng")
+        return IPReputationIndex()
+
+    def _load_local(self) -> IPReputationIndex:
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.index_path)), exist_ok=True)
+            if not os.path.exists(self.index_path):
+                # Chỉ một worker biên dịch index, các worker còn lại chờ rồi map file đã có
+                with _file_lock(self.lock_path, blocking=True):
+                    if not os.path.exists(self.index_path):
+                        self._load_json().save(self.index_path)
+            return self._map_index()
+        except Exception as e:
+            logger.warning(f"Không thể dùng index blocklist {self.index_path}, dùng bản trong bộ nhớ: {str(e)}")
+            return self._load_json()
+
+    def _read_meta(self) -> Dict:
+        try:
+            with open(self.meta_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_atomic(self, path: str, payload: Dict):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        # Ghi ra file tạm rồi rename để không bao giờ để lại file dở dang
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(payload, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _is_fresh(self, meta: Dict) -> bool:
+        if not meta.get('fetchedAt'):
+            return False
+        try:
+            age = (datetime.now(timezone.utc) - datetime.fromisoformat(meta['fetchedAt'])).total_seconds()
+        except ValueError:
+            return False
+        return age < self.interval
+
+    def reload_if_changed(self) -> bool:
+        """Re-map the index file if another process replaced it; returns True on swap"""
+        try:
+            st = os.stat(self.index_path)
+        except OSError:
+            return False
+        if (st.st_ino, st.st_mtime_ns) == self._index_stat:
+            return False
+        try:
+            self.index = self._map_index()
+        except Exception as e:
+            logger.warning(f"Không thể map index blocklist mới: {str(e)}")
+            return False
+        logger.info(f"Đã chuyển sang index blocklist mới: {len(self.index)} dải IP độc hại")
+        return True
+
+    def refresh(self, force: bool = False) -> bool:
+        """
+        Fetch and compile once if this process wins the lock and the data is stale
+        (or `force` is set); returns True if a new index was swapped in.
+        """
+        if self.fetcher is None:
+            return False
+        with _file_lock(self.lock_path, blocking=False) as acquired:
+            if not acquired:
+                return False
+            try:
+                meta = self._read_meta()
+                if not force and self._is_fresh(meta):
+                    return False
+
+                result = self.fetcher.fetch(meta.get('etag'), meta.get('lastModified'))
+                fetched_at = datetime.now(timezone.utc).isoformat()
+                if result is None:
+                    logger.info("Blocklist không thay đổi")
+                    meta['fetchedAt'] = fetched_at
+                    self._write_atomic(self.meta_path, meta)
+                    self.last_error = None
+                    return False
+
+                index = IPReputationIndex.from_abuseipdb(result.payload)
+                self._write_atomic(self.snapshot_path, result.payload)
+                index.save(self.index_path)
+                self._write_atomic(self.meta_path, {
+                    'etag': result.etag,
+                    'lastModified': result.last_modified,
+                    'fetchedAt': fetched_at
+                })
+                self.index = self._map_index()
+                self.last_error = None
+                logger.info(f"Đã cập nhật blocklist: {len(index)} dải IP độc hại")
+                return True
+            except Exception as e:
+                self.last_error = str(e)
+                logger.warning(f"Không thể cập nhật blocklist, giữ danh sách hiện tại: {str(e)}")
+                return False
+
+    def _run(self):
+        # Spread the first attempt so that workers started together do not race for the lock
+        next_refresh = time.monotonic() + random.uniform(0, min(self.interval, 30))
+        while not self._stop.wait(self.poll_interval):
+            self.reload_if_changed()
+            if self.fetcher is not None and self.interval > 0 and time.monotonic() >= next_refresh:
+                self.refresh()
+                next_refresh = time.monotonic() + self.interval
+
+    def start(self):
+        """Start the background poll/refresh thread (no-op with a non-positive poll interval)"""
+        if self.poll_interval <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='blocklist-refresher', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+
+if __name__ == "__main__":
+    # Biên dịch lại index một lần (ví dụ từ cron) mà không cần khởi động API
+    refresher = BlocklistRefresher.from_env()
+    refresher.refresh(force=True)
+    print(f"{refresher.index_path}: {len(refresher.index)} intervals, fetched at {refresher.fetched_at}")
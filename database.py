@@ -1,11 +1,22 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Boolean, JSON, ForeignKey, Text
+from sqlalchemy import create_engine, event, Column, Index, Integer, String, Float, Double, DateTime, Boolean, JSON, ForeignKey, LargeBinary, Text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
 from datetime import datetime
 import os
+import json
+import threading
+import time
+import zlib
 import argparse
 from dotenv import load_dotenv
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 # Parse command line arguments
 load_dotenv()
 
@@ -16,22 +27,336 @@ DB_HOST = os.getenv('DB_HOST', 'localhost')
 DB_PORT = os.getenv('DB_PORT', '3306')
 DB_NAME = os.getenv('DB_NAME', 'fraud_detection')
 
-# Create database URL
-DATABASE_URL = f"mysql+pymysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+# Backend: mysql (default) or sqlite, an embedded database file for single-node deployments and benchmarks
+DB_BACKEND = os.getenv('DB_BACKEND', 'mysql').lower()
+SQLITE_PATH = os.getenv('SQLITE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'fraud_detection.db'))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000))
+SQLITE_CACHE_SIZE_KB = int(os.getenv('SQLITE_CACHE_SIZE_KB', 65536))
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+
+# Create database URL (DATABASE_URL overrides the individual settings)
+if os.getenv('DATABASE_URL'):
+    DATABASE_URL = os.getenv('DATABASE_URL')
+elif DB_BACKEND == 'sqlite':
+    DATABASE_URL = f"sqlite:///{SQLITE_PATH}"
+elif DB_BACKEND == 'mysql':
+    DATABASE_URL = f"mysql+pymysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+else:
+    raise ValueError(f"Unsupported DB_BACKEND: {DB_BACKEND} (expected mysql or sqlite)")
+
+# Optional read replica for profile, history and reporting reads
+DB_READ_HOST = os.getenv('DB_READ_HOST')
+DB_READ_PORT = os.getenv('DB_READ_PORT', DB_PORT)
+DATABASE_READ_URL = os.getenv('DATABASE_READ_URL') or (
+    f"mysql+pymysql://{DB_USER}:{DB_PASSWORD}@{DB_READ_HOST}:{DB_READ_PORT}/{DB_NAME}" if DB_READ_HOST else None
+)
+REPLICA_MAX_LAG_SECONDS = float(os.getenv('REPLICA_MAX_LAG_SECONDS', 5))
+REPLICA_LAG_CHECK_INTERVAL = float(os.getenv('REPLICA_LAG_CHECK_INTERVAL', 1))
+
+# Connection pool configuration (per process: each gunicorn worker has its own pool,
+# so the database sees up to workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections)
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 3600))
+
+class PoolMetrics:
+    """Counters for connection pool usage: checkouts, time spent waiting for a connection, overflow and timeouts"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.engine = None
+        self.connections_created = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.invalidations = 0
+        self.timeouts = 0
+        self.waits = 0
+        self.wait_seconds_total = 0.0
+        self.max_wait_seconds = 0.0
+        self.max_overflow_seen = 0
+
+    def attach(self, engine):
+        # Pool events registered on the engine follow the pool across engine.dispose()
+        self.engine = engine
+        event.listen(engine, 'connect', self._on_connect)
+        event.listen(engine, 'checkout', self._on_checkout)
+        event.listen(engine, 'checkin', self._on_checkin)
+        event.listen(engine, 'invalidate', self._on_invalidate)
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connections_created += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        pool = self.engine.pool
+        overflow = pool.overflow() if isinstance(pool, QueuePool) else 0
+        with self._lock:
+            self.checkouts += 1
+            self.max_overflow_seen = max(self.max_overflow_seen, overflow)
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.checkins += 1
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self._lock:
+            self.invalidations += 1
+
+    def observe_wait(self, seconds: float, timed_out: bool = False):
+        with self._lock:
+            self.waits += 1
+            self.wait_seconds_total += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+            if timed_out:
+                self.timeouts += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            stats = {
+                'connections_created': self.connections_created,
+                'checkouts': self.checkouts,
+                'checkins': self.checkins,
+                'invalidations': self.invalidations,
+                'timeouts': self.timeouts,
+                'wait_seconds_total': self.wait_seconds_total,
+                'avg_wait_seconds': self.wait_seconds_total / self.waits if self.waits else 0.0,
+                'max_wait_seconds': self.max_wait_seconds,
+                'max_overflow_seen': self.max_overflow_seen,
+            }
+        pool = self.engine.pool if self.engine is not None else None
+        if isinstance(pool, QueuePool):
+            stats.update({
+                'pool_size': pool.size(),
+                'checked_out': pool.checkedout(),
+                'checked_in': pool.checkedin(),
+                'overflow': max(0, pool.overflow()),
+                'max_overflow': pool._max_overflow,
+            })
+        return stats
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a connection"""
+
+    metrics = None
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            if self.metrics is not None:
+                self.metrics.observe_wait(time.perf_counter() - started, timed_out=True)
+            raise
+        if self.metrics is not None:
+            self.metrics.observe_wait(time.perf_counter() - started)
+        return connection
+
+# Execution option of write transactions, see configure_sqlite and begin_write
+WRITE_TRANSACTION = {'sqlite_begin': 'immediate'}
+
+def configure_sqlite(engine):
+    """
+    Tune every new SQLite connection of `engine`: WAL journal so readers never block the
+    writer, synchronous=NORMAL (durable at checkpoints, safe with WAL), a busy timeout
+    instead of immediate "database is locked" errors, enforced foreign keys, and a larger
+    page cache and memory map.
+
+    Transactions are begun explicitly because pysqlite's implicit transaction handling
+    breaks SAVEPOINT, which the feature store uses for concurrent first inserts. Reads
+    use a deferred BEGIN, so WAL readers run concurrently. Transactions begun with the
+    WRITE_TRANSACTION execution option (see `begin_write`) use BEGIN IMMEDIATE and take
+    the write lock up front: a deferred transaction that reads and then writes fails
+    with "database is locked" when another connection holds the lock, and busy_timeout
+    does not retry that upgrade.
+    """
+    @event.listens_for(engine, 'connect')
+    def _on_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for pragma in (
+            'journal_mode=WAL',
+            'synchronous=NORMAL',
+            f'busy_timeout={SQLITE_BUSY_TIMEOUT_MS}',
+            'foreign_keys=ON',
+            f'cache_size=-{SQLITE_CACHE_SIZE_KB}',
+            'temp_store=MEMORY',
+            f'mmap_size={SQLITE_MMAP_SIZE}',
+        ):
+            cursor.execute(f'PRAGMA {pragma}')
+        cursor.close()
+
+    @event.listens_for(engine, 'begin')
+    def _on_begin(connection):
+        immediate = connection.get_execution_options().get('sqlite_begin') == 'immediate'
+        connection.exec_driver_sql('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+
+def begin_write(db):
+    """
+    Start the session's next transaction as a write transaction (BEGIN IMMEDIATE on
+    SQLite, no effect on other backends). Call it before the first statement of a
+    transaction that writes; it does nothing if a transaction is already in progress.
+    """
+    if not db.in_transaction():
+        db.connection(execution_options=WRITE_TRANSACTION)
+
+def create_instrumented_engine(url, metrics: PoolMetrics, **kwargs):
+    """Create an engine on an InstrumentedQueuePool reporting to `metrics`"""
+    pool_class = type('InstrumentedQueuePool', (InstrumentedQueuePool,), {'metrics': metrics})
+    is_sqlite = str(url).startswith('sqlite')
+    if is_sqlite:
+        path = str(url).split(':///', 1)[-1]
+        if path and path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Pooled connections move between threads, one at a time
+        kwargs.setdefault('connect_args', {'check_same_thread': False})
+    created = create_engine(url, poolclass=pool_class, **kwargs)
+    if is_sqlite:
+        configure_sqlite(created)
+    metrics.attach(created)
+    return created
+
+# Async drivers for the ASGI API, by the driver of the configured URL
+ASYNC_DRIVERS = {
+    'mysql': 'aiomysql',
+    'mysql+pymysql': 'aiomysql',
+    'sqlite': 'aiosqlite',
+    'sqlite+pysqlite': 'aiosqlite',
+}
+
+def create_async_db_engine(url, metrics: PoolMetrics, **kwargs):
+    """
+    Create an AsyncEngine for the same database as `url`, switching to its async driver
+    (pymysql -> aiomysql, pysqlite -> aiosqlite). SQLite connections get the same pragmas
+    as the sync engine. Pool usage is reported to `metrics`.
+    """
+    from sqlalchemy.engine import make_url
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    url = make_url(url)
+    driver = ASYNC_DRIVERS.get(url.drivername)
+    if driver is None:
+        raise ValueError(f"No async driver configured for {url.drivername}")
+    url = url.set(drivername=f"{url.get_backend_name()}+{driver}")
+    if url.get_backend_name() == 'sqlite':
+        if url.database and url.database != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(url.database)), exist_ok=True)
+        # aiosqlite rejects the QueuePool sizing options
+        for option in ('pool_size', 'max_overflow', 'pool_timeout'):
+            kwargs.pop(option, None)
+    created = create_async_engine(url, **kwargs)
+    if url.get_backend_name() == 'sqlite':
+        configure_sqlite(created.sync_engine)
+    metrics.attach(created.sync_engine)
+    return created
+
+pool_metrics = PoolMetrics()
 
 # Create SQLAlchemy engine with connection pooling and retry settings
-engine = create_engine(
+engine = create_instrumented_engine(
     DATABASE_URL,
-    pool_pre_ping=True,  # Enable connection health checks
-    pool_recycle=3600,   # Recycle connections after 1 hour
-    pool_timeout=30,     # Wait up to 30 seconds for a connection
-    max_overflow=10,     # Allow up to 10 connections above pool_size
-    pool_size=5          # Maintain 5 connections in the pool
+    pool_metrics,
+    pool_pre_ping=True,                # Enable connection health checks
+    pool_recycle=DB_POOL_RECYCLE,      # Recycle connections after 1 hour
+    pool_timeout=DB_POOL_TIMEOUT,      # Wait up to 30 seconds for a connection
+    max_overflow=DB_MAX_OVERFLOW,      # Allow up to 10 connections above pool_size
+    pool_size=DB_POOL_SIZE             # Maintain 5 connections in the pool
 )
 
 # Create session factory
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Read engine: the replica if one is configured, otherwise the primary
+read_pool_metrics = PoolMetrics() if DATABASE_READ_URL else pool_metrics
+read_engine = create_instrumented_engine(
+    DATABASE_READ_URL,
+    read_pool_metrics,
+    pool_pre_ping=True,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_timeout=DB_POOL_TIMEOUT,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_size=DB_POOL_SIZE
+) if DATABASE_READ_URL else engine
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+
+class ReadRouter:
+    """
+    Decide whether a read may go to the replica.
+
+    Reads fall back to the primary when no replica is configured, when its replication
+    lag (checked at most every `check_interval` seconds) exceeds `max_lag` or cannot be
+    determined, and for a key (e.g. a user id) written by this process within the last
+    `max_lag` seconds, so a client reading right after its own write sees it.
+    """
+
+    def __init__(self, read_engine, max_lag: float = REPLICA_MAX_LAG_SECONDS,
+                 check_interval: float = REPLICA_LAG_CHECK_INTERVAL):
+        self.read_engine = read_engine
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._lag = None
+        self._lag_checked_at = 0.0
+        self._recent_writes = {}
+
+    @property
+    def has_replica(self) -> bool:
+        return self.read_engine is not engine
+
+    def _measure_lag(self):
+        if self.read_engine.dialect.name != 'mysql':
+            return 0.0
+        with self.read_engine.connect() as connection:
+            for statement in ('SHOW REPLICA STATUS', 'SHOW SLAVE STATUS'):
+                try:
+                    row = connection.exec_driver_sql(statement).mappings().first()
+                    break
+                except Exception:
+                    continue
+            else:
+                return None
+        if row is None:
+            return 0.0  # Not a replica (e.g. a second standalone database in tests)
+        lag = row.get('Seconds_Behind_Source', row.get('Seconds_Behind_Master'))
+        return float(lag) if lag is not None else None
+
+    def replica_lag(self):
+        """Last measured replication lag in seconds, or None if unknown (replication stopped or check failed)"""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._lag_checked_at < self.check_interval:
+                return self._lag
+            self._lag_checked_at = now
+        try:
+            lag = self._measure_lag()
+        except Exception:
+            lag = None
+        with self._lock:
+            self._lag = lag
+        return lag
+
+    def note_write(self, key):
+        """Record a write for `key` so reads for it stay on the primary until the replica has caught up"""
+        now = time.monotonic()
+        with self._lock:
+            self._recent_writes[key] = now
+            if len(self._recent_writes) > 10000:
+                cutoff = now - self.max_lag
+                self._recent_writes = {k: t for k, t in self._recent_writes.items() if t >= cutoff}
+
+    def use_replica(self, key=None) -> bool:
+        if not self.has_replica:
+            return False
+        if key is not None:
+            with self._lock:
+                written_at = self._recent_writes.get(key)
+            if written_at is not None and time.monotonic() - written_at < self.max_lag:
+                return False
+        lag = self.replica_lag()
+        return lag is not None and lag <= self.max_lag
+
+read_router = ReadRouter(read_engine)
+
 # Create base class for models
 Base = declarative_base()
 
@@ -49,6 +374,7 @@ class User(Base):
     transactions = relationship("Transaction", back_populates="user")
     transaction_analyses = relationship("TransactionAnalysis", back_populates="user")
     profile = relationship("UserProfile", back_populates="user", uselist=False)
+    features = relationship("UserFeatures", back_populates="user", uselist=False)
     alerts = relationship("Alert", back_populates="user")
 
 class Transaction(Base):
@@ -65,6 +391,12 @@ class Transaction(Base):
     ip_address = Column(String(50))
     geolocation = Column(String(255))
     device_id = Column(String(100))
+
+    __table_args__ = (
+        # History (ORDER BY timestamp DESC LIMIT n) and recent-window lookups per user
+        Index('idx_transactions_user_timestamp', 'user_id', 'timestamp'),
+        Index('idx_transactions_timestamp', 'timestamp'),
+    )
     
     # Relationships
     user = relationship("User", back_populates="transactions")
@@ -88,34 +420,126 @@ class TransactionAnalysis(Base):
     description = Column(String(255), nullable=True)
     is_suspicious = Column(Boolean, default=False)
     risk_score = Column(Float, default=0.0)
-    ai_analysis = Column(JSON, nullable=True)
-    traditional_analysis = Column(JSON, nullable=True)
     verified = Column(Boolean, default=False)
     is_fraud = Column(Boolean, default=False)
-    fraud_reasons = Column(JSON, nullable=True)  # List of reasons for fraud detection
+    # ai_analysis, traditional_analysis and fraud_reasons live compressed in TransactionAnalysisPayload
+
+    __table_args__ = (
+        Index('idx_transaction_analyses_user_timestamp', 'user_id', 'timestamp'),
+        Index('idx_transaction_analyses_timestamp', 'timestamp'),
+        Index('idx_transaction_analyses_is_fraud', 'is_fraud'),
+    )
     
     # Relationships
     user = relationship("User", back_populates="transaction_analyses")
+    payload = relationship("TransactionAnalysisPayload", uselist=False, cascade="all, delete-orphan")
 
     def __repr__(self):
         return f"<TransactionAnalysis(transaction_id='{self.transaction_id}', user_id='{self.user_id}', amount={self.amount}, currency='{self.currency}', description='{self.description}', category='{self.category}', timestamp='{self.timestamp}', is_suspicious={self.is_suspicious}, risk_score={self.risk_score})>"
 
+ANALYSIS_PAYLOAD_FIELDS = ('ai_analysis', 'traditional_analysis', 'fraud_reasons')
+
+def _json_default(value):
+    return value.isoformat() if isinstance(value, datetime) else str(value)
+
+class TransactionAnalysisPayload(Base):
+    """
+    Verbose analysis payload (LLM output, rule details, reasons) of a TransactionAnalysis,
+    stored compressed outside the hot table and only loaded on demand
+    """
+    __tablename__ = "transaction_analysis_payloads"
+
+    transaction_id = Column(String(50), ForeignKey('transaction_analyses.transaction_id'), primary_key=True)
+    codec = Column(String(20), nullable=False)  # msgpack+zlib, or json+zlib where msgpack is unavailable
+    data = Column(LargeBinary(length=16 * 1024 * 1024), nullable=False)  # MEDIUMBLOB on MySQL
+
+    @staticmethod
+    def encode(fields: dict):
+        """Return (codec, compressed bytes) for a dict of payload fields"""
+        if msgpack is not None:
+            return 'msgpack+zlib', zlib.compress(msgpack.packb(fields, default=_json_default, use_bin_type=True), 6)
+        return 'json+zlib', zlib.compress(json.dumps(fields, default=_json_default, ensure_ascii=False).encode('utf-8'), 6)
+
+    @staticmethod
+    def decode(codec: str, data: bytes) -> dict:
+        raw = zlib.decompress(data)
+        if codec == 'msgpack+zlib':
+            if msgpack is None:
+                raise RuntimeError("msgpack is required to read this analysis payload")
+            return msgpack.unpackb(raw, raw=False)
+        if codec == 'json+zlib':
+            return json.loads(raw)
+        raise ValueError(f"Unknown analysis payload codec: {codec}")
+
+    @classmethod
+    def from_fields(cls, transaction_id: str, fields: dict) -> 'TransactionAnalysisPayload':
+        codec, data = cls.encode(fields)
+        return cls(transaction_id=transaction_id, codec=codec, data=data)
+
+    def fields(self) -> dict:
+        return self.decode(self.codec, self.data)
+
+def split_analysis_row(row: dict):
+    """
+    Split a dict of TransactionAnalysis values (as built by the agent) into the hot-row
+    values and the payload-table values, or None when the row has no payload fields.
+    The Alert values a suspicious analysis carries under 'alert' are left out of both.
+    """
+    hot = {key: value for key, value in row.items() if key not in ANALYSIS_PAYLOAD_FIELDS and key != 'alert'}
+    fields = {key: row[key] for key in ANALYSIS_PAYLOAD_FIELDS if row.get(key) is not None}
+    if not fields:
+        return hot, None
+    codec, data = TransactionAnalysisPayload.encode(fields)
+    return hot, {'transaction_id': row['transaction_id'], 'codec': codec, 'data': data}
+
 class UserProfile(Base):
     """UserProfile model for storing user behavior patterns"""
     __tablename__ = "user_profiles"
 
     user_id = Column(String(50), ForeignKey('users.user_id'), primary_key=True)
-    common_locations = Column(JSON)  # List of common locations
-    common_devices = Column(JSON)    # List of common devices
-    common_categories = Column(JSON) # List of common transaction categories
-    common_ip_addresses = Column(JSON) # List of common ip addresses
     avg_transaction_amount = Column(Float, default=0.0)
-    typical_transaction_hours = Column(JSON)  # List of hours when user typically transacts
     last_updated = Column(DateTime, default=datetime.now)
+    # Common locations, devices, categories, IP addresses and hours are counted in UserProfileValue
     
     # Relationships
     user = relationship("User", back_populates="profile")
 
+class UserProfileValue(Base):
+    """
+    Occurrence counter of one value of a profile attribute (location, device, category,
+    ip_address, hour) for a user, incremented by an atomic upsert on every verified transaction
+    """
+    __tablename__ = "user_profile_values"
+
+    user_id = Column(String(50), ForeignKey('users.user_id'), primary_key=True)
+    attribute = Column(String(20), primary_key=True)
+    value = Column(String(255), primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+    last_seen_at = Column(DateTime)
+
+class UserFeatures(Base):
+    """Materialized per-user behavioral features, maintained incrementally on every transaction write"""
+    __tablename__ = "user_features"
+
+    user_id = Column(String(50), ForeignKey('users.user_id'), primary_key=True)
+    transaction_count = Column(Integer, nullable=False, default=0)
+    amount_sum = Column(Double, nullable=False, default=0.0)
+    amount_sq_sum = Column(Double, nullable=False, default=0.0)  # Sum of squared amounts, for variance
+    amount_max = Column(Float, nullable=False, default=0.0)
+    last_amount = Column(Float)
+    last_seen_at = Column(DateTime)
+    # Sliding-window counters: count for the current bucket plus the previous one
+    hour_bucket = Column(DateTime)
+    hour_count = Column(Integer, nullable=False, default=0)
+    prev_hour_count = Column(Integer, nullable=False, default=0)
+    day_bucket = Column(DateTime)
+    day_count = Column(Integer, nullable=False, default=0)
+    prev_day_count = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.now)
+
+    # Relationships
+    user = relationship("User", back_populates="features")
+
 class Alert(Base):
     """Alert model for storing fraud alerts"""
     __tablename__ = "alerts"
@@ -128,18 +552,92 @@ class Alert(Base):
     transaction_id = Column(String(50), ForeignKey('transaction_analyses.transaction_id'))
     transaction_details = Column(JSON)
     status = Column(String(20), default='new')  # new, reviewed, resolved, false_positive
+
+    __table_args__ = (
+        Index('idx_alerts_user_timestamp', 'user_id', 'timestamp'),
+        Index('idx_alerts_status_timestamp', 'status', 'timestamp'),
+        Index('idx_alerts_timestamp', 'timestamp'),
+    )
     
     # Relationships
     user = relationship("User", back_populates="alerts")
 
+class StatisticsRollup(Base):
+    """
+    Scoring counters per time bucket (granularity 'hour', 'day', or 'total' for all time),
+    incremented by an atomic upsert in the same transaction as the rows they count. Each
+    bucket is split into slots picked at random by writers, so concurrent writers rarely
+    wait on the same row; readers sum the slots (see rollups.py).
+    """
+    __tablename__ = "statistics_rollups"
+
+    granularity = Column(String(10), primary_key=True)
+    bucket = Column(DateTime, primary_key=True)  # Start of the hour or day; TOTAL_BUCKET for 'total'
+    slot = Column(Integer, primary_key=True)
+    transactions = Column(Integer, nullable=False, default=0)
+    suspicious = Column(Integer, nullable=False, default=0)
+    alerts = Column(Integer, nullable=False, default=0)
+    new_users = Column(Integer, nullable=False, default=0)
+
+def upsert(bind, model, rows, update=None):
+    """
+    Build a single INSERT that updates conflicting rows in place (ON DUPLICATE KEY UPDATE
+    on MySQL, ON CONFLICT DO UPDATE elsewhere), keyed on the primary key.
+
+    `update` maps column names to expressions; in them, model columns refer to the
+    existing row. Without `update`, conflicting rows are left untouched.
+    """
+    dialect = bind.dialect.name
+    if dialect == 'mysql':
+        from sqlalchemy.dialects.mysql import insert as dialect_insert
+    elif dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    stmt = dialect_insert(model).values(rows)
+    keys = [column.name for column in model.__table__.primary_key.columns]
+    if dialect == 'mysql':
+        # A no-op assignment turns duplicate keys into "0 rows affected" instead of an error
+        return stmt.on_duplicate_key_update(update or {keys[0]: model.__table__.c[keys[0]]})
+    if update:
+        return stmt.on_conflict_do_update(index_elements=keys, set_=update)
+    return stmt.on_conflict_do_nothing(index_elements=keys)
+
+def insert_missing(bind, model, rows):
+    """
+    Build a single INSERT that skips rows whose primary key already exists (INSERT IGNORE
+    on MySQL, ON CONFLICT DO NOTHING elsewhere); its rowcount is the number of rows inserted
+    """
+    dialect = bind.dialect.name
+    if dialect == 'mysql':
+        from sqlalchemy.dialects.mysql import insert as dialect_insert
+        # Unlike a no-op ON DUPLICATE KEY UPDATE, ignored rows are not counted as matched
+        return dialect_insert(model).values(rows).prefix_with('IGNORE')
+    return upsert(bind, model, rows)
+
 def get_db():
-    """Get database session"""
+    """Get database session (the session is closed when the generator is closed or exhausted)"""
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
 
+def get_read_db(key=None):
+    """Get a session for lag-tolerant reads: the replica when usable, otherwise the primary"""
+    db = ReadSessionLocal() if read_router.use_replica(key) else SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
 def init_db():
-    """Initialize database by creating all tables"""
-    Base.metadata.create_all(bind=engine) 
+    """Initialize database by creating all tables and applying pending schema migrations"""
+    Base.metadata.create_all(bind=engine)
+    from migrations import upgrade
+    upgrade(engine)
+
+if __name__ == "__main__":
+    # Tạo toàn bộ schema (bảng, index, migration) trên backend đang cấu hình
+    init_db()
+    print(f"Initialized database schema at {engine.url.render_as_string(hide_password=True)}")
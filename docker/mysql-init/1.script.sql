@@ -41,27 +41,72 @@ CREATE TABLE IF NOT EXISTS transaction_analyses (
     device_id VARCHAR(50) NOT NULL,
     is_suspicious TINYINT(1) DEFAULT 0,
     risk_score FLOAT DEFAULT 0.0,
-    ai_analysis JSON,
-    traditional_analysis JSON,
     verified TINYINT(1) DEFAULT 0,
     is_fraud TINYINT(1) DEFAULT 0,
-    fraud_reasons JSON,
     FOREIGN KEY (user_id) REFERENCES users(user_id)
 );
 
+-- Create transaction_analysis_payloads table (ai_analysis, traditional_analysis and
+-- fraud_reasons of an analysis, compressed; read only when the details are requested)
+CREATE TABLE IF NOT EXISTS transaction_analysis_payloads (
+    transaction_id VARCHAR(50) PRIMARY KEY,
+    codec VARCHAR(20) NOT NULL,
+    data MEDIUMBLOB NOT NULL,
+    FOREIGN KEY (transaction_id) REFERENCES transaction_analyses(transaction_id)
+);
+
 -- Create user_profiles table
 CREATE TABLE IF NOT EXISTS user_profiles (
     user_id VARCHAR(50) PRIMARY KEY,
-    common_locations JSON,
-    common_devices JSON,
-    common_categories JSON,
-    common_ip_addresses JSON,
     avg_transaction_amount FLOAT DEFAULT 0.0,
-    typical_transaction_hours JSON,
     last_updated DATETIME DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (user_id) REFERENCES users(user_id)
 );
 
+-- Create user_profile_values table (per-user occurrence counters of locations, devices,
+-- categories, IP addresses and hours, incremented with INSERT ... ON DUPLICATE KEY UPDATE)
+CREATE TABLE IF NOT EXISTS user_profile_values (
+    user_id VARCHAR(50) NOT NULL,
+    attribute VARCHAR(20) NOT NULL,
+    value VARCHAR(255) NOT NULL,
+    count INT NOT NULL DEFAULT 0,
+    last_seen_at DATETIME,
+    PRIMARY KEY (user_id, attribute, value),
+    FOREIGN KEY (user_id) REFERENCES users(user_id)
+);
+
+-- Create user_features table (maintained incrementally on every transaction write)
+CREATE TABLE IF NOT EXISTS user_features (
+    user_id VARCHAR(50) PRIMARY KEY,
+    transaction_count INT NOT NULL DEFAULT 0,
+    amount_sum DOUBLE NOT NULL DEFAULT 0.0,
+    amount_sq_sum DOUBLE NOT NULL DEFAULT 0.0,
+    amount_max FLOAT NOT NULL DEFAULT 0.0,
+    last_amount FLOAT,
+    last_seen_at DATETIME,
+    hour_bucket DATETIME,
+    hour_count INT NOT NULL DEFAULT 0,
+    prev_hour_count INT NOT NULL DEFAULT 0,
+    day_bucket DATETIME,
+    day_count INT NOT NULL DEFAULT 0,
+    prev_day_count INT NOT NULL DEFAULT 0,
+    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users(user_id)
+);
+
+-- Create statistics_rollups table (scoring counters per hour, day and in total, split into
+-- slots to spread concurrent increments; see rollups.py)
+CREATE TABLE IF NOT EXISTS statistics_rollups (
+    granularity VARCHAR(10) NOT NULL,
+    bucket DATETIME NOT NULL,
+    slot INT NOT NULL,
+    transactions INT NOT NULL DEFAULT 0,
+    suspicious INT NOT NULL DEFAULT 0,
+    alerts INT NOT NULL DEFAULT 0,
+    new_users INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (granularity, bucket, slot)
+);
+
 -- Create alerts table
 CREATE TABLE IF NOT EXISTS alerts (
     alert_id INT AUTO_INCREMENT PRIMARY KEY,
@@ -72,16 +117,20 @@ CREATE TABLE IF NOT EXISTS alerts (
     transaction_id VARCHAR(50),
     transaction_details JSON,
     fraud_reasons JSON,
+    status VARCHAR(20) DEFAULT 'new',
     FOREIGN KEY (user_id) REFERENCES users(user_id),
-    FOREIGN KEY (transaction_id) REFERENCES transactions(transaction_id)
+    FOREIGN KEY (transaction_id) REFERENCES transaction_analyses(transaction_id)
 );
 
 -- Create indexes for better performance
-CREATE INDEX idx_transactions_user_id ON transactions(user_id);
+-- (user_id, timestamp) serves per-user history (ORDER BY timestamp DESC LIMIT n) and recent-window
+-- lookups, and covers the user_id foreign keys, so there are no separate user_id indexes.
+-- Existing databases get these through `python migrations.py`.
+CREATE INDEX idx_transactions_user_timestamp ON transactions(user_id, timestamp);
 CREATE INDEX idx_transactions_timestamp ON transactions(timestamp);
-CREATE INDEX idx_transaction_analyses_user_id ON transaction_analyses(user_id);
+CREATE INDEX idx_transaction_analyses_user_timestamp ON transaction_analyses(user_id, timestamp);
 CREATE INDEX idx_transaction_analyses_timestamp ON transaction_analyses(timestamp);
 CREATE INDEX idx_transaction_analyses_is_fraud ON transaction_analyses(is_fraud);
--- CREATE INDEX idx_alerts_user_id ON alerts(user_id);
--- CREATE INDEX idx_alerts_timestamp ON alerts(timestamp);
--- CREATE INDEX idx_alerts_status ON alerts(status);
+CREATE INDEX idx_alerts_user_timestamp ON alerts(user_id, timestamp);
+CREATE INDEX idx_alerts_status_timestamp ON alerts(status, timestamp);
+CREATE INDEX idx_alerts_timestamp ON alerts(timestamp);
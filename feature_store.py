@@ -0,0 +1,277 @@
+import math
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from sqlalchemy import case, func, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from database import Transaction, User, UserFeatures, UserProfile, UserProfileValue, insert_missing, upsert
+
+logger = logging.getLogger('fraud_detection.features')
+
+HOUR = timedelta(hours=1)
+DAY = timedelta(days=1)
+
+# Profile attribute -> transaction field it is counted from ('hour' comes from the timestamp)
+PROFILE_ATTRIBUTES = {
+    'location': 'geolocation',
+    'device': 'device_id',
+    'category': 'category',
+    'ip_address': 'ip_address',
+    'hour': 'timestamp',
+}
+
+# Values per attribute that make up the profile: the most frequent ones among those seen
+# within the max age (0 days: no age limit). Counters are kept forever, so without these
+# bounds a long-lived user's profile (and every prompt built from it) grows without limit.
+PROFILE_VALUES_LIMIT = int(os.getenv('PROFILE_VALUES_LIMIT', 30))
+PROFILE_VALUES_MAX_AGE = timedelta(days=int(os.getenv('PROFILE_VALUES_MAX_AGE_DAYS', 365)))
+
+
+def _hour_bucket(ts: datetime) -> datetime:
+    return ts.replace(minute=0, second=0, microsecond=0)
+
+
+def _day_bucket(ts: datetime) -> datetime:
+    return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _window_assignments(bucket_col, count_col, prev_col, bucket: datetime, width: timedelta):
+    """
+    Build the SET clauses for a sliding-window counter pair.
+
+    The row keeps the count of the current bucket and of the one before it. A write
+    in the current bucket increments it, a write one bucket ahead rolls the window,
+    a write further ahead resets it and a late write for the previous bucket bumps
+    the previous count. Assignments are ordered so that MySQL, which evaluates SET
+    clauses left to right against already-updated values, sees the old counters.
+    """
+    previous = bucket - width
+    stale = (bucket_col.is_(None)) | (bucket_col < previous)
+    return [
+        (prev_col, case(
+            (bucket_col == previous, count_col),
+            (stale, 0),
+            (bucket_col == bucket + width, prev_col + 1),
+            else_=prev_col
+        )),
+        (count_col, case(
+            (bucket_col == bucket, count_col + 1),
+            (bucket_col == previous, 1),
+            (stale, 1),
+            else_=count_col
+        )),
+        (bucket_col, case(
+            (stale | (bucket_col == previous), bucket),
+            else_=bucket_col
+        )),
+    ]
+
+
+def _window_estimate(bucket: Optional[datetime], count: int, prev_count: int, now: datetime, width: timedelta) -> float:
+    """Estimate the number of events in the trailing window ending at `now`"""
+    if bucket is None:
+        return 0.0
+    elapsed = (now - bucket).total_seconds() / width.total_seconds()
+    if 0 <= elapsed < 1:
+        return count + prev_count * (1 - elapsed)
+    if 1 <= elapsed < 2:
+        return count * (2 - elapsed)
+    return 0.0
+
+
+def record_transaction(db: Session, user_id: str, amount: float, timestamp: Optional[datetime] = None):
+    """
+    Fold a newly written transaction into the user's feature record.
+
+    Runs as a single UPDATE with the arithmetic done by the database, inside the
+    caller's transaction, so the features commit or roll back together with the
+    transaction row. The caller is responsible for committing.
+    """
+    timestamp = timestamp or datetime.now()
+    if isinstance(timestamp, str):
+        timestamp = datetime.fromisoformat(timestamp)
+    amount = float(amount or 0)
+    is_latest = (UserFeatures.last_seen_at.is_(None)) | (UserFeatures.last_seen_at <= timestamp)
+
+    assignments = [
+        (UserFeatures.transaction_count, UserFeatures.transaction_count + 1),
+        (UserFeatures.amount_sum, UserFeatures.amount_sum + amount),
+        (UserFeatures.amount_sq_sum, UserFeatures.amount_sq_sum + amount * amount),
+        (UserFeatures.amount_max, case((UserFeatures.amount_max < amount, amount), else_=UserFeatures.amount_max)),
+        # last_amount must be assigned before last_seen_at, it depends on the old value
+        (UserFeatures.last_amount, case((is_latest, amount), else_=UserFeatures.last_amount)),
+        (UserFeatures.last_seen_at, case((is_latest, timestamp), else_=UserFeatures.last_seen_at)),
+    ]
+    assignments += _window_assignments(UserFeatures.hour_bucket, UserFeatures.hour_count,
+                                       UserFeatures.prev_hour_count, _hour_bucket(timestamp), HOUR)
+    assignments += _window_assignments(UserFeatures.day_bucket, UserFeatures.day_count,
+                                       UserFeatures.prev_day_count, _day_bucket(timestamp), DAY)
+    assignments.append((UserFeatures.updated_at, datetime.now()))
+
+    stmt = update(UserFeatures).where(UserFeatures.user_id == user_id).ordered_values(
+        *assignments
+    ).execution_options(synchronize_session=False)
+
+    if db.execute(stmt).rowcount:
+        return
+
+    # First transaction for this user: insert, falling back to the update if a
+    # concurrent writer created the row in the meantime
+    try:
+        with db.begin_nested():
+            db.add(UserFeatures(
+                user_id=user_id,
+                transaction_count=1,
+                amount_sum=amount,
+                amount_sq_sum=amount * amount,
+                amount_max=amount,
+                last_amount=amount,
+                last_seen_at=timestamp,
+                hour_bucket=_hour_bucket(timestamp),
+                hour_count=1,
+                prev_hour_count=0,
+                day_bucket=_day_bucket(timestamp),
+                day_count=1,
+                prev_day_count=0,
+                updated_at=datetime.now()
+            ))
+    except IntegrityError:
+        logger.info(f"Feature record for user {user_id} created concurrently, retrying update")
+        db.execute(stmt)
+
+
+def get_user_features(db: Session, user_id: str, now: Optional[datetime] = None) -> Optional[Dict]:
+    """
+    Read the user's feature record by primary key.
+
+    Returns None when the user has no record yet, otherwise a dictionary of the
+    stored counters plus derived moments and trailing-window counts as of `now`.
+    """
+    row = db.get(UserFeatures, user_id)
+    if row is None:
+        return None
+
+    now = now or datetime.now()
+    if isinstance(now, str):
+        now = datetime.fromisoformat(now)
+    count = row.transaction_count or 0
+    mean = row.amount_sum / count if count else 0.0
+    variance = max(0.0, row.amount_sq_sum / count - mean * mean) if count else 0.0
+
+    return {
+        'transaction_count': count,
+        'avg_amount': mean,
+        'std_amount': math.sqrt(variance),
+        'max_amount': row.amount_max,
+        'last_amount': row.last_amount,
+        'last_seen_at': row.last_seen_at.isoformat() if row.last_seen_at else None,
+        'transactions_last_hour': _window_estimate(row.hour_bucket, row.hour_count, row.prev_hour_count, now, HOUR),
+        'transactions_last_day': _window_estimate(row.day_bucket, row.day_count, row.prev_day_count, now, DAY),
+    }
+
+
+def rebuild_user_features(db: Session, user_id: str):
+    """
+    Recompute a user's feature record from the transactions table.
+
+    Only meant for backfilling users whose history predates the feature store;
+    the serving path never calls this.
+    """
+    db.query(UserFeatures).filter(UserFeatures.user_id == user_id).delete()
+    transactions = db.query(Transaction.amount, Transaction.timestamp).filter(
+        Transaction.user_id == user_id
+    ).order_by(Transaction.timestamp.asc()).all()
+    for amount, timestamp in transactions:
+        record_transaction(db, user_id, amount, timestamp)
+        db.flush()
+
+
+def ensure_users(db: Session, user_ids: List[str]) -> int:
+    """
+    Create the user rows that do not exist, without a read and without racing concurrent
+    creators; returns the number of users created
+    """
+    if not user_ids:
+        return 0
+    now = datetime.now()
+    return db.execute(insert_missing(db.get_bind(), User, [{'user_id': user_id, 'created_at': now} for user_id in user_ids])).rowcount
+
+
+def ensure_user(db: Session, user_id: str) -> bool:
+    """Create the user row if it does not exist; True if it was created"""
+    return ensure_users(db, [user_id]) > 0
+
+
+def record_profile(db: Session, user_id: str, transaction_data: Dict):
+    """
+    Fold a verified transaction into the user's profile.
+
+    Two statements, both atomic upserts run inside the caller's transaction: one
+    increments the occurrence counters of the transaction's location, device,
+    category, IP address and hour, the other sets the profile's average amount from
+    the feature record (so `record_transaction` must run first). Concurrent updates
+    for the same user never lose increments. The caller is responsible for committing.
+    """
+    timestamp = transaction_data.get('timestamp') or datetime.now()
+    if isinstance(timestamp, str):
+        timestamp = datetime.fromisoformat(timestamp)
+    now = datetime.now()
+
+    rows = []
+    for attribute, field in PROFILE_ATTRIBUTES.items():
+        value = timestamp.hour if attribute == 'hour' else transaction_data.get(field)
+        if value is None or value == '':
+            continue
+        rows.append({'user_id': user_id, 'attribute': attribute, 'value': str(value)[:255],
+                     'count': 1, 'last_seen_at': timestamp})
+    bind = db.get_bind()
+    if rows:
+        db.execute(upsert(bind, UserProfileValue, rows, {
+            'count': UserProfileValue.count + 1,
+            'last_seen_at': case(
+                (UserProfileValue.last_seen_at < timestamp, timestamp),
+                else_=UserProfileValue.last_seen_at
+            ),
+        }))
+
+    average = select(UserFeatures.amount_sum / UserFeatures.transaction_count).where(
+        UserFeatures.user_id == user_id, UserFeatures.transaction_count > 0
+    ).scalar_subquery()
+    db.execute(upsert(bind, UserProfile, [{'user_id': user_id, 'avg_transaction_amount': average, 'last_updated': now}], {
+        'avg_transaction_amount': average,
+        'last_updated': now,
+    }))
+
+
+def get_profile_values(db: Session, user_id: str, attribute: Optional[str] = None, limit: int = PROFILE_VALUES_LIMIT,
+                       max_age: Optional[timedelta] = PROFILE_VALUES_MAX_AGE, now: Optional[datetime] = None) -> Dict[str, List[str]]:
+    """
+    Profile attribute values of the user keyed by attribute: per attribute, the `limit`
+    most frequent values (the most recently seen first among equal counts) last seen
+    within `max_age` before `now`. One query ranks the values per attribute with a
+    window function, so the result stays bounded however long the user's history is.
+    """
+    value = UserProfileValue
+    rank = func.row_number().over(
+        partition_by=value.attribute, order_by=(value.count.desc(), value.last_seen_at.desc())
+    ).label('rank')
+    ranked = select(value.attribute, value.value, rank).where(value.user_id == user_id)
+    if attribute is not None:
+        ranked = ranked.where(value.attribute == attribute)
+    if max_age:
+        # Values carried over from the JSON profiles may have no last_seen_at: keep them
+        since = (now or datetime.now()) - max_age
+        ranked = ranked.where(or_(value.last_seen_at.is_(None), value.last_seen_at >= since))
+    ranked = ranked.subquery()
+    query = select(ranked.c.attribute, ranked.c.value).where(ranked.c.rank <= limit).order_by(
+        ranked.c.attribute, ranked.c.rank
+    )
+
+    values = {name: [] for name in PROFILE_ATTRIBUTES}
+    for name, profile_value in db.execute(query):
+        values.setdefault(name, []).append(profile_value)
+    return values
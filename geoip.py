@@ -0,0 +1,229 @@
+import csv
+import logging
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_right
+from functools import lru_cache
+from typing import List, NamedTuple, Optional, Tuple
+
+from ip_reputation import U128View, align8, parse_address
+
+logger = logging.getLogger('fraud_detection.geoip')
+
+DEFAULT_GEOIP_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'geoip.bin')
+
+# Compiled database: header, then 8-byte aligned sections
+#   v4 starts/ends (uint32), v4 location ids (uint32),
+#   v6 starts/ends as high/low uint64 halves, v6 location ids (uint32),
+#   newline-separated "country_code|country_name|region" location table
+_MAGIC = b'GEOIPRNG'
+_FORMAT_VERSION = 1
+_HEADER = struct.Struct('<8sIIIII4x')  # magic, version, little-endian flag, v4 count, v6 count, locations size
+_U64_MASK = (1 << 64) - 1
+
+# Tên thường gặp của các quốc gia trong dữ liệu giao dịch, để so khớp với geolocation do client gửi
+COUNTRY_ALIASES = {
+    'VN': ['vietnam', 'viet nam'],
+    'US': ['usa', 'united states', 'united states of america', 'america'],
+    'GB': ['uk', 'united kingdom', 'great britain', 'england'],
+    'JP': ['japan'],
+    'KR': ['south korea', 'korea', 'republic of korea'],
+    'TW': ['taiwan'],
+    'SG': ['singapore'],
+    'TH': ['thailand'],
+    'MY': ['malaysia'],
+    'ID': ['indonesia'],
+    'PH': ['philippines'],
+    'CN': ['china'],
+    'HK': ['hong kong'],
+    'AU': ['australia'],
+    'IN': ['india'],
+    'DE': ['germany'],
+    'FR': ['france'],
+    'NL': ['netherlands'],
+    'RU': ['russia', 'russian federation'],
+    'CA': ['canada'],
+    'RO': ['romania'],
+}
+
+
+class GeoLocation(NamedTuple):
+    country_code: str
+    country_name: Optional[str]
+    region: Optional[str]
+
+    @property
+    def display_name(self) -> str:
+        """Country name in the same form the transaction data uses (e.g. "Vietnam")"""
+        if self.country_name:
+            return self.country_name
+        aliases = COUNTRY_ALIASES.get(self.country_code)
+        return aliases[0].title() if aliases else self.country_code
+
+    def matches(self, claimed: Optional[str]) -> bool:
+        """
+        Whether a client-supplied location string ("Vietnam", "VN", "Hanoi, Vietnam", ...)
+        is consistent with this location. Matching is done on country only.
+        """
+        if not claimed:
+            return True
+        names = {self.country_code.lower()}
+        names.update(COUNTRY_ALIASES.get(self.country_code, []))
+        if self.country_name:
+            names.add(self.country_name.lower())
+        parts = [p.strip().lower() for p in claimed.split(',')]
+        return any(p in names for p in parts if p)
+
+
+def _parse_bound(value: str) -> Optional[Tuple[int, int]]:
+    value = value.strip()
+    if value.isdigit():
+        number = int(value)
+        return (4 if number <= 0xFFFFFFFF else 6), number
+    return parse_address(value)
+
+
+class GeoIPResolver:
+    """
+    Offline IP-range to country/region resolver.
+
+    The database is a compiled binary of sorted, non-overlapping IP ranges (see
+    `compile`) read into flat arrays; a lookup is one binary search over packed
+    integers, with no network access and no per-lookup allocation besides the result.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.locations: List[GeoLocation] = []
+        self._tables = {4: (array('I'), array('I'), array('I')), 6: ([], [], array('I'))}
+        if path and os.path.exists(path):
+            self._load(path)
+            logger.info(f"Đã tải cơ sở dữ liệu GeoIP {path}: {len(self)} dải IP")
+        else:
+            logger.info("Không có cơ sở dữ liệu GeoIP cục bộ, bỏ qua xác thực vị trí theo IP")
+
+    def _load(self, path: str):
+        with open(path, 'rb') as f:
+            data = f.read()
+        magic, version, little_endian, n4, n6, locations_size = _HEADER.unpack_from(data, 0)
+        if magic != _MAGIC or version != _FORMAT_VERSION:
+            raise ValueError(f"{path} is not a compiled GeoIP database (version {_FORMAT_VERSION})")
+        if bool(little_endian) != (sys.byteorder == 'little'):
+            raise ValueError(f"{path} was compiled on a host with a different byte order")
+
+        offset = _HEADER.size
+        sections = []
+        for fmt, count in (('I', n4), ('I', n4), ('I', n4), ('Q', n6), ('Q', n6), ('Q', n6), ('Q', n6), ('I', n6)):
+            offset = align8(offset)
+            section = array(fmt)
+            section.frombytes(data[offset:offset + count * section.itemsize])
+            sections.append(section)
+            offset += count * section.itemsize
+        offset = align8(offset)
+        rows = data[offset:offset + locations_size].decode('utf-8').split('\n') if locations_size else []
+
+        starts4, ends4, ids4, starts6_hi, starts6_lo, ends6_hi, ends6_lo, ids6 = sections
+        self._tables = {
+            4: (starts4, ends4, ids4),
+            6: (U128View(starts6_hi, starts6_lo), U128View(ends6_hi, ends6_lo), ids6),
+        }
+        self.locations = []
+        for row in rows:
+            code, name, region = row.split('|')
+            self.locations.append(GeoLocation(code, name or None, region or None))
+
+    def lookup(self, ip: str) -> Optional[GeoLocation]:
+        """Return the location of `ip`, or None if it is unknown (including private ranges)"""
+        address = parse_address(ip) if ip else None
+        if address is None:
+            return None
+        version, value = address
+        starts, ends, ids = self._tables[version]
+        i = bisect_right(starts, value) - 1
+        if i < 0 or value > ends[i]:
+            return None
+        return self.locations[ids[i]]
+
+    def __len__(self) -> int:
+        return sum(len(table[0]) for table in self._tables.values())
+
+    @staticmethod
+    def compile(csv_path: str, out_path: str) -> int:
+        """
+        Compile a CSV of IP ranges into the binary format read by GeoIPResolver.
+
+        Each row is `start,end,country_code[,country_name[,region]]` where start/end
+        are IP addresses or integers (the layout of the DB-IP and IP2Location "lite"
+        CSV exports). Rows that do not parse, such as a header, are skipped. Returns
+        the number of ranges written.
+        """
+        location_ids = {}
+        ranges = {4: [], 6: []}
+        with open(csv_path, newline='', encoding='utf-8') as f:
+            for row in csv.reader(f):
+                if len(row) < 3:
+                    continue
+                start, end = _parse_bound(row[0]), _parse_bound(row[1])
+                if start is None or end is None or start[0] != end[0]:
+                    continue
+                code = row[2].strip().upper()
+                if not code or code == '-':
+                    continue
+                name = row[3].strip() if len(row) > 3 else ''
+                region = row[4].strip() if len(row) > 4 else ''
+                key = '|'.join(v.replace('|', ' ').replace('\n', ' ') for v in (code, name, region))
+                location_id = location_ids.setdefault(key, len(location_ids))
+                ranges[start[0]].append((start[1], end[1], location_id))
+
+        for version in (4, 6):
+            ranges[version].sort()
+            # Overlapping ranges would break the binary search: keep the first range that covers an address
+            disjoint = []
+            for start, end, location_id in ranges[version]:
+                if disjoint and start <= disjoint[-1][1]:
+                    if end <= disjoint[-1][1]:
+                        continue
+                    start = disjoint[-1][1] + 1
+                disjoint.append((start, end, location_id))
+            ranges[version] = disjoint
+
+        v4, v6 = ranges[4], ranges[6]
+        locations = '\n'.join(location_ids).encode('utf-8')
+        sections = [
+            array('I', (r[0] for r in v4)), array('I', (r[1] for r in v4)), array('I', (r[2] for r in v4)),
+            array('Q', (r[0] >> 64 for r in v6)), array('Q', (r[0] & _U64_MASK for r in v6)),
+            array('Q', (r[1] >> 64 for r in v6)), array('Q', (r[1] & _U64_MASK for r in v6)),
+            array('I', (r[2] for r in v6)),
+            locations,
+        ]
+
+        os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+        tmp_path = f"{out_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(_HEADER.pack(_MAGIC, _FORMAT_VERSION, sys.byteorder == 'little', len(v4), len(v6), len(locations)))
+            offset = _HEADER.size
+            for section in sections:
+                padding = align8(offset) - offset
+                data = section.tobytes() if isinstance(section, array) else section
+                f.write(bytes(padding) + data)
+                offset += padding + len(data)
+        os.replace(tmp_path, out_path)
+        return len(v4) + len(v6)
+
+
+@lru_cache(maxsize=None)
+def get_resolver(path: Optional[str] = None) -> GeoIPResolver:
+    """Process-wide resolver for `path` (default: GEOIP_DB_PATH or data/geoip.bin)"""
+    return GeoIPResolver(path or os.getenv('GEOIP_DB_PATH', DEFAULT_GEOIP_DB_PATH))
+
+
+if __name__ == "__main__":
+    # Biên dịch CSV thành file nhị phân: python geoip.py <input.csv> [output.bin]
+    if len(sys.argv) < 2:
+        print("Usage: python geoip.py <input.csv> [output.bin]")
+        sys.exit(1)
+    output = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_GEOIP_DB_PATH
+    count = GeoIPResolver.compile(sys.argv[1], output)
+    print(f"Compiled {count} ranges into {output}")
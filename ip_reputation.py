@@ -0,0 +1,290 @@
+import heapq
+import ipaddress
+import json
+import logging
+import mmap
+import os
+import socket
+import struct
+import sys
+from array import array
+from bisect import bisect_right
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger('fraud_detection.ip_reputation')
+
+
+class IPReputation(NamedTuple):
+    """Reputation of the range an address was matched against"""
+    network: str
+    score: int
+    country: Optional[str]
+
+
+_V4_MAPPED_PREFIX = bytes(10) + b'\xff\xff'
+
+# Compiled index file: header, then 8-byte aligned sections
+#   v4 starts/ends (uint32), v6 starts/ends as high/low uint64 halves,
+#   v4/v6 scores (uint8), v4/v6 country ids (uint16), newline-separated country codes
+_MAGIC = b'IPREPIDX'
+_FORMAT_VERSION = 1
+_HEADER = struct.Struct('<8sIIIII4x')  # magic, version, little-endian flag, v4 count, v6 count, countries size
+_U64_MASK = (1 << 64) - 1
+
+
+def parse_address(ip: str) -> Optional[Tuple[int, int]]:
+    """Return (version, packed integer) for an IP string, or None if it is not a valid address"""
+    # inet_pton is much cheaper than ipaddress.ip_address on the lookup hot path
+    try:
+        return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big')
+    except (OSError, TypeError):
+        pass
+    try:
+        packed = socket.inet_pton(socket.AF_INET6, ip.split('%', 1)[0])
+    except (OSError, TypeError, AttributeError):
+        return None
+    # IPv4-mapped IPv6 addresses (::ffff:a.b.c.d) are matched against the IPv4 table
+    if packed[:12] == _V4_MAPPED_PREFIX:
+        return 4, int.from_bytes(packed[12:], 'big')
+    return 6, int.from_bytes(packed, 'big')
+
+
+def parse_range(value: str) -> Optional[Tuple[int, int, int]]:
+    """Return (version, first, last) for an IP address or CIDR block string, or None if invalid"""
+    if isinstance(value, str) and '/' not in value:
+        address = parse_address(value.strip())
+        return (address[0], address[1], address[1]) if address else None
+    try:
+        network = ipaddress.ip_network(value.strip(), strict=False)
+    except (ValueError, AttributeError):
+        return None
+    return network.version, int(network.network_address), int(network.broadcast_address)
+
+
+def _format_range(version: int, start: int, end: int) -> str:
+    first = ipaddress.ip_address(start) if version == 4 else ipaddress.IPv6Address(start)
+    if start == end:
+        return str(first)
+    last = ipaddress.ip_address(end) if version == 4 else ipaddress.IPv6Address(end)
+    networks = list(ipaddress.summarize_address_range(first, last))
+    return str(networks[0]) if len(networks) == 1 else f"{first}-{last}"
+
+
+def _disjoint_intervals(entries: List[Tuple[int, int, int, int]]) -> List[Tuple[int, int, int, int]]:
+    """
+    Flatten possibly overlapping (start, end, score, country_id) entries into sorted,
+    non-overlapping intervals. Where ranges overlap the highest score wins, and
+    adjacent intervals carrying the same data are merged.
+    """
+    if not entries:
+        return []
+    entries.sort()
+    boundaries = sorted({e[0] for e in entries} | {e[1] + 1 for e in entries})
+
+    result = []
+    active = []  # heap of (-score, end, country_id)
+    i = 0
+    for k in range(len(boundaries) - 1):
+        point = boundaries[k]
+        while i < len(entries) and entries[i][0] <= point:
+            start, end, score, country_id = entries[i]
+            heapq.heappush(active, (-score, end, country_id))
+            i += 1
+        while active and active[0][1] < point:
+            heapq.heappop(active)
+        if not active:
+            continue
+
+        score, country_id = -active[0][0], active[0][2]
+        last = boundaries[k + 1] - 1
+        if result and result[-1][1] == point - 1 and result[-1][2:] == (score, country_id):
+            result[-1] = (result[-1][0], last, score, country_id)
+        else:
+            result.append((point, last, score, country_id))
+    return result
+
+
+def align8(offset: int) -> int:
+    return (offset + 7) & ~7
+
+
+class U128View:
+    """Read-only sequence of 128-bit integers stored as parallel high/low uint64 arrays"""
+
+    def __init__(self, high, low):
+        self.high = high
+        self.low = low
+
+    def __len__(self):
+        return len(self.high)
+
+    def __getitem__(self, i):
+        return (self.high[i] << 64) | self.low[i]
+
+
+class IPReputationIndex:
+    """
+    IP reputation index over IPv4/IPv6 addresses and CIDR blocks.
+
+    Ranges are stored as packed integers in sorted, non-overlapping interval arrays
+    (one table per address family) and looked up with a binary search, so membership
+    is O(log n) and a single CIDR entry covers its whole subnet. Each interval carries
+    the abuse confidence score and country code of the entry it came from.
+    """
+
+    def __init__(self, entries: Iterable[Tuple[str, int, Optional[str]]] = ()):
+        """
+        Args:
+            entries: iterable of (ip_or_cidr, confidence_score, country_code)
+        """
+        self.countries: List[Optional[str]] = [None]
+        country_ids: Dict[Optional[str], int] = {None: 0}
+        parsed = {4: [], 6: []}
+        skipped = 0
+
+        for value, score, country in entries:
+            ip_range = parse_range(value)
+            if ip_range is None:
+                skipped += 1
+                continue
+            if country not in country_ids:
+                country_ids[country] = len(self.countries)
+                self.countries.append(country)
+            version, start, end = ip_range
+            parsed[version].append((start, end, max(0, min(100, int(score or 0))), country_ids[country]))
+
+        if skipped:
+            logger.warning(f"Skipped {skipped} invalid IP reputation entries")
+
+        self._tables = {version: self._build_table(version, parsed[version]) for version in (4, 6)}
+
+    @staticmethod
+    def _build_table(version: int, entries: List[Tuple[int, int, int, int]]):
+        intervals = _disjoint_intervals(entries)
+        starts = [iv[0] for iv in intervals]
+        ends = [iv[1] for iv in intervals]
+        # IPv4 bounds fit in uint32 arrays; IPv6 bounds exceed 64 bits and stay Python ints
+        if version == 4:
+            starts, ends = array('I', starts), array('I', ends)
+        return starts, ends, array('B', (iv[2] for iv in intervals)), array('H', (iv[3] for iv in intervals))
+
+    @classmethod
+    def from_abuseipdb(cls, payload: Dict) -> 'IPReputationIndex':
+        """Build an index from an AbuseIPDB blacklist response (or a file in the same format)"""
+        return cls(
+            (item['ipAddress'], item.get('abuseConfidenceScore', 100), item.get('countryCode'))
+            for item in payload.get('data', [])
+            if item.get('ipAddress')
+        )
+
+    @classmethod
+    def from_file(cls, path: str) -> 'IPReputationIndex':
+        with open(path, 'r') as f:
+            return cls.from_abuseipdb(json.load(f))
+
+    def lookup(self, ip: str) -> Optional[IPReputation]:
+        """Return the reputation of the range containing `ip`, or None if it is not listed"""
+        address = parse_address(ip)
+        if address is None:
+            return None
+        version, value = address
+        starts, ends, scores, country_ids = self._tables[version]
+        i = bisect_right(starts, value) - 1
+        if i < 0 or value > ends[i]:
+            return None
+        return IPReputation(
+            network=_format_range(version, starts[i], ends[i]),
+            score=scores[i],
+            country=self.countries[country_ids[i]]
+        )
+
+    def __contains__(self, ip: str) -> bool:
+        address = parse_address(ip)
+        if address is None:
+            return False
+        version, value = address
+        starts, ends = self._tables[version][:2]
+        i = bisect_right(starts, value) - 1
+        return i >= 0 and value <= ends[i]
+
+    def __len__(self) -> int:
+        """Number of disjoint intervals in the index"""
+        return sum(len(table[0]) for table in self._tables.values())
+
+    def save(self, path: str):
+        """
+        Compile the index into a binary file that can be memory-mapped with `load`.
+
+        The file is written next to `path` and renamed over it, so processes that
+        poll the path either see the previous version or the complete new one.
+        """
+        starts4, ends4, scores4, countries4 = self._tables[4]
+        starts6, ends6, scores6, countries6 = self._tables[6]
+        countries = '\n'.join(c or '' for c in self.countries).encode('utf-8')
+
+        sections = [
+            array('I', starts4), array('I', ends4),
+            array('Q', (v >> 64 for v in starts6)), array('Q', (v & _U64_MASK for v in starts6)),
+            array('Q', (v >> 64 for v in ends6)), array('Q', (v & _U64_MASK for v in ends6)),
+            array('B', scores4), array('B', scores6),
+            array('H', countries4), array('H', countries6),
+            countries,
+        ]
+        header = _HEADER.pack(_MAGIC, _FORMAT_VERSION, sys.byteorder == 'little',
+                              len(starts4), len(starts6), len(countries))
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(header)
+            offset = len(header)
+            for section in sections:
+                padding = align8(offset) - offset
+                f.write(bytes(padding))
+                data = section.tobytes() if isinstance(section, array) else section
+                f.write(data)
+                offset += padding + len(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'IPReputationIndex':
+        """
+        Memory-map a compiled index file read-only.
+
+        The arrays are views over the mapping, so every process that loads the same
+        file shares its pages through the OS page cache instead of holding a copy.
+        """
+        with open(path, 'rb') as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, little_endian, n4, n6, countries_size = _HEADER.unpack_from(mapping, 0)
+        if magic != _MAGIC or version != _FORMAT_VERSION:
+            raise ValueError(f"{path} is not a compiled IP reputation index (version {_FORMAT_VERSION})")
+        if bool(little_endian) != (sys.byteorder == 'little'):
+            raise ValueError(f"{path} was compiled on a host with a different byte order")
+
+        view = memoryview(mapping)
+        offset = _HEADER.size
+        sections = []
+        for fmt, count in (('I', n4), ('I', n4), ('Q', n6), ('Q', n6), ('Q', n6), ('Q', n6),
+                           ('B', n4), ('B', n6), ('H', n4), ('H', n6)):
+            offset = align8(offset)
+            size = count * struct.calcsize(fmt)
+            sections.append(view[offset:offset + size].cast(fmt))
+            offset += size
+        offset = align8(offset)
+        countries = bytes(view[offset:offset + countries_size]).decode('utf-8').split('\n')
+
+        starts4, ends4, starts6_hi, starts6_lo, ends6_hi, ends6_lo, scores4, scores6, countries4, countries6 = sections
+        index = cls.__new__(cls)
+        index.countries = [c or None for c in countries]
+        index._tables = {
+            4: (starts4, ends4, scores4, countries4),
+            6: (U128View(starts6_hi, starts6_lo), U128View(ends6_hi, ends6_lo), scores6, countries6),
+        }
+        # Keep the mapping alive as long as the views over it are reachable
+        index._mapping = mapping
+        return index
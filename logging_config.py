@@ -0,0 +1,175 @@
+"""
+Process-wide logging setup.
+
+Request threads (and the event loop) only put records on a bounded in-memory queue;
+a single listener thread formats them and does the console/file writes. Records are
+filtered before anything is rendered: a disabled level costs one `isEnabledFor`
+check, and per-stage sampling drops a fraction of the chatty INFO/DEBUG records of
+a stage (a logger name prefix) without ever dropping warnings or errors.
+
+Environment:
+    LOG_LEVEL          root level (default INFO)
+    LOG_FILE           log file, overriding the one passed by the caller ('none' disables it)
+    LOG_FORMAT         text (default) or json, one structured object per line
+    LOG_SAMPLE_RATES   per-stage rates, e.g. "fraud_detection.rules=0.1,fraud_detection.ai=0.5"
+    LOG_QUEUE_SIZE     records buffered before new ones are dropped (default 10000)
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+from datetime import date
+from typing import Dict, Optional
+
+from serialization import Serialized, dumps
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Attributes of every LogRecord; anything else on a record came from `extra=`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+# Arguments that cannot change between the log call and the listener formatting the record
+_IMMUTABLE_ARGS = (str, bytes, int, float, bool, type(None), date, Serialized)
+
+_lock = threading.Lock()
+_listener: Optional[logging.handlers.QueueListener] = None
+_queue_handler: Optional['DroppingQueueHandler'] = None
+
+
+def parse_sample_rates(spec: Optional[str]) -> Dict[str, float]:
+    """"stage=rate,..." -> {stage: rate}, rates clamped to [0, 1]"""
+    rates = {}
+    for item in (spec or '').split(','):
+        if '=' not in item:
+            continue
+        stage, rate = item.split('=', 1)
+        rates[stage.strip()] = min(1.0, max(0.0, float(rate)))
+    return rates
+
+
+class SamplingFilter(logging.Filter):
+    """Keep each record below WARNING with the rate of its stage (longest matching logger-name prefix)"""
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        # Longest prefix first
+        self.rates = sorted(rates.items(), key=lambda item: len(item[0]), reverse=True)
+        self._cache: Dict[str, float] = {}
+
+    def rate_for(self, name: str) -> float:
+        rate = self._cache.get(name)
+        if rate is None:
+            rate = 1.0
+            for stage, stage_rate in self.rates:
+                if name == stage or name.startswith(stage + '.'):
+                    rate = stage_rate
+                    break
+            self._cache[name] = rate
+        return rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rate_for(record.name)
+        return rate >= 1.0 or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: time, level, logger, message, plus any `extra=` fields"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return dumps(entry).decode('utf-8')
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that never blocks the caller: when the queue is full the record is
+    dropped and counted. Messages are rendered by the listener thread unless an argument
+    could still be mutated by the caller, in which case they are rendered here.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        args = record.args
+        if args and not (isinstance(args, tuple) and all(isinstance(arg, _IMMUTABLE_ARGS) for arg in args)):
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            # Tracebacks hold frames of the calling thread: render them now
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def configure_logging(log_file: Optional[str] = None, level: Optional[str] = None) -> logging.Logger:
+    """
+    Route all logging through the background queue. The first call in a process wins;
+    later calls (e.g. from another module's constructor) keep the existing setup.
+    """
+    global _listener, _queue_handler
+    root = logging.getLogger()
+    with _lock:
+        if _listener is not None:
+            return root
+
+        log_file = os.getenv('LOG_FILE', log_file)
+        formatter = JsonFormatter() if os.getenv('LOG_FORMAT', 'text').lower() == 'json' else logging.Formatter(TEXT_FORMAT)
+        handlers = [logging.StreamHandler()]
+        if log_file and log_file.lower() != 'none':
+            handlers.append(logging.FileHandler(log_file))
+        for handler in handlers:
+            handler.setFormatter(formatter)
+
+        _queue_handler = DroppingQueueHandler(queue.Queue(maxsize=int(os.getenv('LOG_QUEUE_SIZE', 10000))))
+        rates = parse_sample_rates(os.getenv('LOG_SAMPLE_RATES'))
+        if rates:
+            _queue_handler.addFilter(SamplingFilter(rates))
+
+        root.handlers = [_queue_handler]
+        root.setLevel((level or os.getenv('LOG_LEVEL', 'INFO')).upper())
+        _listener = logging.handlers.QueueListener(_queue_handler.queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(shutdown_logging)
+    return root
+
+
+def shutdown_logging():
+    """Write out the queued records and stop the listener thread"""
+    global _listener
+    with _lock:
+        listener, _listener = _listener, None
+    if listener is not None:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+
+
+def dropped_records() -> int:
+    """Records dropped because the queue was full"""
+    return _queue_handler.dropped if _queue_handler is not None else 0
+
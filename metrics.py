@@ -0,0 +1,260 @@
+"""
+In-process latency histograms and counters, rendered in the Prometheus text format.
+
+Metrics are per worker process, like the pool metrics of /api/v1/db-pool: scrape every
+worker (or run a single uvicorn worker) to see the whole service.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from profiling import current_trace
+
+# Seconds: from an in-memory rule check up to a slow LLM call
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def _key(self, labels: Dict) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {_format_number(value)}')
+        return lines
+
+
+class Gauge:
+    """Current value of something; `set_function` samples it at render time instead"""
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+        self._value = 0.0
+        self._function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float):
+        with self._lock:
+            self._value = float(value)
+
+    def set_function(self, function: Optional[Callable[[], float]]):
+        with self._lock:
+            self._function = function
+
+    def value(self) -> float:
+        with self._lock:
+            function, value = self._function, self._value
+        return float(function()) if function is not None else value
+
+    def render(self) -> List[str]:
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge',
+                f'{self.name} {_format_number(self.value())}']
+
+
+class Histogram:
+    """Cumulative-bucket histogram; `time(**labels)` observes the duration of a block in seconds"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # labels -> [per-bucket counts (last one is +Inf), sum]
+        self._series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def snapshot(self, **labels) -> Dict:
+        """Count, sum and cumulative bucket counts of one label set"""
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            counts, total = self._series.get(key, [[0] * (len(self.buckets) + 1), 0.0])
+            counts = list(counts)
+        cumulative, running = [], 0
+        for count in counts:
+            running += count
+            cumulative.append(running)
+        return {'count': running, 'sum': total, 'buckets': dict(zip(self.buckets + (float('inf'),), cumulative))}
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = sorted((key, list(counts), total) for key, (counts, total) in self._series.items())
+        for key, counts, total in items:
+            running = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                running += count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_number(bound)}"')
+                lines.append(f'{self.name}_bucket{labels} {running}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {repr(total)}')
+            lines.append(f'{self.name}_count{labels} {running}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, documentation: str) -> Gauge:
+        metric = Gauge(name, documentation)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+# Stages of process_transaction, in cascade order: profile_load, rule_<check>, ml_model,
+# ai_prompt_build, ai_network, ai_parse, db_commit, alert_enqueue, plus total for the whole request
+STAGE_SECONDS = REGISTRY.histogram(
+    'fraud_stage_duration_seconds',
+    'Time spent in each stage of transaction processing',
+    ['stage', 'model_version']
+)
+STAGE_ERRORS = REGISTRY.counter(
+    'fraud_stage_errors_total',
+    'Stages that raised an exception',
+    ['stage', 'model_version']
+)
+TRANSACTIONS = REGISTRY.counter(
+    'fraud_transactions_processed_total',
+    'Processed transactions by outcome (normal, suspicious, error)',
+    ['outcome', 'model_version']
+)
+ALERTS_ENQUEUED = REGISTRY.counter(
+    'fraud_alerts_enqueued_total',
+    'Alert deliveries queued, one per channel',
+    ['channel']
+)
+ALERT_DELIVERIES = REGISTRY.counter(
+    'fraud_alert_deliveries_total',
+    'Alert delivery attempts by outcome (sent, retried, failed, skipped)',
+    ['channel', 'outcome']
+)
+ALERT_SENDS_SUPPRESSED = REGISTRY.counter(
+    'fraud_alert_sends_suppressed_total',
+    'Alert deliveries not made because the alert was merged into a per-user digest',
+    ['channel']
+)
+ALERT_DIGESTS = REGISTRY.counter(
+    'fraud_alert_digests_total',
+    'Digests of coalesced alerts queued, by trigger (window end, escalation)',
+    ['trigger']
+)
+ALERT_SEND_SECONDS = REGISTRY.histogram(
+    'fraud_alert_send_duration_seconds',
+    'Time the notification provider took to accept an alert',
+    ['channel']
+)
+
+ANALYSIS_WRITER_QUEUE_DEPTH = REGISTRY.gauge(
+    'fraud_analysis_writer_queue_depth',
+    'Analysis rows accepted by the write-behind writer and not yet written'
+)
+ANALYSIS_WRITER_ROWS = REGISTRY.counter(
+    'fraud_analysis_writer_rows_total',
+    'Analysis rows by outcome (submitted, written, rejected, failed, replayed)',
+    ['outcome']
+)
+ANALYSIS_WRITER_FLUSH_SECONDS = REGISTRY.histogram(
+    'fraud_analysis_writer_flush_duration_seconds',
+    'Time the write-behind writer took to write one batch'
+)
+
+
+@contextmanager
+def stage_timer(stage: str, model_version: str = 'none') -> Iterator[None]:
+    """Observe the duration of a stage (and add it to the request's trace, if any), counting it as an error if the block raises"""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=stage, model_version=model_version)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, stage=stage, model_version=model_version)
+        trace = current_trace()
+        if trace is not None:
+            trace.add_stage(stage, elapsed)
+
+
+def render() -> str:
+    """All metrics of this process in the Prometheus text exposition format"""
+    return REGISTRY.render()
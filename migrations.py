@@ -0,0 +1,278 @@
+import argparse
+import json
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Callable, List, NamedTuple, Optional
+
+from sqlalchemy import Column, DateTime, Index, Integer, MetaData, String, Table, inspect, insert, select, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import IntegrityError
+
+from database import ANALYSIS_PAYLOAD_FIELDS, WRITE_TRANSACTION, Base, TransactionAnalysisPayload
+from rollups import TOTAL_BUCKET, bucket_starts
+
+logger = logging.getLogger('fraud_detection.migrations')
+
+# Bookkeeping table: one row per applied migration
+_migration_metadata = MetaData()
+schema_migrations = Table(
+    'schema_migrations', _migration_metadata,
+    Column('version', Integer, primary_key=True),
+    Column('description', String(255)),
+    Column('applied_at', DateTime),
+)
+
+_LOCK_NAME = 'fraud_detection_schema_migrations'
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    apply: Callable[[Connection], None]
+
+
+def _index_names(connection: Connection, table: str) -> set:
+    return {index['name'] for index in inspect(connection).get_indexes(table)}
+
+
+def _column_names(connection: Connection, table: str) -> set:
+    return {column['name'] for column in inspect(connection).get_columns(table)}
+
+
+def _create_model_indexes(connection: Connection, table: str, names: List[str]):
+    """Create the named indexes declared on the model's table, skipping those that already exist"""
+    existing = _index_names(connection, table)
+    for index in Base.metadata.tables[table].indexes:
+        if index.name in names and index.name not in existing:
+            logger.info(f"Creating index {index.name} on {table}")
+            index.create(connection)
+
+
+def _drop_index(connection: Connection, table: str, name: str, *columns: str):
+    if name in _index_names(connection, table):
+        logger.info(f"Dropping index {name} on {table}")
+        model_table = Base.metadata.tables[table]
+        Index(name, *(model_table.c[column] for column in columns)).drop(connection)
+
+
+def _composite_history_indexes(connection: Connection):
+    # (user_id, timestamp) serves both the per-user history ORDER BY ... LIMIT and the
+    # recent-window range; it also makes the single-column user_id indexes redundant
+    _create_model_indexes(connection, 'transactions', ['idx_transactions_user_timestamp', 'idx_transactions_timestamp'])
+    _create_model_indexes(connection, 'transaction_analyses', [
+        'idx_transaction_analyses_user_timestamp',
+        'idx_transaction_analyses_timestamp',
+        'idx_transaction_analyses_is_fraud',
+    ])
+    _drop_index(connection, 'transactions', 'idx_transactions_user_id', 'user_id')
+    _drop_index(connection, 'transaction_analyses', 'idx_transaction_analyses_user_id', 'user_id')
+
+
+def _alert_indexes(connection: Connection):
+    # The SQL bootstrap script predates Alert.status
+    if 'status' not in _column_names(connection, 'alerts'):
+        logger.info("Adding column alerts.status")
+        connection.execute(text("ALTER TABLE alerts ADD COLUMN status VARCHAR(20) DEFAULT 'new'"))
+    _create_model_indexes(connection, 'alerts', ['idx_alerts_user_timestamp', 'idx_alerts_status_timestamp'])
+
+
+def _analysis_payload_table(connection: Connection, batch_size: int = 1000):
+    # Move the verbose JSON columns of existing analyses into the compressed side table, then drop them
+    Base.metadata.tables['transaction_analysis_payloads'].create(connection, checkfirst=True)
+    inline = [name for name in ANALYSIS_PAYLOAD_FIELDS if name in _column_names(connection, 'transaction_analyses')]
+    if not inline:
+        return
+    moved = 0
+    last_id = ''
+    while True:
+        rows = connection.execute(text(
+            f"SELECT transaction_id, {', '.join(inline)} FROM transaction_analyses "
+            f"WHERE transaction_id > :last_id ORDER BY transaction_id LIMIT {batch_size}"
+        ), {'last_id': last_id}).mappings().all()
+        if not rows:
+            break
+        last_id = rows[-1]['transaction_id']
+        ids = [row['transaction_id'] for row in rows]
+        existing = set(connection.execute(
+            select(TransactionAnalysisPayload.transaction_id).where(TransactionAnalysisPayload.transaction_id.in_(ids))
+        ).scalars())
+        payloads = []
+        for row in rows:
+            fields = {
+                name: json.loads(row[name]) if isinstance(row[name], str) else row[name]
+                for name in inline if row[name] is not None
+            }
+            if fields and row['transaction_id'] not in existing:
+                codec, data = TransactionAnalysisPayload.encode(fields)
+                payloads.append({'transaction_id': row['transaction_id'], 'codec': codec, 'data': data})
+        if payloads:
+            connection.execute(insert(TransactionAnalysisPayload), payloads)
+            moved += len(payloads)
+        connection.commit()
+    logger.info(f"Moved {moved} analysis payloads to transaction_analysis_payloads")
+    for name in inline:
+        connection.execute(text(f"ALTER TABLE transaction_analyses DROP COLUMN {name}"))
+    connection.commit()
+
+
+def _user_profile_values(connection: Connection):
+    # Turn the JSON lists of existing profiles into occurrence counters, then drop them
+    Base.metadata.tables['user_profile_values'].create(connection, checkfirst=True)
+    inline = {
+        'location': 'common_locations',
+        'device': 'common_devices',
+        'category': 'common_categories',
+        'ip_address': 'common_ip_addresses',
+        'hour': 'typical_transaction_hours',
+    }
+    columns = _column_names(connection, 'user_profiles')
+    inline = {attribute: column for attribute, column in inline.items() if column in columns}
+    if not inline:
+        return
+    profiles = connection.execute(text(
+        f"SELECT user_id, last_updated, {', '.join(inline.values())} FROM user_profiles"
+    )).mappings().all()
+    table = Base.metadata.tables['user_profile_values']
+    existing = set(connection.execute(select(table.c.user_id).distinct()).scalars())
+    for profile in profiles:
+        if profile['user_id'] in existing:
+            continue
+        last_updated = profile['last_updated']
+        if isinstance(last_updated, str):
+            last_updated = datetime.fromisoformat(last_updated)
+        rows = []
+        for attribute, column in inline.items():
+            values = profile[column]
+            values = json.loads(values) if isinstance(values, str) else values
+            for value in {str(v)[:255] for v in values or [] if v is not None and v != ''}:
+                rows.append({'user_id': profile['user_id'], 'attribute': attribute, 'value': value,
+                             'count': 1, 'last_seen_at': last_updated})
+        if rows:
+            connection.execute(insert(table), rows)
+    connection.commit()
+    for column in inline.values():
+        connection.execute(text(f"ALTER TABLE user_profiles DROP COLUMN {column}"))
+    connection.commit()
+
+
+def _alert_rows(connection: Connection):
+    # Alerts are written with their analysis, before the transaction is verified: the SQL
+    # bootstrap script pointed alerts.transaction_id at transactions instead
+    for fk in inspect(connection).get_foreign_keys('alerts'):
+        if fk['constrained_columns'] == ['transaction_id'] and fk['referred_table'] == 'transactions' and fk['name']:
+            logger.info(f"Pointing alerts.transaction_id at transaction_analyses instead of {fk['name']}")
+            connection.execute(text(f"ALTER TABLE alerts DROP FOREIGN KEY {fk['name']}"))
+            connection.execute(text(
+                "ALTER TABLE alerts ADD CONSTRAINT fk_alerts_transaction_analyses "
+                "FOREIGN KEY (transaction_id) REFERENCES transaction_analyses (transaction_id)"
+            ))
+    # Keyset pages of all alerts, newest first; InnoDB appends alert_id to it as the tie-break
+    _create_model_indexes(connection, 'alerts', ['idx_alerts_timestamp'])
+
+
+def _statistics_rollups(connection: Connection, days: int = 30):
+    # Seed the counters from the existing rows, once: all-time totals, plus hour and day
+    # buckets for the longest statistics window (by transaction and alert timestamp)
+    table = Base.metadata.tables['statistics_rollups']
+    table.create(connection, checkfirst=True)
+    if connection.execute(select(table.c.slot).limit(1)).first() is not None:
+        return
+    since = datetime.now() - timedelta(days=days + 1)
+    counts = defaultdict(lambda: dict.fromkeys(('transactions', 'suspicious', 'alerts', 'new_users'), 0))
+    sources = (
+        ('transactions', "SELECT timestamp, is_suspicious FROM transaction_analyses"),
+        ('alerts', "SELECT timestamp, NULL FROM alerts"),
+        ('new_users', "SELECT created_at, NULL FROM users"),
+    )
+    for counter, sql in sources:
+        result = connection.execute(text(sql).execution_options(stream_results=True))
+        for timestamp, is_suspicious in result:
+            if isinstance(timestamp, str):
+                timestamp = datetime.fromisoformat(timestamp)
+            recent = timestamp is not None and timestamp >= since
+            for key in (bucket_starts(timestamp) if recent else {'total': TOTAL_BUCKET}).items():
+                counts[key][counter] += 1
+                if is_suspicious:
+                    counts[key]['suspicious'] += 1
+    rows = [dict(values, granularity=granularity, bucket=bucket, slot=0) for (granularity, bucket), values in counts.items()]
+    for start in range(0, len(rows), 1000):
+        connection.execute(insert(table), rows[start:start + 1000])
+    connection.commit()
+    logger.info(f"Seeded {len(rows)} statistics rollup rows")
+
+
+# Append new migrations at the end; never renumber or edit one that has shipped
+MIGRATIONS: List[Migration] = [
+    Migration(1, 'Composite (user_id, timestamp) indexes for transaction history lookups', _composite_history_indexes),
+    Migration(2, 'Alert status column and alert lookup indexes', _alert_indexes),
+    Migration(3, 'Move analysis payload JSON into the compressed transaction_analysis_payloads table', _analysis_payload_table),
+    Migration(4, 'Replace profile JSON lists with user_profile_values counters', _user_profile_values),
+    Migration(5, 'Alert foreign key to transaction_analyses and alert timestamp index', _alert_rows),
+    Migration(6, 'Statistics rollup counters seeded from existing transactions, alerts and users', _statistics_rollups),
+]
+
+
+def applied_versions(connection: Connection) -> set:
+    _migration_metadata.create_all(connection)
+    return set(connection.execute(select(schema_migrations.c.version)).scalars())
+
+
+def upgrade(engine: Engine, target: Optional[int] = None) -> List[int]:
+    """
+    Apply pending migrations in version order, up to `target` if given.
+
+    Every migration checks the live schema before changing it, so running it against a
+    database that already has the change (e.g. one created by `create_all`) only records
+    the version. Concurrent workers serialize on a MySQL named lock. Returns the versions
+    applied by this call.
+    """
+    applied = []
+    # Migrations read the schema, then change it: on SQLite, take the write lock up front
+    with engine.execution_options(**WRITE_TRANSACTION).connect() as connection:
+        is_mysql = connection.dialect.name == 'mysql'
+        if is_mysql:
+            connection.execute(text("SELECT GET_LOCK(:name, 60)"), {'name': _LOCK_NAME})
+        try:
+            done = applied_versions(connection)
+            connection.commit()
+            for migration in MIGRATIONS:
+                if migration.version in done or (target is not None and migration.version > target):
+                    continue
+                logger.info(f"Applying migration {migration.version}: {migration.description}")
+                migration.apply(connection)
+                try:
+                    connection.execute(insert(schema_migrations).values(
+                        version=migration.version,
+                        description=migration.description,
+                        applied_at=datetime.now()
+                    ))
+                    connection.commit()
+                except IntegrityError:
+                    # Another process recorded it first
+                    connection.rollback()
+                applied.append(migration.version)
+        finally:
+            if is_mysql:
+                connection.execute(text("SELECT RELEASE_LOCK(:name)"), {'name': _LOCK_NAME})
+    return applied
+
+
+if __name__ == "__main__":
+    from database import engine
+
+    parser = argparse.ArgumentParser(description='Apply schema migrations')
+    parser.add_argument('--status', action='store_true', help='List migrations and whether they are applied')
+    parser.add_argument('--target', type=int, help='Apply migrations up to this version')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    if args.status:
+        with engine.connect() as connection:
+            done = applied_versions(connection)
+            connection.commit()
+        for migration in MIGRATIONS:
+            print(f"{migration.version:4d} {'applied' if migration.version in done else 'pending':8s} {migration.description}")
+    else:
+        versions = upgrade(engine, args.target)
+        print(f"Applied migrations: {versions}" if versions else "Schema is up to date")
@@ -0,0 +1,195 @@
+"""
+Per-request diagnostics.
+
+`RequestTrace` collects the stage timings (from metrics.stage_timer) and the database
+statements of one request; it lives in a context variable, so it follows the request
+through threads' own contexts and through asyncio tasks and SQLAlchemy's greenlets.
+`RequestProfiler` captures a cProfile and optionally a tracemalloc snapshot for one in
+every N requests into a local directory.
+
+Environment:
+    PROFILE_SAMPLE_EVERY   profile one request in N (default 0: disabled)
+    PROFILE_DIR            where .prof / .tracemalloc files go (default data/profiles)
+    PROFILE_TRACEMALLOC    also snapshot memory allocations (default false)
+    PROFILE_MAX_FILES      oldest captures beyond this are deleted (default 200)
+"""
+import cProfile
+import glob
+import itertools
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import event
+
+logger = logging.getLogger('fraud_detection.profiling')
+
+DEFAULT_PROFILE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'profiles')
+
+# Header / query flag that asks for the timing breakdown in the response
+DEBUG_TIMING_HEADER = 'X-Debug-Timing'
+DEBUG_TIMING_PARAM = 'debug_timing'
+
+
+class RequestTrace:
+    """Stage timings and database statements of one request"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages: List[Tuple[str, float]] = []
+        self.queries = 0
+        self.query_seconds = 0.0
+
+    def add_stage(self, stage: str, seconds: float):
+        self.stages.append((stage, seconds))
+
+    def add_query(self, seconds: float):
+        self.queries += 1
+        self.query_seconds += seconds
+
+    def to_dict(self) -> Dict:
+        return {
+            'elapsed_ms': round((time.perf_counter() - self.started) * 1000, 3),
+            'stages': [{'stage': stage, 'ms': round(seconds * 1000, 3)} for stage, seconds in self.stages],
+            'db_queries': self.queries,
+            'db_query_ms': round(self.query_seconds * 1000, 3),
+        }
+
+    def server_timing(self) -> str:
+        """Value of a Server-Timing header (stages repeated within the request are summed)"""
+        totals: Dict[str, float] = {}
+        for stage, seconds in self.stages:
+            totals[stage] = totals.get(stage, 0.0) + seconds
+        entries = [f'{stage};dur={seconds * 1000:.3f}' for stage, seconds in totals.items()]
+        entries.append(f'db;desc="{self.queries} queries";dur={self.query_seconds * 1000:.3f}')
+        return ', '.join(entries)
+
+
+_current_trace: ContextVar[Optional[RequestTrace]] = ContextVar('request_trace', default=None)
+
+
+def current_trace() -> Optional[RequestTrace]:
+    return _current_trace.get()
+
+
+@contextmanager
+def trace_request(enabled: bool = True) -> Iterator[Optional[RequestTrace]]:
+    """Collect a RequestTrace for the enclosed block (yields None when not enabled)"""
+    if not enabled:
+        yield None
+        return
+    trace = RequestTrace()
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+def debug_timing_requested(headers, args) -> bool:
+    """Whether the request asked for a timing breakdown (disabled with DEBUG_TIMING_ENABLED=false)"""
+    if os.getenv('DEBUG_TIMING_ENABLED', 'true').lower() in ('0', 'false', 'no'):
+        return False
+    value = headers.get(DEBUG_TIMING_HEADER) or args.get(DEBUG_TIMING_PARAM)
+    return value is not None and value.lower() in ('1', 'true', 'yes')
+
+
+def instrument_engine(engine):
+    """Count the statements (and their time) of `engine` against the current request's trace"""
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        if _current_trace.get() is not None:
+            conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        trace = _current_trace.get()
+        started = conn.info.get('query_started')
+        if trace is not None and started:
+            trace.add_query(time.perf_counter() - started.pop())
+
+
+class RequestProfiler:
+    """
+    Profile one request in every `sample_every` with cProfile (and tracemalloc).
+
+    cProfile only sees the thread that enabled it, which is the request under a sync
+    worker; on the event loop it also sees the other coroutines that ran while the
+    sampled request was waiting. tracemalloc is process-wide.
+    """
+
+    def __init__(self, sample_every: int = 0, directory: str = DEFAULT_PROFILE_DIR,
+                 trace_memory: bool = False, max_files: int = 200):
+        self.sample_every = sample_every
+        self.directory = directory
+        self.trace_memory = trace_memory
+        self.max_files = max_files
+        self._counter = itertools.count(1)
+        # cProfile allows one active profiler per thread and the event loop is one thread
+        self._active = threading.local()
+        self._memory_lock = threading.Lock()
+        self.captured = 0
+
+    @classmethod
+    def from_env(cls) -> 'RequestProfiler':
+        return cls(
+            sample_every=int(os.getenv('PROFILE_SAMPLE_EVERY', 0)),
+            directory=os.getenv('PROFILE_DIR', DEFAULT_PROFILE_DIR),
+            trace_memory=os.getenv('PROFILE_TRACEMALLOC', 'false').lower() in ('1', 'true', 'yes'),
+            max_files=int(os.getenv('PROFILE_MAX_FILES', 200)),
+        )
+
+    def _should_sample(self) -> bool:
+        return self.sample_every > 0 and next(self._counter) % self.sample_every == 0
+
+    @contextmanager
+    def profile(self, name: str) -> Iterator[bool]:
+        """Profile the enclosed block if this request is sampled; yields whether it is"""
+        if not self._should_sample() or getattr(self._active, 'profiling', False):
+            yield False
+            return
+        self._active.profiling = True
+        profiler = cProfile.Profile()
+        started_memory = False
+        if self.trace_memory:
+            with self._memory_lock:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    started_memory = True
+        profiler.enable()
+        try:
+            yield True
+        finally:
+            profiler.disable()
+            self._active.profiling = False
+            try:
+                self._save(name, profiler, started_memory)
+            except Exception as e:
+                logger.warning("Không thể lưu profile của request %s: %s", name, e)
+
+    def _save(self, name: str, profiler: cProfile.Profile, started_memory: bool):
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, f"{datetime.now():%Y%m%dT%H%M%S%f}_{os.getpid()}_{name}")
+        profiler.dump_stats(base + '.prof')
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.take_snapshot().dump(base + '.tracemalloc')
+            if started_memory:
+                with self._memory_lock:
+                    tracemalloc.stop()
+        self.captured += 1
+        logger.info("Saved request profile %s.prof", base)
+        self._prune()
+
+    def _prune(self):
+        captures = sorted(glob.glob(os.path.join(self.directory, '*.prof')))
+        for path in captures[:max(0, len(captures) - self.max_files)]:
+            for extension in ('.prof', '.tracemalloc'):
+                stale = path[:-len('.prof')] + extension
+                if os.path.exists(stale):
+                    os.remove(stale)
@@ -0,0 +1,121 @@
+import random
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Optional
+
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.orm import Session
+
+from database import StatisticsRollup, upsert
+
+# Rows per bucket; a writer increments one picked at random so that concurrent scoring
+# transactions rarely wait on each other's row lock
+SLOTS = 8
+TOTAL_BUCKET = datetime(1970, 1, 1)
+COUNTERS = ('transactions', 'suspicious', 'alerts', 'new_users')
+
+# Window -> (granularity, number of buckets including the current one)
+WINDOWS = {
+    'last_hour': ('hour', 1),
+    'last_24_hours': ('hour', 24),
+    'last_7_days': ('day', 7),
+    'last_30_days': ('day', 30),
+}
+_WIDTH = {'hour': timedelta(hours=1), 'day': timedelta(days=1)}
+
+
+def bucket_starts(ts: datetime) -> Dict[str, datetime]:
+    """Bucket of `ts` for every granularity (in the offset `ts` is stored with, like the DateTime columns)"""
+    hour = ts.replace(minute=0, second=0, microsecond=0, tzinfo=None)
+    return {'hour': hour, 'day': hour.replace(hour=0), 'total': TOTAL_BUCKET}
+
+
+def record_counts(db: Session, transactions: int = 0, suspicious: int = 0, alerts: int = 0, new_users: int = 0,
+                  timestamp: Optional[datetime] = None):
+    """
+    Add to the hour, day and all-time counters of `timestamp`, the counted rows' own
+    timestamp (now if None), with one upsert run inside the caller's transaction, so the
+    counters move exactly with the rows they count. Run it last before committing: it
+    keeps a hot row locked until the commit.
+    """
+    counts = {'transactions': transactions, 'suspicious': suspicious, 'alerts': alerts, 'new_users': new_users}
+    counts = {name: value for name, value in counts.items() if value}
+    if not counts:
+        return
+    slot = random.randrange(SLOTS)
+    rows = [dict({name: counts.get(name, 0) for name in COUNTERS}, granularity=granularity, bucket=bucket, slot=slot)
+            for granularity, bucket in bucket_starts(timestamp or datetime.now()).items()]
+    db.execute(upsert(db.get_bind(), StatisticsRollup, rows, {
+        name: getattr(StatisticsRollup, name) + value for name, value in counts.items()
+    }))
+
+
+def record_analysis_counts(db: Session, analysis_rows: Iterable[Dict], new_users: int = 0):
+    """
+    Count analysis rows (and their 'alert' rows) in the buckets of their own timestamps,
+    and users created now, the way migration 6 seeded the counters from existing rows:
+    one `record_counts` per hour bucket involved, in bucket order.
+    """
+    counts = defaultdict(Counter)
+    for row in analysis_rows:
+        timestamp = row.get('timestamp') or datetime.now()
+        if isinstance(timestamp, str):
+            timestamp = datetime.fromisoformat(timestamp)
+        values = counts[bucket_starts(timestamp)['hour']]
+        values['transactions'] += 1
+        values['suspicious'] += int(bool(row.get('is_suspicious')))
+        if row.get('alert'):
+            counts[bucket_starts(row['alert'].get('timestamp') or datetime.now())['hour']]['alerts'] += 1
+    if new_users:
+        counts[bucket_starts(datetime.now())['hour']]['new_users'] += new_users
+    for hour in sorted(counts):
+        record_counts(db, timestamp=hour, **counts[hour])
+
+
+def get_statistics(db: Session, now: Optional[datetime] = None) -> Dict:
+    """
+    All-time counts and the counts of every window in WINDOWS. Windows are aligned on
+    buckets: 'last_24_hours' is the current hour and the 23 before it. One query reads
+    at most SLOTS rows per bucket of the longest windows, whatever the traffic.
+    """
+    now = now or datetime.now()
+    current = bucket_starts(now)
+    since = {
+        name: current[granularity] - _WIDTH[granularity] * (buckets - 1)
+        for name, (granularity, buckets) in WINDOWS.items()
+    }
+    oldest = {
+        granularity: min(since[name] for name, (g, _) in WINDOWS.items() if g == granularity)
+        for granularity in _WIDTH
+    }
+    rollup = StatisticsRollup
+    rows = db.execute(
+        select(rollup.granularity, rollup.bucket, *(func.sum(getattr(rollup, name)) for name in COUNTERS))
+        .where(or_(
+            rollup.granularity == 'total',
+            *(and_(rollup.granularity == granularity, rollup.bucket >= start) for granularity, start in oldest.items())
+        ))
+        .group_by(rollup.granularity, rollup.bucket)
+    ).all()
+
+    totals = dict.fromkeys(COUNTERS, 0)
+    windows = {name: dict(dict.fromkeys(COUNTERS, 0), since=since[name].isoformat()) for name in WINDOWS}
+    for granularity, bucket, *values in rows:
+        values = dict(zip(COUNTERS, (int(value or 0) for value in values)))
+        if granularity == 'total':
+            totals = values
+            continue
+        for name, (window_granularity, _) in WINDOWS.items():
+            if granularity == window_granularity and bucket >= since[name]:
+                for counter, value in values.items():
+                    windows[name][counter] += value
+
+    return {
+        'user_count': totals['new_users'],
+        'transaction_count': totals['transactions'],
+        'suspicious_count': totals['suspicious'],
+        'alert_count': totals['alerts'],
+        'alerts_last_7_days': windows['last_7_days']['alerts'],
+        'windows': windows,
+        'generated_at': now.isoformat(),
+    }
@@ -0,0 +1,86 @@
+"""
+JSON encoding for the request path.
+
+`dumps` produces compact UTF-8 bytes with orjson when it is installed (falling back
+to the standard library), handling datetimes, numpy scalars/arrays and anything else
+through `str`. Responses are encoded once; log records reference the encoded bytes
+through `Serialized`, which is only decoded if a handler actually emits the record.
+"""
+import json
+from datetime import date, datetime
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+JSON_MIMETYPE = 'application/json'
+
+
+def _default(value: Any):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if np is not None:
+        if isinstance(value, np.generic):
+            return value.item()
+        if isinstance(value, np.ndarray):
+            return value.tolist()
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    return str(value)
+
+
+if orjson is not None:
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+    def dumps(obj: Any) -> bytes:
+        """Compact JSON bytes for `obj`"""
+        return orjson.dumps(obj, default=_default, option=_ORJSON_OPTIONS)
+
+    def loads(data: Union[bytes, str]) -> Any:
+        return orjson.loads(data)
+else:
+    def dumps(obj: Any) -> bytes:
+        """Compact JSON bytes for `obj`"""
+        return json.dumps(obj, default=_default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    def loads(data: Union[bytes, str]) -> Any:
+        return json.loads(data)
+
+
+def dumps_str(obj: Any) -> str:
+    """Compact JSON text for `obj` (e.g. to embed in a prompt)"""
+    return dumps(obj).decode('utf-8')
+
+
+class Serialized:
+    """
+    Already-encoded JSON passed to a log call: `logger.info("Response: %s", Serialized(body))`
+    decodes the bytes only when the record is formatted, and never encodes again
+    """
+
+    __slots__ = ('data',)
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def __str__(self) -> str:
+        return self.data.decode('utf-8', errors='replace')
+
+
+class Lazy:
+    """Object to log as JSON, encoded only if the record is emitted: `logger.debug("%s", Lazy(obj))`"""
+
+    __slots__ = ('obj',)
+
+    def __init__(self, obj: Any):
+        self.obj = obj
+
+    def __str__(self) -> str:
+        return dumps_str(self.obj)
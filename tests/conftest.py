@@ -0,0 +1,27 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# The modules read their database settings at import time: point them at a throwaway
+# SQLite file before any test module imports them
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='fraud_detection_tests_'), 'test.db')}"
+for name in ('DATABASE_READ_URL', 'DB_READ_HOST', 'ANALYSIS_WRITE_BEHIND'):
+    os.environ.pop(name, None)
+
+
+@pytest.fixture
+def db():
+    """Session on an empty database with the current schema"""
+    from database import Base, SessionLocal, engine
+
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
@@ -0,0 +1,37 @@
+import pytest
+
+from alert_queue import AlertQueue, combined_risk
+
+
+@pytest.fixture
+def alert_queue(tmp_path):
+    return AlertQueue(str(tmp_path / 'alert_queue.db'), coalesce_window=300)
+
+
+def _survival(alert_queue, user_id):
+    return alert_queue._connection().execute('SELECT survival FROM alert_digests WHERE user_id = ?', (user_id,)).fetchone()[0]
+
+
+def _alert(risk_score):
+    return {'user_id': 'u1', 'transaction_id': 't1', 'risk_score': risk_score, 'reasons': []}
+
+
+def test_out_of_range_risks_are_clamped_before_combining(alert_queue):
+    channels = ('push', 'email', 'sms')
+    assert alert_queue.submit('u1', _alert(1.7), channels) == ('high', 3)
+    assert _survival(alert_queue, 'u1') == 0.0
+    # A second out-of-range score must not flip the product's sign and undo the escalation
+    assert alert_queue.submit('u1', _alert(1.5), channels) == ('high', 0)
+    assert _survival(alert_queue, 'u1') == 0.0
+
+    assert alert_queue.submit('u2', _alert(-0.5), channels) == ('low', 1)
+    assert alert_queue.submit('u2', _alert(None), channels) == ('low', 0)
+    assert _survival(alert_queue, 'u2') == 1.0
+
+
+def test_medium_alerts_escalate_once_combined(alert_queue):
+    channels = ('push', 'email', 'sms')
+    assert alert_queue.submit('u1', _alert(0.6), channels) == ('medium', 2)
+    assert alert_queue.submit('u1', _alert(0.6), channels) == ('high', 3)
+    assert _survival(alert_queue, 'u1') == pytest.approx(0.16)
+    assert combined_risk([0.6, 0.6]) == pytest.approx(0.84)
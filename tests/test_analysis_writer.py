@@ -0,0 +1,106 @@
+import os
+from datetime import datetime
+
+import pytest
+
+from analysis_writer import DEAD_LETTER_FILE, AnalysisWriter, _decode_row, _encode_row
+from database import Alert, SessionLocal, TransactionAnalysis
+
+fcntl = pytest.importorskip('fcntl')
+
+
+def _row(transaction_id, user_id='u1', **values):
+    return dict({
+        'transaction_id': transaction_id,
+        'user_id': user_id,
+        'amount': 100.0,
+        'category': 'food',
+        'timestamp': datetime(2026, 3, 1, 10, 0),
+        'is_suspicious': False,
+        'risk_score': 10.0,
+        'verified': False,
+        'is_fraud': False,
+    }, **values)
+
+
+def _write_journal(path, rows):
+    with open(path, 'w') as f:
+        f.writelines(_encode_row(row) + '\n' for row in rows)
+
+
+def _analysis_ids():
+    db = SessionLocal()
+    try:
+        return [transaction_id for (transaction_id,) in
+                db.query(TransactionAnalysis.transaction_id).order_by(TransactionAnalysis.transaction_id)]
+    finally:
+        db.close()
+
+
+@pytest.fixture
+def journal_dir(db, tmp_path):
+    return str(tmp_path / 'journal')
+
+
+def test_journal_round_trips_timestamps():
+    row = _row('t1', is_suspicious=True, alert={'user_id': 'u1', 'transaction_id': 't1',
+                                                'timestamp': datetime(2026, 3, 1, 10, 0, 5), 'risk_score': 90.0})
+    assert _decode_row(_encode_row(row)) == row
+
+
+def test_orphaned_journal_is_replayed_on_start(db, journal_dir):
+    os.makedirs(journal_dir)
+    alert = {'user_id': 'u2', 'transaction_id': 't2', 'timestamp': datetime(2026, 3, 1, 10, 1), 'risk_score': 90.0,
+             'reasons': ['amount'], 'transaction_details': {}, 'status': 'new'}
+    _write_journal(os.path.join(journal_dir, 'analysis.424242.jsonl'), [
+        _row('t1'), _row('t2', user_id='u2', is_suspicious=True, alert=alert),
+    ])
+
+    writer = AnalysisWriter(journal_dir=journal_dir)
+    writer.close()
+
+    assert _analysis_ids() == ['t1', 't2']
+    assert [a.transaction_id for a in db.query(Alert)] == ['t2']
+    assert os.listdir(journal_dir) == []
+
+
+def test_replay_skips_rows_already_written(db, journal_dir):
+    writer = AnalysisWriter(journal_dir=journal_dir)
+    assert writer.submit(_row('t1'))
+    writer.close()
+    _write_journal(os.path.join(journal_dir, 'analysis.424242.jsonl'), [_row('t1'), _row('t2')])
+
+    writer = AnalysisWriter(journal_dir=journal_dir)
+    writer.close()
+
+    assert _analysis_ids() == ['t1', 't2']
+    assert not os.path.exists(os.path.join(journal_dir, DEAD_LETTER_FILE))
+
+
+def test_journal_of_a_live_worker_is_left_alone(db, journal_dir):
+    os.makedirs(journal_dir)
+    path = os.path.join(journal_dir, 'analysis.424242.jsonl')
+    _write_journal(path, [_row('t1')])
+    with open(path, 'a') as live:
+        fcntl.flock(live.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        writer = AnalysisWriter(journal_dir=journal_dir)
+        writer.close()
+
+    assert _analysis_ids() == []
+    assert os.listdir(journal_dir) == ['analysis.424242.jsonl']
+
+
+def test_rows_refused_by_the_database_go_to_the_dead_letter_file(db, journal_dir):
+    writer = AnalysisWriter(journal_dir=journal_dir)
+    assert writer.submit(_row('t1'))
+    assert writer.submit(_row('t1', amount=200.0))
+    assert writer.submit(_row('t2'))
+    assert writer.flush()
+
+    # The journal starts over once every row is either written or dead-lettered
+    assert os.path.getsize(os.path.join(journal_dir, f"analysis.{os.getpid()}.jsonl")) == 0
+    writer.close()
+
+    assert _analysis_ids() == ['t1', 't2']
+    with open(os.path.join(journal_dir, DEAD_LETTER_FILE)) as f:
+        assert [_decode_row(line) for line in f] == [_row('t1', amount=200.0)]
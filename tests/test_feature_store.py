@@ -0,0 +1,102 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from database import UserFeatures, UserProfileValue
+from feature_store import (
+    HOUR, PROFILE_ATTRIBUTES, _window_estimate, ensure_user, get_profile_values, get_user_features, record_transaction
+)
+
+
+def _record(db, *timestamps):
+    ensure_user(db, 'u1')
+    for timestamp in timestamps:
+        record_transaction(db, 'u1', 100.0, timestamp)
+        db.flush()
+    db.commit()
+    return db.get(UserFeatures, 'u1')
+
+
+def _hour_window(row):
+    return row.hour_bucket, row.hour_count, row.prev_hour_count
+
+
+def test_writes_in_the_same_hour_add_up(db):
+    row = _record(db, datetime(2026, 3, 1, 10, 5), datetime(2026, 3, 1, 10, 40))
+    assert _hour_window(row) == (datetime(2026, 3, 1, 10), 2, 0)
+
+
+def test_write_in_the_next_hour_rolls_the_window(db):
+    row = _record(db, datetime(2026, 3, 1, 10, 5), datetime(2026, 3, 1, 10, 40), datetime(2026, 3, 1, 11, 10))
+    assert _hour_window(row) == (datetime(2026, 3, 1, 11), 1, 2)
+    # Half-way through 11:00 the previous hour still counts for half
+    features = get_user_features(db, 'u1', now=datetime(2026, 3, 1, 11, 30))
+    assert features['transactions_last_hour'] == pytest.approx(2.0)
+
+
+def test_write_two_hours_ahead_resets_the_window(db):
+    row = _record(db, datetime(2026, 3, 1, 10, 5), datetime(2026, 3, 1, 10, 40), datetime(2026, 3, 1, 12, 15))
+    assert _hour_window(row) == (datetime(2026, 3, 1, 12), 1, 0)
+
+
+def test_late_write_for_the_previous_hour_bumps_the_previous_count(db):
+    row = _record(db, datetime(2026, 3, 1, 10, 5), datetime(2026, 3, 1, 11, 10), datetime(2026, 3, 1, 10, 55))
+    assert _hour_window(row) == (datetime(2026, 3, 1, 11), 1, 2)
+    assert row.last_seen_at == datetime(2026, 3, 1, 11, 10)
+
+
+def test_write_older_than_the_window_only_updates_the_totals(db):
+    row = _record(db, datetime(2026, 3, 1, 10, 5), datetime(2026, 3, 1, 11, 10), datetime(2026, 3, 1, 8, 0))
+    assert _hour_window(row) == (datetime(2026, 3, 1, 11), 1, 1)
+    assert row.transaction_count == 3
+
+
+def test_day_window_rolls_at_midnight(db):
+    row = _record(db, datetime(2026, 3, 1, 23, 50), datetime(2026, 3, 2, 0, 10))
+    assert (row.day_bucket, row.day_count, row.prev_day_count) == (datetime(2026, 3, 2), 1, 1)
+    assert _hour_window(row) == (datetime(2026, 3, 2), 1, 1)
+
+
+@pytest.mark.parametrize('now, expected', [
+    (datetime(2026, 3, 1, 10, 0), 3 + 4),
+    (datetime(2026, 3, 1, 10, 45), 3 + 4 * 0.25),
+    (datetime(2026, 3, 1, 11, 0), 3),
+    (datetime(2026, 3, 1, 11, 30), 1.5),
+    (datetime(2026, 3, 1, 12, 0), 0),
+    (datetime(2026, 3, 1, 9, 59), 0),
+])
+def test_window_estimate_decays_over_two_buckets(now, expected):
+    assert _window_estimate(datetime(2026, 3, 1, 10), 3, 4, now, HOUR) == pytest.approx(expected)
+
+
+def _profile_value(db, attribute, value, count, last_seen_at):
+    db.add(UserProfileValue(user_id='u1', attribute=attribute, value=value, count=count, last_seen_at=last_seen_at))
+
+
+def test_profile_values_keep_the_most_frequent_per_attribute(db):
+    ensure_user(db, 'u1')
+    seen = datetime(2026, 3, 1)
+    for i in range(5):
+        _profile_value(db, 'ip_address', f'10.0.0.{i}', count=i + 1, last_seen_at=seen)
+    _profile_value(db, 'device', 'old-phone', count=3, last_seen_at=seen - timedelta(days=1))
+    _profile_value(db, 'device', 'new-phone', count=3, last_seen_at=seen)
+    db.commit()
+
+    values = get_profile_values(db, 'u1', limit=3, now=seen)
+    assert values['ip_address'] == ['10.0.0.4', '10.0.0.3', '10.0.0.2']
+    # Equal counts: the most recently seen first
+    assert values['device'] == ['new-phone', 'old-phone']
+    assert values['location'] == []
+    assert get_profile_values(db, 'u1', 'device', limit=1, now=seen) == dict(dict.fromkeys(PROFILE_ATTRIBUTES, []), device=['new-phone'])
+
+
+def test_profile_values_not_seen_within_the_max_age_drop_out(db):
+    ensure_user(db, 'u1')
+    now = datetime(2026, 3, 1)
+    _profile_value(db, 'location', 'Hanoi', count=1, last_seen_at=now - timedelta(days=10))
+    _profile_value(db, 'location', 'Paris', count=50, last_seen_at=now - timedelta(days=400))
+    _profile_value(db, 'location', 'Hue', count=2, last_seen_at=None)
+    db.commit()
+
+    assert get_profile_values(db, 'u1', 'location', now=now, max_age=timedelta(days=365))['location'] == ['Hue', 'Hanoi']
+    assert get_profile_values(db, 'u1', 'location', now=now, max_age=None)['location'] == ['Paris', 'Hue', 'Hanoi']
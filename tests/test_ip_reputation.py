@@ -0,0 +1,63 @@
+from ip_reputation import IPReputationIndex, _disjoint_intervals
+
+
+def test_no_entries():
+    assert _disjoint_intervals([]) == []
+
+
+def test_higher_score_nested_inside_lower_splits_it():
+    assert _disjoint_intervals([(0, 100, 50, 1), (10, 20, 90, 1)]) == [
+        (0, 9, 50, 1), (10, 20, 90, 1), (21, 100, 50, 1),
+    ]
+
+
+def test_lower_score_nested_inside_higher_disappears():
+    assert _disjoint_intervals([(0, 100, 90, 1), (10, 20, 50, 1)]) == [(0, 100, 90, 1)]
+
+
+def test_identical_ranges_keep_the_highest_score():
+    assert _disjoint_intervals([(5, 9, 40, 1), (5, 9, 70, 2), (5, 9, 60, 3)]) == [(5, 9, 70, 2)]
+
+
+def test_ranges_sharing_one_address():
+    assert _disjoint_intervals([(0, 10, 30, 1), (10, 20, 80, 1)]) == [(0, 9, 30, 1), (10, 20, 80, 1)]
+
+
+def test_adjacent_ranges_merge_only_with_the_same_data():
+    assert _disjoint_intervals([(0, 9, 50, 1), (10, 19, 50, 1)]) == [(0, 19, 50, 1)]
+    assert _disjoint_intervals([(0, 9, 50, 1), (10, 19, 50, 2)]) == [(0, 9, 50, 1), (10, 19, 50, 2)]
+    assert _disjoint_intervals([(0, 9, 50, 1), (10, 19, 60, 1)]) == [(0, 9, 50, 1), (10, 19, 60, 1)]
+
+
+def test_gap_between_ranges_is_kept():
+    assert _disjoint_intervals([(20, 29, 50, 1), (0, 9, 50, 1)]) == [(0, 9, 50, 1), (20, 29, 50, 1)]
+
+
+def test_expired_range_under_the_top_of_the_heap():
+    # The high-score range ends first; the wide one underneath must take over again,
+    # while the low-score range ending later never shows through
+    entries = [(0, 100, 50, 1), (10, 20, 90, 1), (15, 60, 10, 1)]
+    assert _disjoint_intervals(entries) == [(0, 9, 50, 1), (10, 20, 90, 1), (21, 100, 50, 1)]
+
+
+def test_range_ending_at_the_top_of_the_address_space():
+    top = 2 ** 32 - 1
+    assert _disjoint_intervals([(top - 255, top, 80, 1), (top, top, 20, 1)]) == [(top - 255, top, 80, 1)]
+
+
+def test_index_lookup_over_overlapping_cidrs(tmp_path):
+    index = IPReputationIndex([
+        ('10.0.0.0/24', 40, 'VN'),
+        ('10.0.0.128/25', 90, 'US'),
+        ('10.0.0.200', 20, 'CN'),
+        ('2001:db8::/32', 70, None),
+    ])
+    path = str(tmp_path / 'blocklist.idx')
+    index.save(path)
+    for loaded in (index, IPReputationIndex.load(path)):
+        assert len(loaded) == 3
+        assert loaded.lookup('10.0.0.1') == ('10.0.0.0/25', 40, 'VN')
+        assert loaded.lookup('10.0.0.200') == ('10.0.0.128/25', 90, 'US')
+        assert loaded.lookup('10.0.1.0') is None
+        assert loaded.lookup('2001:db8:ffff::1').score == 70
+        assert '2001:db9::1' not in loaded
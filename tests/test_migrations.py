@@ -0,0 +1,138 @@
+import json
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine, inspect, select, text
+from sqlalchemy.orm import Session
+
+from database import TransactionAnalysisPayload, UserProfileValue, configure_sqlite
+from feature_store import get_profile_values
+from migrations import MIGRATIONS, upgrade
+from rollups import get_statistics
+
+# Tables as the first release created them, before any migration
+BASELINE_SCHEMA = (
+    """CREATE TABLE users (
+        user_id VARCHAR(50) PRIMARY KEY, email VARCHAR(255), phone VARCHAR(20),
+        created_at DATETIME, last_login DATETIME, risk_score FLOAT
+    )""",
+    """CREATE TABLE transactions (
+        transaction_id VARCHAR(50) PRIMARY KEY, user_id VARCHAR(50) REFERENCES users (user_id),
+        amount FLOAT, currency VARCHAR(10) NOT NULL, description VARCHAR(255), category VARCHAR(100),
+        timestamp DATETIME, ip_address VARCHAR(50), geolocation VARCHAR(255), device_id VARCHAR(100)
+    )""",
+    """CREATE TABLE transaction_analyses (
+        transaction_id VARCHAR(50) PRIMARY KEY, user_id VARCHAR(50) REFERENCES users (user_id),
+        amount FLOAT, category VARCHAR(100), timestamp DATETIME, ip_address VARCHAR(50),
+        geolocation VARCHAR(255), device_id VARCHAR(100), currency VARCHAR(10) NOT NULL,
+        description VARCHAR(255), is_suspicious BOOLEAN, risk_score FLOAT, ai_analysis JSON,
+        traditional_analysis JSON, verified BOOLEAN, is_fraud BOOLEAN, fraud_reasons JSON
+    )""",
+    """CREATE TABLE user_profiles (
+        user_id VARCHAR(50) PRIMARY KEY REFERENCES users (user_id), common_locations JSON,
+        common_devices JSON, common_categories JSON, common_ip_addresses JSON,
+        avg_transaction_amount FLOAT, typical_transaction_hours JSON, last_updated DATETIME
+    )""",
+    """CREATE TABLE alerts (
+        alert_id INTEGER PRIMARY KEY AUTOINCREMENT, user_id VARCHAR(50) REFERENCES users (user_id),
+        timestamp DATETIME, risk_score FLOAT, reasons JSON,
+        transaction_id VARCHAR(50) REFERENCES transactions (transaction_id), transaction_details JSON
+    )""",
+)
+
+
+@pytest.fixture
+def baseline(tmp_path):
+    """Engine on a database with the baseline schema"""
+    engine = create_engine(f"sqlite:///{tmp_path / 'baseline.db'}")
+    configure_sqlite(engine)
+    with engine.begin() as connection:
+        for statement in BASELINE_SCHEMA:
+            connection.execute(text(statement))
+    yield engine
+    engine.dispose()
+
+
+def _insert(engine, table, **values):
+    columns = ', '.join(values)
+    params = ', '.join(f':{name}' for name in values)
+    with engine.begin() as connection:
+        connection.execute(text(f"INSERT INTO {table} ({columns}) VALUES ({params})"), values)
+
+
+def _analysis(engine, transaction_id, timestamp, is_suspicious=False, **values):
+    _insert(engine, 'transaction_analyses', transaction_id=transaction_id, user_id='u1', amount=100.0,
+            currency='VND', timestamp=timestamp, is_suspicious=is_suspicious, risk_score=10.0,
+            verified=False, is_fraud=False, **values)
+
+
+def _columns(engine, table):
+    return {column['name'] for column in inspect(engine).get_columns(table)}
+
+
+def test_upgrade_applies_every_migration_once(baseline):
+    assert upgrade(baseline) == [migration.version for migration in MIGRATIONS]
+    assert upgrade(baseline) == []
+
+
+def test_analysis_payloads_move_to_the_side_table(baseline):
+    _insert(baseline, 'users', user_id='u1', created_at=datetime(2026, 1, 1))
+    _analysis(baseline, 't1', datetime(2026, 1, 1, 10),
+              ai_analysis=json.dumps({'risk_score': 80, 'reasons': ['new device']}),
+              fraud_reasons=json.dumps(['amount']))
+    _analysis(baseline, 't2', datetime(2026, 1, 1, 11))
+
+    upgrade(baseline, target=3)
+
+    assert not {'ai_analysis', 'traditional_analysis', 'fraud_reasons'} & _columns(baseline, 'transaction_analyses')
+    with Session(baseline) as db:
+        payloads = {payload.transaction_id: payload.fields() for payload in db.scalars(select(TransactionAnalysisPayload))}
+    # An analysis without any payload field gets no payload row
+    assert payloads == {'t1': {'ai_analysis': {'risk_score': 80, 'reasons': ['new device']}, 'fraud_reasons': ['amount']}}
+
+
+def test_profile_lists_become_value_counters(baseline):
+    _insert(baseline, 'users', user_id='u1', created_at=datetime(2026, 1, 1))
+    _insert(baseline, 'user_profiles', user_id='u1', avg_transaction_amount=250.0, last_updated=datetime(2026, 2, 1),
+            common_locations=json.dumps(['Hanoi', 'Hanoi', 'Da Nang']), common_devices=json.dumps(['ios-1']),
+            common_categories=json.dumps([]), common_ip_addresses=None, typical_transaction_hours=json.dumps([9, 21]))
+
+    upgrade(baseline, target=4)
+
+    assert not {'common_locations', 'common_devices', 'typical_transaction_hours'} & _columns(baseline, 'user_profiles')
+    with Session(baseline) as db:
+        rows = db.scalars(select(UserProfileValue)).all()
+        assert {row.last_seen_at for row in rows} == {datetime(2026, 2, 1)}
+        values = get_profile_values(db, 'u1', max_age=None)
+    assert sorted(values['location']) == ['Da Nang', 'Hanoi']
+    assert values['device'] == ['ios-1']
+    assert sorted(values['hour']) == ['21', '9']
+    assert values['category'] == [] and values['ip_address'] == []
+
+
+def test_statistics_rollups_are_seeded_from_existing_rows(baseline):
+    now = datetime.now()
+    recent, old = now - timedelta(hours=2), now - timedelta(days=90)
+    _insert(baseline, 'users', user_id='u1', created_at=old)
+    _insert(baseline, 'users', user_id='u2', created_at=recent)
+    _analysis(baseline, 't1', recent, is_suspicious=True)
+    _analysis(baseline, 't2', recent)
+    _analysis(baseline, 't3', old, is_suspicious=True)
+    _insert(baseline, 'transactions', transaction_id='t1', user_id='u1', amount=100.0, currency='VND', timestamp=recent)
+    _insert(baseline, 'alerts', user_id='u1', transaction_id='t1', timestamp=recent, risk_score=90.0)
+
+    upgrade(baseline, target=6)
+
+    with Session(baseline) as db:
+        statistics = get_statistics(db, now)
+    assert statistics['transaction_count'] == 3
+    assert statistics['suspicious_count'] == 2
+    assert statistics['alert_count'] == 1
+    assert statistics['user_count'] == 2
+    last_7_days = statistics['windows']['last_7_days']
+    assert (last_7_days['transactions'], last_7_days['suspicious'], last_7_days['alerts'], last_7_days['new_users']) == (2, 1, 1, 1)
+
+    # Seeding runs once: a second upgrade of an already seeded database changes nothing
+    upgrade(baseline)
+    with Session(baseline) as db:
+        assert get_statistics(db, now)['transaction_count'] == 3
@@ -0,0 +1,42 @@
+from datetime import datetime, timedelta, timezone
+
+from database import StatisticsRollup
+from rollups import get_statistics, record_analysis_counts
+
+
+def _bucket_counts(db, granularity):
+    rows = db.query(StatisticsRollup).filter(StatisticsRollup.granularity == granularity)
+    counts = {}
+    for row in rows:
+        values = counts.setdefault(row.bucket, [0, 0, 0, 0])
+        for i, name in enumerate(('transactions', 'suspicious', 'alerts', 'new_users')):
+            values[i] += getattr(row, name)
+    return counts
+
+
+def test_analyses_count_in_the_bucket_of_their_own_timestamp(db):
+    now = datetime.now()
+    hour = now.replace(minute=0, second=0, microsecond=0)
+    earlier = now - timedelta(hours=3)
+    alert = {'timestamp': now}
+    record_analysis_counts(db, [
+        {'timestamp': earlier, 'is_suspicious': True, 'alert': alert},
+        {'timestamp': earlier.isoformat(), 'is_suspicious': False},
+        {'timestamp': now, 'is_suspicious': False},
+    ], new_users=1)
+    db.commit()
+
+    earlier_hour = earlier.replace(minute=0, second=0, microsecond=0)
+    # The alert is counted when it was raised, the new user when it was created
+    assert _bucket_counts(db, 'hour') == {earlier_hour: [2, 1, 0, 0], hour: [1, 0, 1, 1]}
+    assert _bucket_counts(db, 'total') == {datetime(1970, 1, 1): [3, 1, 1, 1]}
+
+    statistics = get_statistics(db, now)
+    assert statistics['windows']['last_hour']['transactions'] == 1
+    assert statistics['windows']['last_24_hours']['transactions'] == 3
+
+
+def test_timestamps_with_an_offset_are_bucketed_as_stored(db):
+    record_analysis_counts(db, [{'timestamp': datetime(2026, 3, 1, 10, 30, tzinfo=timezone(timedelta(hours=7)))}])
+    db.commit()
+    assert _bucket_counts(db, 'hour') == {datetime(2026, 3, 1, 10): [1, 0, 0, 0]}